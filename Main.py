@@ -1,12 +1,32 @@
 import logging
-import os
 import sqlite3
-import json
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone, time as dt_time
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
 from telegram import Update
-from openai import OpenAI
-import base64
+from telegram.error import BadRequest
+from ai_client import AIClient, OPENROUTER_BASE_URL
+from streaming import EditThrottle, StreamingReply
+from storage import Storage, DB_FILE, enable_incremental_vacuum
+from history_writer import HistoryWriter
+from history_cache import HistoryCache
+from rate_limiter import RateLimiter, LimitResult, POLICIES
+from dispatcher import ChatDispatcher
+from response_cache import ResponseCache, context_hash
+from image_pipeline import ImagePipeline, OUTPUT_MIME_TYPES
+from document_pipeline import DocumentPipeline, DocumentError, document_kind
+from context_builder import ContextBuilder
+from summarizer import Summarizer
+from send_scheduler import SendScheduler, PRIORITY_FOLLOWUP, PRIORITY_BACKGROUND, rate_limit_kwargs
+from metrics import registry, timed, ErrorLogCounter, MetricsServer
+from model_router import ModelRouter, NoVisionModelError, normalize_models, models_error
+from config_store import ConfigStore, ConfigError
+from resilience import CircuitOpenError, RetryPolicy, STATE_VALUES
+from message_splitter import FORMATS, PARSE_MODES, split_message, split_text, utf16_len
+from retention import RetentionJob
+from usage_ledger import UsageLedger, SYSTEM_USER_ID, quotas_error
+from loop_watchdog import LoopWatchdog, LOOP_LAG
+from admission import AdmissionController, lanes_error
 import asyncio
 
 # Настройка логирования
@@ -14,6 +34,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# Ошибки из журнала попадают в метрику bot_errors_total
+logging.getLogger().addHandler(ErrorLogCounter())
 logger = logging.getLogger(__name__)
 
 # Конфигурационный файл
@@ -25,263 +47,554 @@ DEFAULT_CONFIG = {
     "max_message_length": 4000,
     "max_messages_per_day": 50,
     "memory_size": 10,
-    "admin_ids": []
+    "admin_ids": [],
+    "openrouter_base_url": OPENROUTER_BASE_URL,
+    "max_concurrent_requests": 16,
+    "max_concurrent_updates": 64,
+    "request_timeout": 60,
+    "connect_timeout": 10,
+    "http_pool_size": 32,
+    "stream_responses": False,
+    "stream_edit_interval": 1.0,
+    "history_flush_interval": 0.5,
+    "history_batch_size": 100,
+    "history_prune_interval": 60,
+    "history_cache_max_bytes": 16777216,
+    "history_cache_ttl": 1800,
+    "rate_limit_policy": "daily",
+    "rate_limit_burst": 5,
+    "rate_limit_refill_per_minute": 10,
+    "rate_limit_window_seconds": 60,
+    "rate_limit_window_max": 10,
+    "limits_persist_interval": 30,
+    "debounce_window": 0.0,
+    "max_debounce_wait": 3.0,
+    "response_cache_enabled": False,
+    "response_cache_ttl": 86400,
+    "response_cache_max_entries": 5000,
+    "response_cache_similarity": 0.0,
+    "response_cache_max_prompt_length": 300,
+    "response_cache_ignore_history": False,
+    "image_max_edge": 1568,
+    "image_format": "JPEG",
+    "image_quality": 85,
+    "image_cache_max_bytes": 33554432,
+    "history_window": 10,
+    "context_token_budget": 3000,
+    "context_max_message_tokens": 1000,
+    "summarization_enabled": False,
+    "summary_trigger": 8,
+    "summary_keep_recent": 4,
+    "summary_max_tokens": 400,
+    "mode": "polling",
+    "webhook_url": "",
+    "webhook_listen": "0.0.0.0",
+    "webhook_port": 8443,
+    "webhook_path": "/telegram",
+    "webhook_secret_token": "",
+    "webhook_drain_timeout": 30,
+    "state_backend": "sqlite",
+    "redis_url": "redis://localhost:6379/0",
+    "redis_prefix": "bot",
+    "workers": 1,
+    "send_global_rate": 30,
+    "send_chat_rate": 1.0,
+    "send_chat_burst": 3,
+    "send_group_rate_per_minute": 20,
+    "send_max_retries": 3,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": 0,
+    "models": [],
+    "hedge_after": 8.0,
+    "llm_max_retries": 2,
+    "llm_backoff_base": 0.5,
+    "llm_backoff_max": 8.0,
+    "circuit_failure_threshold": 5,
+    "circuit_failure_ratio": 0.5,
+    "circuit_window_size": 50,
+    "circuit_reset_timeout": 30,
+    "document_max_bytes": 10485760,
+    "document_chunk_tokens": 2000,
+    "document_max_chunks": 20,
+    "document_map_concurrency": 4,
+    "document_cache_max_bytes": 16777216,
+    "document_workers": 2,
+    "config_watch_interval": 5,
+    "message_format": "plain",
+    "history_retention_days": 30,
+    "limits_retention_days": 7,
+    "retention_archive_dir": "archive",
+    "retention_batch_size": 1000,
+    "retention_vacuum_pages": 1000,
+    "retention_hour": 3,
+    "usage_flush_interval": 1.0,
+    "usage_batch_size": 200,
+    "daily_token_quota": 0,
+    "user_token_quotas": {},
+    "loop_watchdog_enabled": True,
+    "loop_lag_interval": 0.1,
+    "loop_stall_threshold": 0.25,
+    "loop_sample_interval": 0.02,
+    "loop_stack_depth": 8,
+    "admission_enabled": True,
+    "admission_lanes": {
+        "commands": {"concurrency": 16, "queue": 200, "deadline": 2.0},
+        "text": {"concurrency": 32, "queue": 64, "deadline": 20.0},
+        "media": {"concurrency": 8, "queue": 16, "deadline": 30.0}
+    },
+    "admission_user_limit": 3,
+    "busy_reply_interval": 10.0
 }
 
-def load_config():
-    """Загрузка конфигурации из файла"""
-    try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                # Объединяем с дефолтными значениями
-                return {**DEFAULT_CONFIG, **config}
-        else:
-            # Создаем файл с дефолтными настройками
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(DEFAULT_CONFIG, f, indent=4, ensure_ascii=False)
-            return DEFAULT_CONFIG
-    except Exception as e:
-        logger.error(f"Ошибка загрузки конфига: {e}")
-        return DEFAULT_CONFIG
+# Схема конфига: типы берутся из DEFAULT_CONFIG, здесь дополнительные ограничения
+CONFIG_CHOICES = {
+    "rate_limit_policy": POLICIES,
+    "image_format": tuple(OUTPUT_MIME_TYPES),
+    "mode": ("polling", "webhook"),
+    "state_backend": ("sqlite", "redis"),
+    "message_format": FORMATS,
+}
+CONFIG_POSITIVE = (
+    "max_message_length", "max_concurrent_requests", "max_concurrent_updates", "request_timeout",
+    "connect_timeout", "http_pool_size", "memory_size", "history_batch_size", "history_window",
+    "context_token_budget", "workers", "send_global_rate", "send_chat_rate", "send_chat_burst",
+    "image_max_edge", "image_quality", "document_chunk_tokens", "document_max_chunks",
+    "document_map_concurrency", "document_workers", "retention_batch_size", "retention_vacuum_pages",
+    "usage_flush_interval", "usage_batch_size", "loop_lag_interval", "loop_stall_threshold",
+    "loop_sample_interval", "loop_stack_depth", "circuit_failure_threshold", "circuit_failure_ratio",
+    "circuit_window_size", "send_group_rate_per_minute", "admission_user_limit",
+)
+# Размеры, счетчики и окна: дробные значения ломают срезы, deque и range
+CONFIG_INTEGERS = (
+    "max_message_length", "max_messages_per_day", "memory_size", "max_concurrent_requests",
+    "max_concurrent_updates", "http_pool_size", "history_batch_size", "history_cache_max_bytes",
+    "rate_limit_burst", "rate_limit_window_max", "response_cache_max_entries",
+    "response_cache_max_prompt_length", "image_max_edge", "image_quality", "image_cache_max_bytes",
+    "history_window", "context_token_budget", "context_max_message_tokens", "summary_trigger",
+    "summary_keep_recent", "summary_max_tokens", "webhook_port", "workers", "send_chat_burst",
+    "send_max_retries", "metrics_port", "llm_max_retries", "circuit_failure_threshold",
+    "circuit_window_size", "document_max_bytes", "document_chunk_tokens", "document_max_chunks",
+    "document_map_concurrency", "document_cache_max_bytes", "document_workers",
+    "history_retention_days", "limits_retention_days", "retention_batch_size", "retention_vacuum_pages",
+    "retention_hour", "usage_batch_size", "daily_token_quota", "loop_stack_depth", "admission_user_limit",
+)
+CONFIG_MAXIMUMS = {
+    "max_message_length": 4096, "image_quality": 100, "retention_hour": 23, "circuit_failure_ratio": 1,
+}
+CONFIG_CHECKS = {"models": models_error, "user_token_quotas": quotas_error, "admission_lanes": lanes_error}
 
-def save_config(config):
-    """Сохранение конфигурации в файл"""
-    try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения конфига: {e}")
+def summary_trigger_error(value, values):
+    # Кэш истории держит не больше memory_size сообщений, больший порог сжатия не сработает
+    if value > values["memory_size"]:
+        return f"не больше memory_size ({values['memory_size']})"
+    return None
+
+def summary_keep_recent_error(value, values):
+    # Иначе сжимать нечего, а запрос к нейросети все равно уходит
+    if value >= values["summary_trigger"]:
+        return f"должно быть меньше summary_trigger ({values['summary_trigger']})"
+    return None
+
+CONFIG_RELATIONS = {"summary_trigger": summary_trigger_error, "summary_keep_recent": summary_keep_recent_error}
+
+# Параметры, которые нельзя поменять без перезапуска: соединения, процессы, порты
+CONFIG_RESTART_KEYS = (
+    "telegram_bot_token", "openrouter_api_key", "openrouter_base_url", "max_concurrent_requests",
+    "max_concurrent_updates", "connect_timeout", "http_pool_size", "mode", "webhook_url",
+    "webhook_listen", "webhook_port", "webhook_path", "webhook_secret_token", "state_backend",
+    "redis_url", "redis_prefix", "workers", "metrics_host", "metrics_port", "response_cache_enabled",
+    "document_workers", "config_watch_interval", "retention_hour", "loop_watchdog_enabled",
+    "admission_enabled", "admission_lanes",
+)
+
+def load_config():
+    """Загрузка конфигурации из файла: проверенный неизменяемый снимок с перезагрузкой"""
+    return ConfigStore(
+        CONFIG_FILE,
+        DEFAULT_CONFIG,
+        choices=CONFIG_CHOICES,
+        positive=CONFIG_POSITIVE,
+        maximums=CONFIG_MAXIMUMS,
+        checks=CONFIG_CHECKS,
+        restart_keys=CONFIG_RESTART_KEYS,
+        integers=CONFIG_INTEGERS,
+        relations=CONFIG_RELATIONS
+    )
 
 # Загружаем конфигурацию
 config = load_config()
 
-# Инициализация клиента OpenRouter
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+# Инициализация асинхронного клиента OpenRouter
+ai_client = AIClient(
     api_key=config["openrouter_api_key"],
+    base_url=config["openrouter_base_url"],
+    max_concurrent_requests=config["max_concurrent_requests"],
+    request_timeout=config["request_timeout"],
+    connect_timeout=config["connect_timeout"],
+    pool_size=config["http_pool_size"],
+    retry_policy=RetryPolicy(
+        max_retries=config["llm_max_retries"],
+        base_delay=config["llm_backoff_base"],
+        max_delay=config["llm_backoff_max"]
+    ),
+    failure_threshold=config["circuit_failure_threshold"],
+    reset_timeout=config["circuit_reset_timeout"],
+    failure_ratio=config["circuit_failure_ratio"],
+    window_size=config["circuit_window_size"]
+)
+
+# Выбор модели: запасные модели, хеджирование медленных запросов, vision для изображений
+model_router = ModelRouter(
+    ai_client,
+    normalize_models(config["models"], config["model"], config["request_timeout"]),
+    hedge_after=config["hedge_after"]
+)
+
+# Очередь сообщений пользователей и объединение серий фрагментов
+dispatcher = ChatDispatcher(
+    debounce_window=config["debounce_window"],
+    max_debounce_wait=config["max_debounce_wait"]
+)
+
+# Подготовка изображений перед отправкой в нейросеть
+image_pipeline = ImagePipeline(
+    max_edge=config["image_max_edge"],
+    output_format=config["image_format"],
+    quality=config["image_quality"],
+    cache_max_bytes=config["image_cache_max_bytes"]
+)
+
+# Извлечение текста из документов и сжатие больших файлов
+document_pipeline = DocumentPipeline(
+    max_bytes=config["document_max_bytes"],
+    chunk_tokens=config["document_chunk_tokens"],
+    max_chunks=config["document_max_chunks"],
+    map_concurrency=config["document_map_concurrency"],
+    cache_max_bytes=config["document_cache_max_bytes"],
+    max_workers=config["document_workers"]
+)
+
+# Сборка контекста запроса в пределах бюджета токенов
+context_builder = ContextBuilder(
+    token_budget=config["context_token_budget"],
+    max_message_tokens=config["context_max_message_tokens"]
 )
 
+# Ограничитель частоты правок сообщений при потоковых ответах
+edit_throttle = EditThrottle(config["stream_edit_interval"])
+
+# Планировщик исходящих сообщений с учетом лимитов Bot API,
+# общий лимит делится между процессами-обработчиками
+send_scheduler = SendScheduler(
+    global_rate=config["send_global_rate"] / max(1, config["workers"]),
+    chat_rate=config["send_chat_rate"],
+    chat_burst=config["send_chat_burst"],
+    group_rate_per_minute=config["send_group_rate_per_minute"],
+    max_retries=config["send_max_retries"]
+)
+
+# Хранилище: SQLite с долгоживущим соединением или общий Redis для нескольких процессов
+if config["state_backend"] == "redis":
+    # Пакет redis нужен только для этого режима
+    from redis_storage import RedisStorage
+    storage = RedisStorage(config["redis_url"], prefix=config["redis_prefix"])
+else:
+    storage = Storage(DB_FILE)
+
+# Очередь отложенной записи истории
+history_writer = HistoryWriter(
+    storage,
+    memory_size=config["memory_size"],
+    flush_interval=config["history_flush_interval"],
+    batch_size=config["history_batch_size"],
+    prune_interval=config["history_prune_interval"]
+)
+
+# Лимиты сообщений: счетчики в памяти, периодически сохраняются в базу
+rate_limiter = RateLimiter(
+    storage,
+    max_per_day=config["max_messages_per_day"],
+    policy=config["rate_limit_policy"],
+    burst=config["rate_limit_burst"],
+    refill_per_minute=config["rate_limit_refill_per_minute"],
+    window_seconds=config["rate_limit_window_seconds"],
+    window_max=config["rate_limit_window_max"],
+    persist_interval=config["limits_persist_interval"]
+)
+
+# Кэш ответов на повторяющиеся запросы
+response_cache = ResponseCache(
+    storage,
+    ttl=config["response_cache_ttl"],
+    max_entries=config["response_cache_max_entries"],
+    similarity_threshold=config["response_cache_similarity"],
+    max_prompt_length=config["response_cache_max_prompt_length"]
+)
+
+# Журнал расхода нейросети со сводками по дням и часам и квотами токенов
+usage_ledger = UsageLedger(
+    storage,
+    flush_interval=config["usage_flush_interval"],
+    batch_size=config["usage_batch_size"],
+    daily_token_quota=config["daily_token_quota"],
+    user_token_quotas=config["user_token_quotas"]
+)
+
+# Обслуживание базы SQLite: архив старой истории, очистка и возврат места на диске
+retention_job = RetentionJob(
+    storage,
+    retention_days=config["history_retention_days"],
+    archive_dir=config["retention_archive_dir"],
+    batch_size=config["retention_batch_size"],
+    limits_retention_days=config["limits_retention_days"],
+    vacuum_pages=config["retention_vacuum_pages"]
+)
+
+# Кэш последних сообщений пользователей перед базой
+history_cache = HistoryCache(
+    window_size=config["memory_size"],
+    max_bytes=config["history_cache_max_bytes"],
+    idle_ttl=config["history_cache_ttl"]
+)
+
+# Задержка цикла событий и стеки синхронного кода, который его блокирует
+loop_watchdog = LoopWatchdog(
+    interval=config["loop_lag_interval"],
+    threshold=config["loop_stall_threshold"],
+    sample_interval=config["loop_sample_interval"],
+    stack_depth=config["loop_stack_depth"],
+    handler_files=(__file__,)
+)
+
+# Ответ, когда обновление не допущено из-за перегрузки
+BUSY_TEXT = "⏳ Бот сейчас перегружен. Повторите запрос через минуту."
+
+def is_priority_update(update) -> bool:
+    """Обновления администраторов обслуживаются первыми и не отклоняются"""
+    user = getattr(update, "effective_user", None)
+    return user is not None and is_admin(user.id)
+
+async def reply_busy(update, error):
+    """Вежливый отказ при перегрузке; уступает очередь отправки настоящим ответам"""
+    if update.effective_message is not None:
+        await update.effective_message.reply_text(
+            BUSY_TEXT, **rate_limit_kwargs(update.get_bot(), PRIORITY_BACKGROUND, max_retries=0)
+        )
+
+# Контроль допуска: команды, текст и медиа идут по отдельным полосам с ограниченными очередями
+admission = AdmissionController(
+    config["admission_lanes"],
+    is_priority=is_priority_update,
+    on_reject=reply_busy,
+    busy_reply_interval=config["busy_reply_interval"],
+    spare=config["max_concurrent_updates"],
+    per_user=config["admission_user_limit"]
+)
+
+# Метрики этапов обработки и состояния очередей
+STAGE_SECONDS = registry.histogram("bot_stage_seconds", "Длительность этапов обработки сообщения", ["stage"])
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Длительность обработчиков целиком", ["handler"])
+
+queue_depth_sources = {
+    "history_writer": lambda: history_writer.queue_size,
+    "usage_ledger": lambda: usage_ledger.queue_size,
+    "send_scheduler": lambda: send_scheduler.queued,
+    "llm_in_flight": lambda: ai_client.in_flight,
+}
+for lane in admission.lanes.values():
+    queue_depth_sources[f"admission_{lane.name}"] = lambda lane=lane: lane.queued
+registry.gauge(
+    "bot_queue_depth", "Текущая длина очередей", ["queue"],
+    func=lambda: {name: source() for name, source in queue_depth_sources.items()}
+)
+
+def cache_stats():
+    """Числовые показатели кэшей для метрик"""
+    sources = {
+        "history": history_cache.stats(),
+        "images": image_pipeline.stats(),
+        "documents": document_pipeline.stats(),
+    }
+    if config["response_cache_enabled"]:
+        sources["responses"] = response_cache.stats()
+    return {
+        (cache, name): value
+        for cache, stats in sources.items()
+        for name, value in stats.items()
+    }
+
+registry.gauge("bot_cache_stat", "Показатели кэшей", ["cache", "stat"], func=cache_stats)
+registry.gauge("bot_model_stat", "Доля ошибок и медианная задержка моделей", ["model", "stat"], func=lambda: {
+    (model, name): value
+    for model, stats in model_router.stats().items()
+    for name, value in stats.items() if value is not None
+})
+registry.gauge("bot_circuit_state", "Состояние выключателей: 0 — закрыт, 1 — проверка, 2 — разомкнут", ["model"],
+               func=lambda: {model: STATE_VALUES[breaker.state] for model, breaker in ai_client.breakers.items()})
+registry.gauge("bot_send_scheduler_stat", "Показатели планировщика отправки", ["stat"], func=lambda: {
+    name: value for name, value in send_scheduler.stats().items() if isinstance(value, (int, float))
+})
+
+# Номер процесса-обработчика при workers > 1, влияет на порт метрик
+worker_index = 0
+metrics_server = None
+
 # Инициализация базы данных
 def init_database():
-    """Инициализация базы данных SQLite"""
-    conn = sqlite3.connect('bot_data.db')
-    cursor = conn.cursor()
-    
-    # Таблица для хранения истории сообщений
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS message_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        message_text TEXT NOT NULL,
-        message_type TEXT NOT NULL,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Таблица для учета лимитов сообщений
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS user_limits (
-        user_id INTEGER PRIMARY KEY,
-        message_count INTEGER DEFAULT 0,
-        last_reset_date DATE DEFAULT CURRENT_DATE
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Инициализация хранилища"""
+    storage.open()
 
-def get_user_message_history(user_id, limit=10):
+def upgrade_database():
+    """Перевод старой базы SQLite на пошаговый возврат места, до запуска обработчиков"""
+    if config["state_backend"] != "sqlite":
+        return
+    started = time.perf_counter()
+    try:
+        vacuumed = enable_incremental_vacuum(DB_FILE)
+    except sqlite3.OperationalError as e:
+        # База занята другим процессом: обслуживание просто не вернет место файлу
+        logger.error(f"Не удалось перевести базу в режим auto_vacuum=INCREMENTAL: {e}")
+        return
+    if vacuumed:
+        logger.warning(
+            f"База переведена в режим auto_vacuum=INCREMENTAL полным VACUUM за {time.perf_counter() - started:.1f} с"
+        )
+
+@timed(STAGE_SECONDS, "history")
+async def get_user_message_history(user_id, limit=10):
     """Получение истории сообщений пользователя"""
     try:
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT message_text, message_type, timestamp 
-        FROM message_history 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-        ''', (user_id, limit))
-        
-        history = cursor.fetchall()
-        conn.close()
-        
-        return [{"text": row[0], "type": row[1], "timestamp": row[2]} for row in history]
+        history = history_cache.get(user_id, limit)
+        if history is not None:
+            return history
+        
+        # Промах кэша: загружаем окно целиком, сообщения из очереди записи новее базы
+        window = max(limit, config["memory_size"])
+        history_cache.begin_load(user_id)
+        try:
+            history = history_writer.pending_for(user_id)[:window]
+            if len(history) < window:
+                history += await storage.get_history(user_id, window - len(history))
+        except Exception:
+            history_cache.abort_load(user_id)
+            raise
+        history_cache.put(user_id, history)
+        return history[:limit]
     except Exception as e:
         logger.error(f"Ошибка получения истории: {e}")
         return []
 
+@timed(STAGE_SECONDS, "history_add")
 def add_message_to_history(user_id, message_text, message_type="text"):
-    """Добавление сообщения в историю"""
+    """Добавление сообщения в историю (запись в базу выполняется пачками в фоне)"""
     try:
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        
-        # Удаляем старые сообщения, если превышен лимит
-        cursor.execute('''
-        DELETE FROM message_history 
-        WHERE user_id = ? AND id NOT IN (
-            SELECT id FROM message_history 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        )
-        ''', (user_id, user_id, config["memory_size"]))
-        
-        # Добавляем новое сообщение
-        cursor.execute('''
-        INSERT INTO message_history (user_id, message_text, message_type)
-        VALUES (?, ?, ?)
-        ''', (user_id, message_text, message_type))
+        message = history_writer.add(user_id, message_text, message_type)
+        history_cache.append(user_id, message)
         
-        conn.commit()
-        conn.close()
+        # После ответа бота проверяем, не пора ли сжать длинный разговор
+        if message_type == "bot_response" and config["summarization_enabled"]:
+            summarizer.maybe_schedule(user_id)
     except Exception as e:
         logger.error(f"Ошибка добавления в историю: {e}")
 
-def check_user_limit(user_id):
+@timed(STAGE_SECONDS, "limit_check")
+def check_user_limit(user_id) -> LimitResult:
     """Проверка лимита сообщений пользователя"""
     try:
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        
-        # Проверяем, нужно ли сбросить счетчик
-        cursor.execute('''
-        SELECT message_count, last_reset_date 
-        FROM user_limits 
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        
-        today = datetime.now().date()
-        
-        if result:
-            message_count, last_reset_date = result
-            last_reset_date = datetime.strptime(last_reset_date, '%Y-%m-%d').date()
-            
-            # Если последний сброс был не сегодня, сбрасываем счетчик
-            if last_reset_date != today:
-                cursor.execute('''
-                UPDATE user_limits 
-                SET message_count = 1, last_reset_date = ?
-                WHERE user_id = ?
-                ''', (today.strftime('%Y-%m-%d'), user_id))
-                conn.commit()
-                conn.close()
-                return True, 1
-            else:
-                # Проверяем лимит
-                if message_count >= config["max_messages_per_day"]:
-                    conn.close()
-                    return False, message_count
-                else:
-                    # Увеличиваем счетчик
-                    cursor.execute('''
-                    UPDATE user_limits 
-                    SET message_count = message_count + 1 
-                    WHERE user_id = ?
-                    ''', (user_id,))
-                    conn.commit()
-                    conn.close()
-                    return True, message_count + 1
-        else:
-            # Создаем новую запись
-            cursor.execute('''
-            INSERT INTO user_limits (user_id, message_count, last_reset_date)
-            VALUES (?, 1, ?)
-            ''', (user_id, today.strftime('%Y-%m-%d')))
-            conn.commit()
-            conn.close()
-            return True, 1
-            
+        # Квота токенов проверяется первой: отклоненный ею запрос не тратит лимит сообщений
+        if usage_ledger.tokens_left(user_id) == 0:
+            return LimitResult(False, usage_ledger.today(user_id).tokens, reason="tokens")
+        return rate_limiter.check(user_id)
     except Exception as e:
         logger.error(f"Ошибка проверки лимита: {e}")
-        return True, 0  # В случае ошибки пропускаем проверку
+        return LimitResult(True, 0)  # В случае ошибки пропускаем проверку
 
-async def reset_daily_limits(context: CallbackContext):
-    """Ежедневный сброс лимитов (вызывается по расписанию)"""
-    try:
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        
-        today = datetime.now().date()
-        cursor.execute('''
-        UPDATE user_limits 
-        SET message_count = 0, last_reset_date = ?
-        WHERE last_reset_date != ?
-        ''', (today.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')))
-        
-        conn.commit()
-        conn.close()
-        logger.info("Ежедневные лимиты сброшены")
-    except Exception as e:
-        logger.error(f"Ошибка сброса лимитов: {e}")
+def limit_exceeded_text(limit: LimitResult) -> str:
+    """Текст ответа при превышении лимита"""
+    if limit.reason == "rate":
+        return f"⏳ Слишком много сообщений подряд. Попробуйте через {max(1, round(limit.retry_after))} сек."
+    if limit.reason == "tokens":
+        return (
+            f"🪙 Вы израсходовали дневную квоту токенов ({limit.count} токенов). "
+            f"Квота обновится в 00:00 по UTC."
+        )
+    return (
+        f"❌ Вы исчерпали лимит сообщений на сегодня ({limit.count}/{config['max_messages_per_day']}). "
+        f"Лимит сбросится в 00:00 по UTC."
+    )
 
-def split_long_message(text: str, max_length: int = config["max_message_length"]) -> list:
-    """Разбивает длинное сообщение на части"""
-    if len(text) <= max_length:
-        return [text]
-    
-    parts = []
-    while text:
-        if len(text) <= max_length:
-            parts.append(text)
-            break
-        
-        # Ищем последний перенос строки или точку для красивого разбиения
-        split_index = text.rfind('\n', 0, max_length)
-        if split_index == -1:
-            split_index = text.rfind('. ', 0, max_length)
-        if split_index == -1:
-            split_index = text.rfind(' ', 0, max_length)
-        if split_index == -1:
-            split_index = max_length
-        
-        parts.append(text[:split_index].strip())
-        text = text[split_index:].strip()
-    
-    return parts
-
-async def send_long_message(update: Update, text: str):
-    """Отправляет длинное сообщение частями"""
-    parts = split_long_message(text)
-    for i, part in enumerate(parts):
-        if len(parts) > 1:
-            part = f"📄 Часть {i+1}/{len(parts)}\n\n{part}"
-        await update.message.reply_text(part)
-
-async def download_image(file_id: str, bot) -> str:
-    """Скачивает изображение и возвращает base64 строку"""
+def split_long_message(text: str, max_length: int = None) -> list:
+    """Разбивает длинное сообщение на части без разметки (длина в единицах UTF-16)"""
+    # Лимит читается при каждом вызове, чтобы действовал перезагруженный конфиг
+    if max_length is None:
+        max_length = config["max_message_length"]
+    return list(split_text(text, max_length)) or [text]
+
+def part_header(number: int, total: int) -> str:
+    return f"📄 Часть {number}/{total}\n\n"
+
+@timed(STAGE_SECONDS, "send")
+async def send_long_message(update: Update, text: str, message_format: str = None):
+    """Отправляет длинное сообщение частями в формате message_format"""
+    if message_format is None:
+        message_format = config["message_format"]
+    parse_mode = PARSE_MODES[message_format]
+    max_length = config["max_message_length"]
+    parts = list(split_message(text, max_length, message_format)) or [(text, text)]
+    reserve = 0
+    # Заголовок части тоже входит в лимит: делим заново с местом под самый широкий
+    while len(parts) > 1 and utf16_len(part_header(len(parts), len(parts))) > reserve:
+        reserve = utf16_len(part_header(len(parts), len(parts)))
+        parts = list(split_message(text, max_length - reserve, message_format)) or [(text, text)]
+    bot = update.get_bot()
+    for i, (source, part) in enumerate(parts):
+        header = part_header(i + 1, len(parts)) if len(parts) > 1 else ""
+        if i == 0:
+            send = update.message.reply_text
+        else:
+            # Продолжения уступают очередь первым частям ответов другим пользователям
+            async def send(text, **kwargs):
+                return await bot.send_message(
+                    update.effective_chat.id, text, **kwargs, **rate_limit_kwargs(bot, PRIORITY_FOLLOWUP)
+                )
+        try:
+            await send(header + part, parse_mode=parse_mode)
+        except BadRequest as e:
+            if parse_mode is None:
+                raise
+            # Разметку не удалось разобрать: отправляем исходный текст части как есть
+            logger.warning(f"Ошибка разметки {message_format}: {e}")
+            await send(header + source)
+
+@timed(STAGE_SECONDS, "download_image")
+async def download_image(file_id: str, file_unique_id: str, bot) -> str:
+    """Скачивает и подготавливает изображение, возвращает data URL"""
     try:
-        file = await bot.get_file(file_id)
-        file_data = await file.download_as_bytearray()
-        
-        # Конвертируем в base64
-        image_base64 = base64.b64encode(file_data).decode('utf-8')
-        return image_base64
+        # Уменьшение и пережатие выполняются в отдельном потоке, результат кэшируется
+        return await image_pipeline.prepare(bot, file_id, file_unique_id)
         
     except Exception as e:
         logger.error(f"Ошибка загрузки изображения: {e}")
         raise
 
+@timed(HANDLER_SECONDS, "image")
 async def process_image_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик сообщений с изображениями"""
     try:
         if not update.message.photo:
             return
         
+        # Без модели с vision не скачиваем картинку и не тратим лимит
+        if not model_router.supports_images():
+            await update.message.reply_text(IMAGES_UNSUPPORTED_TEXT)
+            return
+        
         user_id = update.message.from_user.id
         
         # Проверяем лимит
-        allowed, count = check_user_limit(user_id)
-        if not allowed:
-            await update.message.reply_text(
-                f"❌ Вы исчерпали лимит сообщений на сегодня ({count}/{config['max_messages_per_day']}). "
-                f"Лимит сбросится в 00:00 по UTC."
-            )
+        limit = check_user_limit(user_id)
+        if not limit.allowed:
+            await update.message.reply_text(limit_exceeded_text(limit))
             return
         
         # Показываем статус "печатает..."
@@ -295,10 +608,10 @@ async def process_image_message(update: Update, context: ContextTypes.DEFAULT_TY
         add_message_to_history(user_id, f"Изображение: {caption}", "image")
         
         # Скачиваем изображение
-        image_base64 = await download_image(photo.file_id, context.bot)
+        image_url = await download_image(photo.file_id, photo.file_unique_id, context.bot)
         
         # Отправляем запрос к OpenRouter с изображением
-        response = await generate_ai_response_with_image(caption, image_base64, user_id)
+        response = await generate_ai_response_with_image(caption, image_url, user_id)
         
         # Сохраняем ответ в историю
         add_message_to_history(user_id, response, "bot_response")
@@ -310,18 +623,16 @@ async def process_image_message(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Ошибка при обработке изображения: {e}")
         await update.message.reply_text("⚠️ Не удалось обработать изображение. Попробуйте позже.")
 
+@timed(HANDLER_SECONDS, "document")
 async def process_document_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик документов"""
     try:
         user_id = update.message.from_user.id
         
         # Проверяем лимит
-        allowed, count = check_user_limit(user_id)
-        if not allowed:
-            await update.message.reply_text(
-                f"❌ Вы исчерпали лимит сообщений на сегодня ({count}/{config['max_messages_per_day']}). "
-                f"Лимит сбросится в 00:00 по UTC."
-            )
+        limit = check_user_limit(user_id)
+        if not limit.allowed:
+            await update.message.reply_text(limit_exceeded_text(limit))
             return
         
         document = update.message.document
@@ -341,8 +652,12 @@ async def process_document_message(update: Update, context: ContextTypes.DEFAULT
             await handle_image_document(update, context)
             return
         
+        if document_kind(document.file_name, document.mime_type) is not None:
+            await handle_text_document(update, context, caption)
+            return
+        
         # Для других типов файлов просто отправляем текст
-        response = f"📎 Получен файл: {document.file_name or 'без имени'}\nТип: {document.mime_type or 'неизвестно'}\n\nК сожалению, я пока не умею анализировать содержимое файлов. Отправьте текст или изображение для анализа."
+        response = f"📎 Получен файл: {document.file_name or 'без имени'}\nТип: {document.mime_type or 'неизвестно'}\n\nК сожалению, я пока не умею анализировать такие файлы. Поддерживаются txt, md, csv, json и pdf, а также изображения."
         
         # Сохраняем ответ в историю
         add_message_to_history(user_id, response, "bot_response")
@@ -364,12 +679,10 @@ async def handle_image_document(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.chat.send_action(action="typing")
         
         # Скачиваем изображение
-        file = await context.bot.get_file(document.file_id)
-        file_data = await file.download_as_bytearray()
-        image_base64 = base64.b64encode(file_data).decode('utf-8')
+        image_url = await download_image(document.file_id, document.file_unique_id, context.bot)
         
         # Отправляем запрос к OpenRouter с изображением
-        response = await generate_ai_response_with_image(caption, image_base64, user_id)
+        response = await generate_ai_response_with_image(caption, image_url, user_id)
         
         # Сохраняем ответ в историю
         add_message_to_history(user_id, response, "bot_response")
@@ -381,104 +694,355 @@ async def handle_image_document(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Ошибка при обработке изображения-документа: {e}")
         await update.message.reply_text("⚠️ Не удалось обработать изображение. Попробуйте позже.")
 
-async def generate_ai_response_with_image(prompt: str, image_base64: str, user_id: int) -> str:
-    """Генерация ответа с изображением"""
+async def handle_text_document(update: Update, context: ContextTypes.DEFAULT_TYPE, caption: str):
+    """Обработчик текстовых документов и PDF"""
     try:
-        # Получаем историю сообщений
-        history = get_user_message_history(user_id, 5)  # Берем последние 5 сообщений для контекста
+        user_id = update.message.from_user.id
+        document = update.message.document
         
-        # Формируем системное сообщение с учетом истории
-        system_message = "Ты полезный AI ассистент. Анализируй изображения и отвечай на вопросы о них. Будь дружелюбным и helpful."
+        # Показываем статус "печатает..."
+        await update.message.chat.send_action(action="typing")
         
-        if history:
-            system_message += "\n\nКонтекст предыдущих сообщений:"
-            for msg in reversed(history):  # В хронологическом порядке
-                if msg["type"] == "text":
-                    system_message += f"\nПользователь: {msg['text']}"
-                elif msg["type"] == "bot_response":
-                    system_message += f"\nБот: {msg['text']}"
+        # Скачиваем файл и извлекаем текст (результат кэшируется по file_unique_id)
+        extracted = await document_pipeline.prepare(context.bot, document)
         
-        messages = [
-            {
-                "role": "system", 
-                "content": system_message
-            },
+        # Отправляем запрос к OpenRouter с текстом файла или выжимкой по вопросу
+        response = await generate_ai_response_with_document(caption, extracted, document.file_unique_id, user_id)
+        
+        # Сохраняем ответ в историю
+        add_message_to_history(user_id, response, "bot_response")
+        
+        # Отправляем ответ пользователю
+        await send_long_message(update, response)
+        
+    except DocumentError as e:
+        await update.message.reply_text(str(e))
+    except Exception as e:
+        logger.error(f"Ошибка при обработке текстового документа: {e}")
+        await update.message.reply_text("⚠️ Не удалось прочитать файл. Попробуйте позже.")
+
+TEXT_SYSTEM_PROMPT = "Ты полезный AI ассистент в Telegram чате. Отвечай кратко и по делу. Будь дружелюбным и helpful."
+IMAGE_SYSTEM_PROMPT = "Ты полезный AI ассистент. Анализируй изображения и отвечай на вопросы о них. Будь дружелюбным и helpful."
+DOCUMENT_SYSTEM_PROMPT = "Ты полезный AI ассистент. Отвечай на вопросы о присланном файле, опираясь на его текст. Будь дружелюбным и helpful."
+
+@timed(STAGE_SECONDS, "build_prompt")
+async def build_messages(system_prompt: str, user_content, user_id: int) -> tuple:
+    """Формирует сообщения для запроса к нейросети с учетом истории, возвращает (messages, оценка токенов)"""
+    # История не может быть длиннее памяти бота
+    history = await get_user_message_history(user_id, min(config["history_window"], config["memory_size"]))
+    summary = await summarizer.get_summary(user_id) if config["summarization_enabled"] else None
+    messages, prompt_tokens, turns = context_builder.build(system_prompt, history, user_content, summary)
+    logger.info(f"Контекст пользователя {user_id}: {turns} реплик истории, ~{prompt_tokens} токенов")
+    return messages, prompt_tokens
+
+async def summarize_conversation(system_prompt: str, previous_summary, transcript: str) -> str:
+    """Сжатие старой части переписки в краткое содержание"""
+    content = transcript
+    if previous_summary:
+        content = f"Прежнее краткое содержание:\n{previous_summary}\n\nНовые сообщения:\n{transcript}"
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+    started = time.perf_counter()
+    completion, model = await model_router.complete(
+        messages, max_tokens=config["summary_max_tokens"], temperature=0.3
+    )
+    record_completion(SYSTEM_USER_ID, model, "summary", completion, started)
+    return completion.choices[0].message.content.strip()
+
+# Фоновое сжатие длинных разговоров
+summarizer = Summarizer(
+    storage,
+    history_writer,
+    history_cache,
+    summarize_func=summarize_conversation,
+    trigger=config["summary_trigger"],
+    keep_recent=config["summary_keep_recent"]
+)
+
+# Параметры, которые компоненты читают из своих атрибутов: ключ конфига -> (объект, атрибут)
+CONFIG_BINDINGS = {
+    "max_messages_per_day": (rate_limiter, "max_per_day"),
+    "rate_limit_policy": (rate_limiter, "policy"),
+    "rate_limit_burst": (rate_limiter, "burst"),
+    "rate_limit_refill_per_minute": (rate_limiter, "refill_per_minute"),
+    "rate_limit_window_seconds": (rate_limiter, "window_seconds"),
+    "rate_limit_window_max": (rate_limiter, "window_max"),
+    "limits_persist_interval": (rate_limiter, "persist_interval"),
+    "memory_size": (history_writer, "memory_size"),
+    "history_flush_interval": (history_writer, "flush_interval"),
+    "history_batch_size": (history_writer, "batch_size"),
+    "history_prune_interval": (history_writer, "prune_interval"),
+    "history_cache_max_bytes": (history_cache, "max_bytes"),
+    "history_cache_ttl": (history_cache, "idle_ttl"),
+    "debounce_window": (dispatcher, "debounce_window"),
+    "max_debounce_wait": (dispatcher, "max_debounce_wait"),
+    "response_cache_ttl": (response_cache, "ttl"),
+    "response_cache_max_entries": (response_cache, "max_entries"),
+    "response_cache_similarity": (response_cache, "similarity_threshold"),
+    "response_cache_max_prompt_length": (response_cache, "max_prompt_length"),
+    "image_max_edge": (image_pipeline, "max_edge"),
+    "image_format": (image_pipeline, "output_format"),
+    "image_quality": (image_pipeline, "quality"),
+    "image_cache_max_bytes": (image_pipeline, "cache_max_bytes"),
+    "document_max_bytes": (document_pipeline, "max_bytes"),
+    "document_chunk_tokens": (document_pipeline, "chunk_tokens"),
+    "document_max_chunks": (document_pipeline, "max_chunks"),
+    "document_map_concurrency": (document_pipeline, "map_concurrency"),
+    "document_cache_max_bytes": (document_pipeline, "cache_max_bytes"),
+    "context_token_budget": (context_builder, "token_budget"),
+    "context_max_message_tokens": (context_builder, "max_message_tokens"),
+    "summary_trigger": (summarizer, "trigger"),
+    "summary_keep_recent": (summarizer, "keep_recent"),
+    "stream_edit_interval": (edit_throttle, "interval"),
+    "request_timeout": (ai_client, "request_timeout"),
+    "llm_max_retries": (ai_client.retry_policy, "max_retries"),
+    "llm_backoff_base": (ai_client.retry_policy, "base_delay"),
+    "llm_backoff_max": (ai_client.retry_policy, "max_delay"),
+    "history_retention_days": (retention_job, "retention_days"),
+    "limits_retention_days": (retention_job, "limits_retention_days"),
+    "retention_archive_dir": (retention_job, "archive_dir"),
+    "retention_batch_size": (retention_job, "batch_size"),
+    "retention_vacuum_pages": (retention_job, "vacuum_pages"),
+    "usage_flush_interval": (usage_ledger, "flush_interval"),
+    "usage_batch_size": (usage_ledger, "batch_size"),
+    "daily_token_quota": (usage_ledger, "daily_token_quota"),
+    "user_token_quotas": (usage_ledger, "user_token_quotas"),
+    "loop_lag_interval": (loop_watchdog, "interval"),
+    "loop_stall_threshold": (loop_watchdog, "threshold"),
+    "loop_sample_interval": (loop_watchdog, "sample_interval"),
+    "loop_stack_depth": (loop_watchdog, "stack_depth"),
+    "busy_reply_interval": (admission, "busy_reply_interval"),
+    "admission_user_limit": (admission, "per_user"),
+}
+
+def apply_config(changed, snapshot):
+    """Передает измененные параметры работающим компонентам без перезапуска"""
+    for key in changed & CONFIG_BINDINGS.keys():
+        target, attribute = CONFIG_BINDINGS[key]
+        setattr(target, attribute, snapshot[key])
+    if changed & {"memory_size"}:
+        # Окна кэша истории перечитаются из базы с новым размером
+        history_cache.resize(snapshot["memory_size"])
+    if changed & {"models", "model", "request_timeout", "hedge_after"}:
+        model_router.configure(
+            normalize_models(snapshot["models"], snapshot["model"], snapshot["request_timeout"]),
+            snapshot["hedge_after"]
+        )
+    if changed & {"circuit_failure_threshold", "circuit_reset_timeout", "circuit_failure_ratio",
+                  "circuit_window_size"}:
+        ai_client.configure_breakers(
+            snapshot["circuit_failure_threshold"], snapshot["circuit_reset_timeout"],
+            snapshot["circuit_failure_ratio"], snapshot["circuit_window_size"]
+        )
+    if changed & {"send_global_rate", "send_chat_rate", "send_chat_burst",
+                  "send_group_rate_per_minute", "send_max_retries"}:
+        send_scheduler.configure(
+            global_rate=snapshot["send_global_rate"] / max(1, snapshot["workers"]),
+            chat_rate=snapshot["send_chat_rate"],
+            chat_burst=snapshot["send_chat_burst"],
+            group_rate_per_minute=snapshot["send_group_rate_per_minute"],
+            max_retries=snapshot["send_max_retries"]
+        )
+
+config.subscribe(apply_config)
+
+# Ответ, когда выключатели всех моделей разомкнуты
+LLM_UNAVAILABLE_TEXT = "⏳ Нейросеть временно недоступна. Попробуйте через минуту."
+
+# Ответ на изображение, когда ни одна модель из конфига не поддерживает vision
+IMAGES_UNSUPPORTED_TEXT = "🖼 Изображения сейчас не поддерживаются: подключенные модели работают только с текстом."
+
+def record_completion(user_id: int, model: str, kind: str, completion, started: float):
+    """Записывает расход токенов и задержку запроса в журнал использования"""
+    usage = completion.usage
+    usage_ledger.record(
+        user_id, model, kind,
+        usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+        time.perf_counter() - started
+    )
+
+def log_token_usage(user_id: int, estimated_tokens: int, completion, model: str, kind: str, started: float):
+    """Логирует фактический расход токенов запроса и учитывает его в журнале"""
+    if completion.usage:
+        logger.info(
+            f"Токены пользователя {user_id} ({completion.model}): запрос {completion.usage.prompt_tokens} "
+            f"(оценка ~{estimated_tokens}), ответ {completion.usage.completion_tokens}"
+        )
+    record_completion(user_id, model, kind, completion, started)
+
+@timed(STAGE_SECONDS, "llm_image")
+async def generate_ai_response_with_image(prompt: str, image_url: str, user_id: int) -> str:
+    """Генерация ответа с изображением"""
+    try:
+        user_content = [
+            {"type": "text", "text": prompt},
             {
-                "role": "user", 
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
-                        }
-                    }
-                ]
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
+                }
             }
         ]
+        messages, prompt_tokens = await build_messages(IMAGE_SYSTEM_PROMPT, user_content, user_id)
         
-        completion = client.chat.completions.create(
-            model=config["model"],
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7,
-            extra_headers={
-                "HTTP-Referer": "https://github.com/your-username/telegram-ai-bot",
-                "X-Title": "Telegram AI Bot"
-            }
-        )
+        started = time.perf_counter()
+        completion, model = await model_router.complete(messages, vision=True)
+        log_token_usage(user_id, prompt_tokens, completion, model, "image", started)
         
         return completion.choices[0].message.content.strip()
         
+    except CircuitOpenError as e:
+        logger.warning(f"Запрос с изображением отклонен: {e}")
+        return LLM_UNAVAILABLE_TEXT
+    except NoVisionModelError:
+        return IMAGES_UNSUPPORTED_TEXT
     except Exception as e:
         logger.error(f"Ошибка OpenRouter с изображением: {e}")
         return "❌ Не удалось проанализировать изображение. Попробуйте позже."
 
+async def complete_document_step(system_prompt: str, content: str, user_id: int = SYSTEM_USER_ID) -> str:
+    """Один шаг сжатия большого документа (map или reduce)"""
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+    started = time.perf_counter()
+    completion, model = await model_router.complete(
+        messages, max_tokens=config["summary_max_tokens"], temperature=0.3
+    )
+    record_completion(user_id, model, "document_step", completion, started)
+    return completion.choices[0].message.content.strip()
+
+@timed(STAGE_SECONDS, "llm_document")
+async def generate_ai_response_with_document(prompt: str, extracted, file_unique_id: str, user_id: int) -> str:
+    """Генерация ответа по тексту документа"""
+    try:
+        # Шаги сжатия документа тоже расходуют токены пользователя
+        async def complete_step(system_prompt, content):
+            return await complete_document_step(system_prompt, content, user_id)
+        
+        text = await document_pipeline.condense(file_unique_id, extracted, prompt, complete_step)
+        parts = [f"Файл «{extracted.name}»"]
+        if len(extracted.chunks) > 1:
+            parts.append(" (выжимка по частям)")
+        if extracted.truncated:
+            parts.append(", прочитано только начало")
+        user_content = f"{''.join(parts)}:\n{text or '(сведений по вопросу не найдено)'}\n\n{prompt}"
+        messages, prompt_tokens = await build_messages(DOCUMENT_SYSTEM_PROMPT, user_content, user_id)
+        
+        started = time.perf_counter()
+        completion, model = await model_router.complete(messages)
+        log_token_usage(user_id, prompt_tokens, completion, model, "document", started)
+        response = completion.choices[0].message.content.strip()
+        
+        if extracted.truncated:
+            response += "\n\n✂️ Файл большой, я прочитал только его начало."
+        return response
+        
+    except CircuitOpenError as e:
+        logger.warning(f"Запрос по документу отклонен: {e}")
+        return LLM_UNAVAILABLE_TEXT
+    except Exception as e:
+        logger.error(f"Ошибка OpenRouter с документом: {e}")
+        return "❌ Не удалось проанализировать файл. Попробуйте позже."
+
+async def build_text_messages(prompt: str, user_id: int) -> tuple:
+    """Сообщения текстового запроса: (messages, оценка токенов, хеш контекста для кэша ответов).
+
+    Кэш общий для всех пользователей, поэтому в ключ входит весь контекст,
+    который уходит нейросети: краткое содержание и окно истории. С
+    response_cache_ignore_history кэшируемые запросы отправляются без
+    истории — общий ответ не может раскрыть чужую переписку.
+    """
+    if (config["response_cache_enabled"] and config["response_cache_ignore_history"]
+            and response_cache.cacheable(prompt)):
+        messages, prompt_tokens, _ = context_builder.build(TEXT_SYSTEM_PROMPT, [], prompt, None)
+    else:
+        messages, prompt_tokens = await build_messages(TEXT_SYSTEM_PROMPT, prompt, user_id)
+    # Последнее сообщение — сам запрос, он уже входит в ключ кэша
+    cache_context = context_hash(*(f"{message['role']}:{message['content']}" for message in messages[:-1]))
+    return messages, prompt_tokens, cache_context
+
+@timed(STAGE_SECONDS, "llm")
 async def generate_ai_response(prompt: str, user_id: int) -> str:
     """Генерация ответа через OpenRouter"""
     try:
-        # Получаем историю сообщений
-        history = get_user_message_history(user_id, 5)  # Берем последние 5 сообщений для контекста
-        
-        # Формируем системное сообщение с учетом истории
-        system_message = "Ты полезный AI ассистент в Telegram чате. Отвечай кратко и по делу. Будь дружелюбным и helpful."
+        messages, prompt_tokens, cache_context = await build_text_messages(prompt, user_id)
         
-        if history:
-            system_message += "\n\nКонтекст предыдущих сообщений:"
-            for msg in reversed(history):  # В хронологическом порядке
-                if msg["type"] == "text":
-                    system_message += f"\nПользователь: {msg['text']}"
-                elif msg["type"] == "bot_response":
-                    system_message += f"\nБot: {msg['text']}"
+        # Повторяющиеся запросы обслуживаются из кэша без обращения к нейросети
+        if config["response_cache_enabled"]:
+            cached = response_cache.lookup(prompt, config["model"], cache_context)
+            if cached is not None:
+                return cached
         
-        messages = [
-            {
-                "role": "system", 
-                "content": system_message
-            },
-            {
-                "role": "user", 
-                "content": prompt
-            }
-        ]
+        started = time.perf_counter()
+        completion, model = await model_router.complete(messages)
+        log_token_usage(user_id, prompt_tokens, completion, model, "text", started)
+        response = completion.choices[0].message.content.strip()
         
-        completion = client.chat.completions.create(
-            model=config["model"],
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7,
-            extra_headers={
-                "HTTP-Referer": "https://github.com/your-username/telegram-ai-bot",
-                "X-Title": "Telegram AI Bot"
-            }
-        )
+        if config["response_cache_enabled"]:
+            tokens = completion.usage.total_tokens if completion.usage else 0
+            response_cache.store(prompt, config["model"], cache_context, response, tokens)
         
-        return completion.choices[0].message.content.strip()
+        return response
         
+    except CircuitOpenError as e:
+        logger.warning(f"Запрос отклонен: {e}")
+        return LLM_UNAVAILABLE_TEXT
     except Exception as e:
         logger.error(f"Ошибка OpenRouter: {e}")
         return "❌ Не удалось получить ответ от нейросети. Попробуйте позже."
 
+@timed(STAGE_SECONDS, "llm_stream")
+async def stream_ai_response(update: Update, prompt: str, user_id: int) -> str:
+    """Потоковая генерация ответа с постепенной правкой сообщения в чате"""
+    # Нейросеть недоступна: сразу короткий ответ без заглушки и правок
+    if not model_router.available():
+        await update.message.reply_text(LLM_UNAVAILABLE_TEXT)
+        return LLM_UNAVAILABLE_TEXT
+    
+    reply = StreamingReply(update.message, edit_throttle, config["max_message_length"], split_long_message)
+    await reply.start()
+    
+    chunks = []
+    try:
+        messages, _, cache_context = await build_text_messages(prompt, user_id)
+        if config["response_cache_enabled"]:
+            cached = response_cache.lookup(prompt, config["model"], cache_context)
+            if cached is not None:
+                await reply.feed(cached)
+                await reply.finish(cached)
+                return cached
+        
+        started = time.perf_counter()
+        
+        def on_usage(model, usage):
+            usage_ledger.record(
+                user_id, model, "stream", usage.prompt_tokens, usage.completion_tokens, time.perf_counter() - started
+            )
+        
+        async for delta in model_router.stream(messages, on_usage=on_usage):
+            chunks.append(delta)
+            await reply.feed(delta)
+        response = "".join(chunks).strip()
+        
+        if config["response_cache_enabled"] and response:
+            response_cache.store(prompt, config["model"], cache_context, response)
+    except CircuitOpenError as e:
+        logger.warning(f"Потоковый запрос отклонен: {e}")
+        response = LLM_UNAVAILABLE_TEXT
+    except Exception as e:
+        logger.error(f"Ошибка потокового ответа OpenRouter: {e}")
+        response = "".join(chunks).strip()
+    
+    if not response:
+        response = "❌ Не удалось получить ответ от нейросети. Попробуйте позже."
+    await reply.finish(response)
+    return response
+
+@timed(HANDLER_SECONDS, "start")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     welcome_text = """
@@ -487,7 +1051,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Отправь мне:
 • Любое текстовое сообщение
 • Изображение с подписью или без
-• Файлы (только информация о файле)
+• Файлы: txt, md, csv, json, pdf — отвечу по их содержимому
 
 Я постараюсь ответить с помощью нейросети!
 
@@ -504,6 +1068,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """.format(config["model"], config["max_messages_per_day"], config["memory_size"])
     await update.message.reply_text(welcome_text)
 
+@timed(HANDLER_SECONDS, "help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     help_text = """
@@ -517,7 +1082,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📋 Что можно отправлять:
 • Текстовые сообщения
 • Изображения (с подписью или без)
-• Файлы (только информация)
+• Файлы: txt, md, csv, json, pdf
 
 🔧 Технологии:
 • Модель: {}
@@ -528,6 +1093,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """.format(config["model"], config["max_message_length"], config["memory_size"], config["max_messages_per_day"])
     await update.message.reply_text(help_text)
 
+@timed(HANDLER_SECONDS, "about")
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /about"""
     about_text = """
@@ -543,6 +1109,7 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 Возможности:
 • Текстовые ответы
 • Анализ изображений
+• Ответы по содержимому файлов (txt, md, csv, json, pdf)
 • Автоматическое разделение длинных сообщений
 • Обработка ошибок
 • История сообщений ({} последних)
@@ -550,15 +1117,17 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📝 Ограничения:
 • Максимальная длина сообщения: {} символов
-• Поддержка файлов: ограниченная
-    """.format(config["memory_size"], config["max_messages_per_day"], config["max_message_length"])
+• Размер файла: до {:.0f} МБ, большие файлы читаются по частям
+    """.format(config["memory_size"], config["max_messages_per_day"], config["max_message_length"],
+               config["document_max_bytes"] / 1024 / 1024)
     await update.message.reply_text(about_text)
 
+@timed(HANDLER_SECONDS, "history")
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /history"""
     try:
         user_id = update.message.from_user.id
-        history = get_user_message_history(user_id, config["memory_size"])
+        history = await get_user_message_history(user_id, config["memory_size"])
         
         if not history:
             await update.message.reply_text("📝 История сообщений пуста.")
@@ -577,23 +1146,16 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при получении истории: {e}")
         await update.message.reply_text("⚠️ Не удалось получить историю сообщений.")
 
+@timed(HANDLER_SECONDS, "stats")
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /stats"""
     try:
         user_id = update.message.from_user.id
         
         # Получаем статистику использования
-        conn = sqlite3.connect('bot_data.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT message_count, last_reset_date 
-        FROM user_limits 
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        result = rate_limiter.usage(user_id)
+        totals, first_day = await usage_ledger.totals(user_id)
+        usage_text = format_user_usage(user_id, usage_ledger.today(user_id), totals, first_day)
         
         if result:
             message_count, last_reset_date = result
@@ -607,10 +1169,11 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Последний сброс: {last_reset_date}
 • Лимит сбросится: в 00:00 UTC
 
+{usage_text}
 💾 Память: {config["memory_size"]} последних сообщений
             """
         else:
-            stats_text = "📊 Вы еще не отправляли сообщений сегодня."
+            stats_text = f"📊 Вы еще не отправляли сообщений сегодня.\n\n{usage_text}"
         
         await update.message.reply_text(stats_text)
         
@@ -618,35 +1181,266 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при получении статистики: {e}")
         await update.message.reply_text("⚠️ Не удалось получить статистику.")
 
-async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
+def is_admin(user_id: int) -> bool:
+    """Пользователь указан в admin_ids"""
+    return user_id in config["admin_ids"]
+
+def format_user_usage(user_id: int, today, totals, first_day) -> str:
+    """Строки о расходе токенов пользователя для /stats и /usage"""
+    lines = [f"🪙 Токены сегодня: {today.tokens} (запросов к нейросети: {today.requests})"]
+    quota = usage_ledger.quota(user_id)
+    if quota:
+        lines.append(f"• Квота на день: {quota}, осталось {max(0, quota - today.tokens)}")
+    if totals.requests:
+        lines.append(
+            f"📈 Всего с {first_day}: {totals.tokens} токенов "
+            f"(запрос {totals.prompt_tokens}, ответ {totals.completion_tokens}), запросов {totals.requests}"
+        )
+    return "\n".join(lines) + "\n"
+
+def format_usage_report(hourly, top_users) -> str:
+    """Отчет /usage по часовым сводкам и лучшим пользователям суток"""
+    models = {}
+    for _, model, usage, latency in hourly:
+        total = models.setdefault(model, [0, 0, 0.0])
+        total[0] += usage.requests
+        total[1] += usage.tokens
+        total[2] += latency
+    requests = sum(total[0] for total in models.values())
+    if not requests:
+        return "📊 За последние сутки запросов к нейросети не было."
+    
+    lines = ["📊 Использование нейросети за 24 часа (UTC)", ""]
+    for model, (count, tokens, latency) in sorted(models.items(), key=lambda item: -item[1][1]):
+        lines.append(f"🤖 {model}: {count} запросов, {tokens} токенов, в среднем {latency / count:.1f} с")
+    
+    lines += ["", "🕐 По часам:"]
+    hours = {}
+    for hour, _, usage, _ in hourly:
+        total = hours.setdefault(hour, [0, 0])
+        total[0] += usage.requests
+        total[1] += usage.tokens
+    for hour, (count, tokens) in hours.items():
+        lines.append(f"• {hour[-2:]}:00 — {count} запросов, {tokens} токенов")
+    
+    if top_users:
+        lines += ["", "👥 Больше всего токенов сегодня:"]
+        for position, (user_id, usage) in enumerate(top_users, 1):
+            lines.append(f"{position}. {user_id} — {usage.tokens} токенов ({usage.requests} запросов)")
+    return "\n".join(lines)
+
+def format_histogram(histogram) -> str:
+    """Строки сводки гистограммы: число вызовов, среднее и p95"""
+    lines = []
+    for labels, child in sorted(histogram.items()):
+        if not child.count:
+            continue
+        average = child.sum / child.count * 1000
+        p95 = child.quantile(0.95) * 1000
+        lines.append(f"• {':'.join(labels)}: {child.count} шт., ср. {average:.0f} мс, p95 {p95:.0f} мс")
+    return "\n".join(lines) or "• нет данных"
+
+@timed(HANDLER_SECONDS, "metrics")
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /metrics (только для администраторов)"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
     try:
-        user_id = update.message.from_user.id
-        user_message = update.message.text
+        tokens = registry.get("bot_llm_tokens_total")
+        errors = registry.get("bot_errors_total")
+        queues = registry.get("bot_queue_depth").collect()
+        top_errors = sorted(errors.items(), key=lambda item: -item[1].value)[:5]
         
-        # Проверяем лимит
-        allowed, count = check_user_limit(user_id)
-        if not allowed:
+        metrics_text = f"""
+📈 Метрики бота
+
+⏱ Обработчики:
+{format_histogram(HANDLER_SECONDS)}
+
+🔧 Этапы:
+{format_histogram(STAGE_SECONDS)}
+
+🧠 Нейросеть:
+{format_histogram(registry.get("bot_llm_request_seconds"))}
+• Хеджирование: запущено {registry.get("bot_llm_hedges_total").labels("launched").value}, выиграло {registry.get("bot_llm_hedges_total").labels("won").value}
+• Повторы: {registry.get("bot_llm_retries_total").total()}, выключатели: {", ".join(f"{model}={breaker.state}" for model, breaker in ai_client.breakers.items()) or "нет"}
+
+💾 Хранилище:
+{format_histogram(registry.get("bot_db_query_seconds"))}
+• Цикл событий: {format_loop_lag()}
+• Обслуживание: {format_retention_report(retention_job.last_report)}
+
+🔢 Токены: {tokens.total()}
+📬 Очереди: {", ".join(f"{labels[0]}={value}" for labels, value in queues)}
+🚦 Допуск: {format_admission()}
+⚠️ Ошибки: {", ".join(f"{labels[0]}={child.value}" for labels, child in top_errors) or "нет"}
+        """
+        await send_long_message(update, metrics_text, "plain")
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении метрик: {e}")
+        await update.message.reply_text("⚠️ Не удалось получить метрики.")
+
+def format_admission() -> str:
+    """Строка /metrics о полосах допуска: занятые места, очередь и отказы"""
+    if not config["admission_enabled"]:
+        return "выключен"
+    results = registry.get("bot_admission_total")
+    lanes = []
+    for name, (active, queued, service_time) in admission.stats().items():
+        rejected = sum(child.value for (lane, result), child in results.items()
+                       if lane == name and result != "admitted")
+        lanes.append(
+            f"{name} {active}/{admission.lanes[name].concurrency}, очередь {queued}, "
+            f"обработка {service_time:.1f} с, отказов {rejected}"
+        )
+    return "; ".join(lanes)
+
+def format_loop_lag() -> str:
+    """Строка о задержке цикла событий для /metrics и /lag"""
+    if not loop_watchdog.running:
+        return "сторож выключен"
+    lag = LOOP_LAG.labels()
+    stalls = registry.get("bot_event_loop_stalls_total").total()
+    return (
+        f"задержка ср. {lag.sum / max(1, lag.count) * 1000:.1f} мс, p99 {lag.quantile(0.99) * 1000:.0f} мс, "
+        f"максимум {loop_watchdog.max_lag * 1000:.0f} мс, блокировок {stalls}"
+    )
+
+def format_lag_report(offenders) -> str:
+    """Отчет /lag: обработчики, дольше всего блокировавшие цикл событий"""
+    lines = [
+        "🐢 Цикл событий",
+        f"• {format_loop_lag()}",
+        f"• Порог блокировки {loop_watchdog.threshold * 1000:.0f} мс, пробы стека раз в {loop_watchdog.sample_interval * 1000:.0f} мс",
+    ]
+    if not offenders:
+        lines.append("\n✅ Блокировок дольше порога не было.")
+        return "\n".join(lines)
+    
+    lines.append("\n🔥 Блокирующие обработчики:")
+    for position, (handler, offender) in enumerate(offenders, 1):
+        lines.append(
+            f"{position}. {handler} — {offender.stalls} раз, всего {offender.blocked:.2f} с, "
+            f"максимум {offender.longest:.2f} с"
+        )
+        for site, count in offender.sites.most_common(3):
+            lines.append(f"   • {site} ({count} проб)")
+    
+    handler, offender = offenders[0]
+    if offender.stack:
+        lines.append(f"\n📍 Стек самой долгой блокировки в {handler}:")
+        lines.extend(f"   {site}" for site in offender.stack)
+    return "\n".join(lines)
+
+@timed(HANDLER_SECONDS, "lag")
+async def lag_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /lag [reset] (только для администраторов)"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    if context.args and context.args[0] == "reset":
+        loop_watchdog.reset()
+        await update.message.reply_text("🧹 Статистика блокировок цикла событий сброшена.")
+        return
+    
+    await send_long_message(update, format_lag_report(loop_watchdog.top()), "plain")
+
+@timed(HANDLER_SECONDS, "usage")
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /usage [user_id] (только для администраторов)"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    try:
+        if context.args:
+            user_id = int(context.args[0])
+            totals, first_day = await usage_ledger.totals(user_id)
+            if not totals.requests:
+                await update.message.reply_text(f"👤 Пользователь {user_id} еще не обращался к нейросети.")
+                return
             await update.message.reply_text(
-                f"❌ Вы исчерпали лимит сообщений на сегодня ({count}/{config['max_messages_per_day']}). "
-                f"Лимит сбросится в 00:00 по UTC."
+                f"👤 Пользователь {user_id}: с {first_day} {totals.requests} запросов, {totals.tokens} токенов "
+                f"(запрос {totals.prompt_tokens}, ответ {totals.completion_tokens})"
             )
             return
         
-        # Сохраняем сообщение в историю
-        add_message_to_history(user_id, user_message, "text")
+        hourly, top_users = await usage_ledger.report()
+        await send_long_message(update, format_usage_report(hourly, top_users), "plain")
         
-        # Показываем статус "печатает..."
-        await update.message.chat.send_action(action="typing")
-        
-        # Отправляем запрос к OpenRouter
-        response = await generate_ai_response(user_message, user_id)
-        
-        # Сохраняем ответ в историю
+    except ValueError:
+        await update.message.reply_text("Использование: /usage [id пользователя]")
+    except Exception as e:
+        logger.error(f"Ошибка при получении отчета об использовании: {e}")
+        await update.message.reply_text("⚠️ Не удалось получить отчет об использовании.")
+
+@timed(HANDLER_SECONDS, "reload")
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reload: перечитывает config.json (только для администраторов)"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    try:
+        applied, pending = config.reload()
+    except ConfigError as e:
+        await update.message.reply_text(f"⚠️ Конфиг не применен, исправьте ошибки:\n{e}")
+        return
+    
+    lines = [f"✅ Применено: {', '.join(sorted(applied))}" if applied else "ℹ️ Изменений нет"]
+    if pending:
+        lines.append(f"🔁 После перезапуска: {', '.join(sorted(pending))}")
+    if config["workers"] > 1:
+        lines.append("Остальные процессы подхватят файл при следующей проверке.")
+    await update.message.reply_text("\n".join(lines))
+
+async def answer_text_message(update: Update, user_id: int, user_message: str):
+    """Ответ на текстовое сообщение (выполняется в очереди пользователя)"""
+    # Проверяем лимит
+    limit = check_user_limit(user_id)
+    if not limit.allowed:
+        await update.message.reply_text(limit_exceeded_text(limit))
+        return
+    
+    # Сохраняем сообщение в историю
+    add_message_to_history(user_id, user_message, "text")
+    
+    if config["stream_responses"]:
+        # Ответ появляется в чате по мере генерации
+        response = await stream_ai_response(update, user_message, user_id)
         add_message_to_history(user_id, response, "bot_response")
+        return
+    
+    # Показываем статус "печатает..."
+    await update.message.chat.send_action(action="typing")
+    
+    # Отправляем запрос к OpenRouter
+    response = await generate_ai_response(user_message, user_id)
+    
+    # Сохраняем ответ в историю
+    add_message_to_history(user_id, response, "bot_response")
+    
+    # Отправляем ответ пользователю (с разбивкой если нужно)
+    await send_long_message(update, response)
+
+@timed(HANDLER_SECONDS, "text")
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений"""
+    try:
+        user_id = update.message.from_user.id
         
-        # Отправляем ответ пользователю (с разбивкой если нужно)
-        await send_long_message(update, response)
+        # Фрагменты одной серии объединяются в один запрос к нейросети
+        user_message = await dispatcher.collect(user_id, update.message.text)
+        if user_message is None:
+            return
+        
+        # Сообщения одного пользователя обрабатываются по очереди
+        async with dispatcher.serialize(user_id):
+            await answer_text_message(update, user_id, user_message)
         
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
@@ -658,35 +1452,105 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update and update.message:
         await update.message.reply_text("⚠️ Произошла непредвиденная ошибка.")
 
-async def daily_reset_job(context: CallbackContext):
-    """Задача для ежедневного сброса лимитов"""
-    await reset_daily_limits(context)
+async def history_cache_job(context: CallbackContext):
+    """Задача для вытеснения неактивных окон из кэша истории"""
+    evicted = history_cache.evict_idle()
+    if evicted:
+        logger.info(f"Кэш истории: вытеснено {evicted} окон, статистика {history_cache.stats()}")
 
-def main():
-    print("🤖 Запуск Telegram AI бота...")
-    
-    # Проверяем обязательные параметры
-    if config["telegram_bot_token"] == "YOUR_TELEGRAM_BOT_TOKEN":
-        print("❌ Ошибка: Установите telegram_bot_token в config.json")
-        return
-        
-    if config["openrouter_api_key"] == "YOUR_OPENROUTER_API_KEY":
-        print("❌ Ошибка: Установите openrouter_api_key в config.json")
+async def maintenance_job(context: CallbackContext):
+    """Ежедневное обслуживание базы"""
+    try:
+        report = await retention_job.run()
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания базы: {e}")
         return
-    
-    # Инициализация базы данных
-    init_database()
-    print("✅ База данных инициализирована")
+    if report:
+        # Окна кэша могли содержать удаленные из базы сообщения
+        for user_id in report.users:
+            history_cache.invalidate(user_id)
 
-    # Создаем приложение
-    application = Application.builder().token(config["telegram_bot_token"]).build()
+def format_retention_report(report) -> str:
+    """Строка /metrics о последнем обслуживании базы"""
+    if report is None:
+        return "еще не выполнялось"
+    return (
+        f"в архив {report.archived} сообщений, счетчиков удалено {report.limits_deleted}, "
+        f"освобождено {report.reclaimed / 1024 / 1024:.1f} МБ за {report.seconds:.1f} с"
+    )
+
+async def on_startup(application: Application):
+    """Запуск фоновых задач после инициализации бота"""
+    global metrics_server
+    queue_depth_sources["updates"] = application.update_queue.qsize
+    if config["loop_watchdog_enabled"]:
+        loop_watchdog.start()
+    if config["metrics_port"]:
+        # Каждый процесс-обработчик отдает метрики на своем порту
+        metrics_server = MetricsServer(host=config["metrics_host"], port=config["metrics_port"] + worker_index)
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {e}")
+            metrics_server = None
+    config.start_watching(config["config_watch_interval"])
+    await rate_limiter.load()
+    rate_limiter.start()
+    history_writer.start()
+    await usage_ledger.load()
+    usage_ledger.start()
+    if config["response_cache_enabled"]:
+        await response_cache.load()
+        response_cache.start()
+
+async def on_shutdown(application: Application):
+    """Освобождение ресурсов при остановке бота"""
+    await config.stop_watching()
+    # Дожидаемся начатых сжатий истории, пока клиент нейросети еще открыт
+    await summarizer.stop()
+    await ai_client.close()
+    # Дописываем очередь истории до закрытия базы
+    await history_writer.stop()
+    await usage_ledger.stop()
+    await rate_limiter.stop()
+    if config["response_cache_enabled"]:
+        await response_cache.stop()
+    image_pipeline.close()
+    document_pipeline.close()
+    await storage.close()
+    logger.info(f"Планировщик отправки: {send_scheduler.stats()}")
+    if metrics_server:
+        await metrics_server.stop()
+    await loop_watchdog.stop()
+
+def build_application(with_updater=True, request=None) -> Application:
+    """Создание приложения с обработчиками (request подменяет сетевой слой Bot API в бенчмарках)"""
+    # Обновления обрабатываются параллельно, иначе один долгий запрос к нейросети
+    # задерживает ответы всем остальным пользователям; контроль допуска еще и
+    # разводит их по полосам, чтобы команды не стояли за запросами к нейросети
+    builder = (
+        Application.builder()
+        .token(config["telegram_bot_token"])
+        .concurrent_updates(admission if config["admission_enabled"] else config["max_concurrent_updates"])
+        .rate_limiter(send_scheduler)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not with_updater:
+        # Обновления приходят от основного процесса, а не из getUpdates
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
-    # Добавляем задачу для ежедневного сброса лимитов
+    # Дневные лимиты сбрасываются лениво при первом сообщении за день,
+    # поэтому в планировщике остается только обслуживание кэша и базы
     job_queue = application.job_queue
     if job_queue:
-        # Сбрасываем каждый день в полночь по UTC
-        job_queue.run_daily(daily_reset_job, time=datetime.strptime("00:00", "%H:%M").time())
-        print("✅ Планировщик лимитов настроен")
+        job_queue.run_repeating(history_cache_job, interval=60)
+        if config["state_backend"] == "sqlite" and worker_index == 0:
+            # Общий файл базы обслуживает только первый процесс-обработчик
+            job_queue.run_daily(maintenance_job, time=dt_time(hour=config["retention_hour"], tzinfo=timezone.utc))
 
     # Регистрируем обработчики команд
     application.add_handler(CommandHandler("start", start_command))
@@ -694,18 +1558,98 @@ def main():
     application.add_handler(CommandHandler("about", about_command))
     application.add_handler(CommandHandler("history", history_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("usage", usage_command))
+    application.add_handler(CommandHandler("lag", lag_command))
+    application.add_handler(CommandHandler("reload", reload_command))
 
     # Регистрируем обработчики сообщений
-    application.add_handler(MessageHandler(filters.PHOTO, process_image_message))
-    application.add_handler(MessageHandler(filters.Document.ALL, process_document_message))
+    # Изображения и файлы одного пользователя тоже обрабатываются по очереди
+    application.add_handler(MessageHandler(filters.PHOTO, dispatcher.serialized(process_image_message)))
+    application.add_handler(MessageHandler(filters.Document.ALL, dispatcher.serialized(process_document_message)))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
 
     # Регистрируем обработчик ошибок
     application.add_error_handler(error_handler)
+    return application
+
+def run_worker(index, updates):
+    """Точка входа процесса-обработчика при workers > 1"""
+    from sharding import serve_worker
+
+    global worker_index
+    worker_index = index
+    init_database()
+    logger.info(f"Процесс-обработчик {index} запущен")
+    asyncio.run(serve_worker(build_application(with_updater=False), updates))
+
+def create_webhook_server(application, dispatch=None):
+    """Webhook-сервер по настройкам из конфига"""
+    # aiohttp нужен только в режиме webhook
+    from webhook_server import WebhookServer
+
+    return WebhookServer(
+        application,
+        host=config["webhook_listen"],
+        port=config["webhook_port"],
+        path=config["webhook_path"],
+        secret_token=config["webhook_secret_token"],
+        drain_timeout=config["webhook_drain_timeout"],
+        dispatch=dispatch
+    )
+
+def main():
+    print("🤖 Запуск Telegram AI бота...")
+    
+    # Проверяем обязательные параметры
+    if config["telegram_bot_token"] == "YOUR_TELEGRAM_BOT_TOKEN":
+        print("❌ Ошибка: Установите telegram_bot_token в config.json")
+        return
+        
+    if config["openrouter_api_key"] == "YOUR_OPENROUTER_API_KEY":
+        print("❌ Ошибка: Установите openrouter_api_key в config.json")
+        return
+    
+    # Полный VACUUM старой базы, пока ни один процесс в нее не пишет
+    upgrade_database()
+    
+    if config["workers"] > 1:
+        # Основной процесс только принимает обновления и раздает их процессам
+        # по id пользователя, база открывается в каждом процессе отдельно
+        from telegram import Bot
+        from sharding import WorkerPool, serve_sharded
+
+        pool = WorkerPool(run_worker, config["workers"])
+        server = create_webhook_server(None, dispatch=pool.dispatch) if config["mode"] == "webhook" else None
+        print(f"✅ Бот запущен: {config['workers']} процессов-обработчиков, хранилище {config['state_backend']}")
+        asyncio.run(serve_sharded(
+            pool,
+            Bot(config["telegram_bot_token"]),
+            server=server,
+            webhook_url=config["webhook_url"],
+            drain_timeout=config["webhook_drain_timeout"]
+        ))
+        return
+
+    # Инициализация базы данных
+    init_database()
+    print("✅ База данных инициализирована")
+
+    # Создаем приложение
+    application = build_application()
+    if application.job_queue:
+        print("✅ Планировщик настроен")
 
     print("✅ Бот запущен и готов к работе!")
     print(f"📊 Конфигурация: {config}")
-    application.run_polling()
+    
+    if config["mode"] == "webhook":
+        from webhook_server import serve_webhook
+
+        server = create_webhook_server(application)
+        asyncio.run(serve_webhook(application, server, config["webhook_url"]))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
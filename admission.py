@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Mapping
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = registry.counter(
+    "bot_admission_total", "Решения контроля допуска обновлений", ["lane", "result"]
+)
+ADMISSION_WAIT = registry.histogram(
+    "bot_admission_wait_seconds", "Ожидание обновления в очереди полосы", ["lane"]
+)
+
+# Полосы: команды без нейросети, текстовые запросы, изображения и документы
+LANES = ("commands", "text", "media")
+LANE_PARAMS = ("concurrency", "queue", "deadline")
+
+# Сглаживание среднего времени обработки для прогноза ожидания
+SERVICE_TIME_ALPHA = 0.1
+
+
+def _close(coroutine):
+    # Обработчик так и не запустится: закрываем корутину без предупреждения
+    close = getattr(coroutine, "close", None)
+    if close is not None:
+        close()
+
+
+def lane_of(update):
+    """Полоса обновления: медиа, текст или дешевые команды и все остальное"""
+    message = getattr(update, "message", None)
+    if message is None:
+        return "commands"
+    if message.photo or message.document:
+        return "media"
+    if message.text and not message.text.startswith("/"):
+        return "text"
+    return "commands"
+
+
+def lanes_error(lanes):
+    """Описание ошибки в admission_lanes или None"""
+    if not isinstance(lanes, Mapping) or set(lanes) != set(LANES):
+        return f"ожидался объект с полосами {', '.join(LANES)}"
+    for name, params in lanes.items():
+        if not isinstance(params, Mapping) or set(params) != set(LANE_PARAMS):
+            return f"полоса {name}: ожидались поля {', '.join(LANE_PARAMS)}"
+        for key, value in params.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                return f"полоса {name}: {key} должно быть неотрицательным числом"
+        if not isinstance(params["concurrency"], int) or not isinstance(params["queue"], int):
+            return f"полоса {name}: concurrency и queue должны быть целыми"
+        if params["concurrency"] < 1 or params["deadline"] <= 0:
+            return f"полоса {name}: concurrency и deadline должны быть положительными"
+    return None
+
+
+class Overloaded(Exception):
+    """Обновление не допущено: очередь полосы полна или ожидание дольше срока"""
+
+    def __init__(self, lane, reason):
+        super().__init__(f"{lane}: {reason}")
+        self.lane = lane
+        self.reason = reason  # "queue", "predicted", "deadline" или "user"
+
+
+class Lane:
+    """Полоса допуска: concurrency обработчиков одновременно и очередь до queue.
+
+    Обновление ждет свободного места не дольше deadline секунд. Если по
+    среднему времени обработки ожидание заведомо больше срока, отказ
+    приходит сразу, не занимая очередь. Приоритетные обновления
+    (администраторы) встают перед остальными и не отклоняются.
+    """
+
+    def __init__(self, name, concurrency, queue, deadline):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.deadline = deadline
+        self.active = 0
+        self.service_time = 0.0
+        self._urgent = deque()
+        self._waiting = deque()
+
+    @property
+    def queued(self):
+        return len(self._urgent) + len(self._waiting)
+
+    def expected_wait(self):
+        """Прогноз ожидания нового обновления в очереди"""
+        return (self.queued // self.concurrency + 1) * self.service_time
+
+    async def acquire(self, priority=False):
+        """Ждет места в полосе, возвращает время ожидания или бросает Overloaded"""
+        if self.active < self.concurrency and not self.queued:
+            self.active += 1
+            return 0.0
+        if not priority:
+            if len(self._waiting) >= self.queue_size:
+                raise Overloaded(self.name, "queue")
+            if self.expected_wait() > self.deadline:
+                raise Overloaded(self.name, "predicted")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        queue = self._urgent if priority else self._waiting
+        queue.append(waiter)
+        timer = None if priority else loop.call_later(self.deadline, self._expire, waiter)
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # Место уже передано, но обработчик отменили — отдаем его следующему
+                self.release()
+            elif waiter in queue:
+                queue.remove(waiter)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return time.monotonic() - started
+
+    def release(self, service_time=None):
+        """Освобождает место; оно сразу переходит к следующему в очереди"""
+        if service_time is not None:
+            if self.service_time:
+                self.service_time += SERVICE_TIME_ALPHA * (service_time - self.service_time)
+            else:
+                self.service_time = service_time
+        for queue in (self._urgent, self._waiting):
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            self._waiting.remove(waiter)
+            waiter.set_exception(Overloaded(self.name, "deadline"))
+
+
+class AdmissionController(BaseUpdateProcessor):
+    """Контроль допуска обновлений перед обработчиками приложения.
+
+    Подключается через Application.builder().concurrent_updates(...). Каждое
+    обновление попадает в свою полосу (lane_of), и медленные запросы к
+    нейросети не задерживают /help и /stats. Отклоненное обновление сразу
+    освобождает место, а on_reject(update, error) отвечает пользователю в
+    отдельной задаче не чаще раза в busy_reply_interval секунд. Общий лимит
+    PTB равен сумме мест и очередей полос плюс spare для обновлений
+    администраторов сверх очереди, поэтому обновления не копятся до полос.
+    Обработчики одного пользователя все равно идут по очереди (ChatDispatcher),
+    поэтому в каждой полосе у пользователя не больше per_user обновлений,
+    работающих и ждущих вместе: его очередь не занимает места других.
+    """
+
+    def __init__(self, lanes, is_priority=None, on_reject=None, busy_reply_interval=10.0,
+                 spare=64, classify=lane_of, max_reply_chats=10000, per_user=3):
+        self.lanes = {name: Lane(name, **params) for name, params in lanes.items()}
+        super().__init__(sum(lane.concurrency + lane.queue_size for lane in self.lanes.values()) + spare)
+        self.is_priority = is_priority
+        self.on_reject = on_reject
+        self.busy_reply_interval = busy_reply_interval
+        self.classify = classify
+        self.max_reply_chats = max_reply_chats
+        self.per_user = per_user
+        self._users = {}
+        self._replied = {}
+        self._replies = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        tasks = list(self._replies.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        """{полоса: (занято мест, в очереди, среднее время обработки)}"""
+        return {name: (lane.active, lane.queued, lane.service_time) for name, lane in self.lanes.items()}
+
+    async def do_process_update(self, update, coroutine):
+        lane = self.lanes[self.classify(update)]
+        priority = self.is_priority is not None and self.is_priority(update)
+        user = getattr(update, "effective_user", None)
+        key = None if user is None or priority else (lane.name, user.id)
+        if key is not None and self._users.get(key, 0) >= self.per_user:
+            _close(coroutine)
+            ADMISSION.labels(lane.name, "user").inc()
+            self._reject(update, Overloaded(lane.name, "user"))
+            return
+        if key is not None:
+            self._users[key] = self._users.get(key, 0) + 1
+        try:
+            try:
+                waited = await lane.acquire(priority)
+            except Overloaded as e:
+                _close(coroutine)
+                ADMISSION.labels(lane.name, e.reason).inc()
+                self._reject(update, e)
+                return
+            except asyncio.CancelledError:
+                _close(coroutine)
+                raise
+            ADMISSION.labels(lane.name, "admitted").inc()
+            ADMISSION_WAIT.labels(lane.name).observe(waited)
+            started = time.monotonic()
+            try:
+                await coroutine
+            finally:
+                lane.release(time.monotonic() - started)
+        finally:
+            if key is not None:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+
+    def _reject(self, update, error):
+        chat = getattr(update, "effective_chat", None)
+        if self.on_reject is None or chat is None or chat.id in self._replies:
+            return
+        now = time.monotonic()
+        if now - self._replied.get(chat.id, float("-inf")) < self.busy_reply_interval:
+            return
+        if len(self._replied) >= self.max_reply_chats:
+            self._replied = {
+                chat_id: at for chat_id, at in self._replied.items() if now - at < self.busy_reply_interval
+            }
+        self._replied[chat.id] = now
+        # Ответ может ждать в очереди отправки, а место обновления уже свободно
+        self._replies[chat.id] = asyncio.create_task(self._reply(chat.id, update, error))
+
+    async def _reply(self, chat_id, update, error):
+        try:
+            await self.on_reject(update, error)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить об отказе в допуске: {e}")
+        finally:
+            del self._replies[chat_id]
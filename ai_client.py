@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import time
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from metrics import registry
+from resilience import OPEN, RETRIES, CircuitBreaker, CircuitOpenError, RetryPolicy, failure_reason
+
+logger = logging.getLogger(__name__)
+
+LLM_SECONDS = registry.histogram(
+    "bot_llm_request_seconds", "Длительность запросов к нейросети", ["model", "outcome"]
+)
+LLM_FIRST_TOKEN_SECONDS = registry.histogram(
+    "bot_llm_first_token_seconds", "Время до первого фрагмента потокового ответа", ["model"]
+)
+LLM_TOKENS = registry.counter("bot_llm_tokens_total", "Токены по данным API", ["model", "kind"])
+
+
+def record_usage(model, usage):
+    """Учитывает расход токенов из ответа API"""
+    if usage:
+        LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+        LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# Заголовки, которые OpenRouter использует для атрибуции приложения
+EXTRA_HEADERS = {
+    "HTTP-Referer": "https://github.com/your-username/telegram-ai-bot",
+    "X-Title": "Telegram AI Bot"
+}
+
+
+class AIClient:
+    """Асинхронный клиент OpenRouter с пулом keep-alive соединений.
+
+    Все запросы идут через один httpx-пул, а семафор ограничивает число
+    одновременных запросов к API, чтобы всплеск сообщений не открыл
+    сотни соединений разом. Временные сбои (таймауты, 429, 5xx) повторяются
+    по retry_policy, каждая попытка ограничена своим сроком, а у каждой
+    модели есть автоматический выключатель, который при недоступности API
+    сразу отклоняет запросы.
+    """
+
+    def __init__(self, api_key, base_url=OPENROUTER_BASE_URL, max_concurrent_requests=16,
+                 request_timeout=60.0, connect_timeout=10.0, pool_size=32, keepalive_expiry=30.0,
+                 retry_policy=None, failure_threshold=5, reset_timeout=30.0,
+                 failure_ratio=0.5, window_size=50):
+        self.request_timeout = request_timeout
+        self.max_concurrent_requests = max_concurrent_requests
+        self.in_flight = 0
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self.window_size = window_size
+        self.breakers = {}
+
+        timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+        self._http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=timeout
+        )
+        # Повторы выполняет сам клиент, встроенные повторы SDK отключены
+        self._client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=self._http_client,
+            timeout=timeout,
+            max_retries=0
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    def breaker(self, model):
+        """Выключатель модели, создается при первом запросе"""
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(
+                model, failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout,
+                failure_ratio=self.failure_ratio, window_size=self.window_size
+            )
+        return breaker
+
+    def configure_breakers(self, failure_threshold, reset_timeout, failure_ratio, window_size):
+        """Новые пороги выключателей, в том числе уже созданных"""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self.window_size = window_size
+        for breaker in self.breakers.values():
+            breaker.configure(failure_threshold, reset_timeout, failure_ratio, window_size)
+
+    def available(self, model):
+        """Примет ли выключатель модели запрос прямо сейчас"""
+        breaker = self.breakers.get(model)
+        return breaker is None or breaker.state != OPEN or breaker.retry_in() == 0
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def _retrying(self, model, attempt_func, keep_slot=False):
+        """Выполняет попытки attempt_func с повторами временных сбоев.
+
+        Каждая попытка занимает место в семафоре, на время паузы между
+        попытками оно освобождается. С keep_slot место после успеха
+        остается занятым, и его освобождает вызывающий через _release_slot.
+        """
+        breaker = self.breaker(model)
+        attempt = 0
+        while True:
+            # Разомкнутый выключатель отклоняет запрос, не дожидаясь семафора
+            breaker.check()
+            await self._semaphore.acquire()
+            self.in_flight += 1
+            try:
+                breaker.before_call()
+                result = await attempt_func()
+            except CircuitOpenError:
+                # Пробный запрос уже выполняется другим обработчиком
+                self._release_slot()
+                raise
+            except asyncio.CancelledError:
+                self._release_slot()
+                breaker.release()
+                raise
+            except Exception as e:
+                self._release_slot()
+                reason = failure_reason(e)
+                if reason is None:
+                    breaker.release()
+                    raise
+                breaker.record_failure()
+                delay = self.retry_policy.delay(attempt, e)
+                if delay is None or breaker.state == OPEN:
+                    raise
+                attempt += 1
+                RETRIES.labels(model, reason).inc()
+                logger.warning(f"Сбой запроса к {model} ({reason}), повтор {attempt} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            if not keep_slot:
+                self._release_slot()
+            breaker.record_success()
+            return result
+
+    async def complete(self, messages, model, max_tokens=1000, temperature=0.7, timeout=None):
+        """Запрос к chat completions, возвращает объект ответа целиком"""
+        timeout = timeout or self.request_timeout
+
+        async def attempt():
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                # Срок на всю попытку: таймаут httpx ограничивает только паузы между байтами
+                completion = await asyncio.wait_for(
+                    self._client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        extra_headers=EXTRA_HEADERS,
+                        timeout=timeout
+                    ),
+                    timeout
+                )
+                outcome = "ok"
+                record_usage(model, completion.usage)
+                return completion
+            finally:
+                LLM_SECONDS.labels(model, outcome).observe(time.perf_counter() - started)
+
+        return await self._retrying(model, attempt)
+
+    async def stream(self, messages, model, max_tokens=1000, temperature=0.7, timeout=None, on_usage=None):
+        """Потоковый запрос, отдает фрагменты текста по мере генерации.
+
+        Повторяется только открытие потока: после первого фрагмента ошибка
+        передается вызывающему. Если очередной фрагмент не пришел за timeout
+        секунд, поток считается зависшим. on_usage(model, usage) вызывается
+        с расходом токенов из последнего фрагмента.
+        """
+        timeout = timeout or self.request_timeout
+        breaker = self.breaker(model)
+        started = time.perf_counter()
+
+        async def open_stream():
+            stream = await asyncio.wait_for(
+                self._client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    extra_headers=EXTRA_HEADERS,
+                    timeout=timeout,
+                    stream=True,
+                    # Расход токенов приходит последним фрагментом
+                    stream_options={"include_usage": True}
+                ),
+                timeout
+            )
+            # Первый фрагмент тоже входит в попытку: 200 без данных — тот же сбой
+            chunks = stream.__aiter__()
+            try:
+                first = await asyncio.wait_for(chunks.__anext__(), timeout)
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await stream.close()
+                raise
+            return stream, chunks, first
+
+        stream, chunks, chunk = await self._retrying(model, open_stream, keep_slot=True)
+        first_token = True
+        outcome = "error"
+        try:
+            async with stream:
+                while chunk is not None:
+                    usage = getattr(chunk, "usage", None)
+                    record_usage(model, usage)
+                    if usage and on_usage is not None:
+                        on_usage(model, usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token:
+                            first_token = False
+                            LLM_FIRST_TOKEN_SECONDS.labels(model).observe(time.perf_counter() - started)
+                        yield chunk.choices[0].delta.content
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        chunk = None
+            outcome = "ok"
+        except Exception as e:
+            if failure_reason(e) is not None:
+                breaker.record_failure()
+            raise
+        finally:
+            self._release_slot()
+            LLM_SECONDS.labels(model, outcome).observe(time.perf_counter() - started)
+
+    async def close(self):
+        """Закрытие пула соединений"""
+        try:
+            await self._client.close()
+        except Exception as e:
+            logger.error(f"Ошибка закрытия клиента OpenRouter: {e}")
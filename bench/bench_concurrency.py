@@ -0,0 +1,73 @@
+"""Бенчмарк параллельности запросов к OpenRouter.
+
+Сравнивает старый путь (синхронный клиент внутри async-обработчика, запросы
+идут друг за другом) с AIClient на пуле соединений против фейкового сервера.
+Запуск: python bench/bench_concurrency.py --chats 20 --latency 1.0
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAI
+
+from ai_client import AIClient
+from fake_openrouter import start_fake_server
+
+MESSAGES = [{"role": "user", "content": "Привет! Как дела?"}]
+
+
+async def run_blocking(base_url, chats):
+    """Старое поведение: синхронный вызов блокирует event loop"""
+    client = OpenAI(base_url=base_url, api_key="fake")
+
+    async def chat():
+        client.chat.completions.create(model="fake-model", messages=MESSAGES, max_tokens=1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat() for _ in range(chats)))
+    return time.perf_counter() - start
+
+
+async def run_async(base_url, chats, max_concurrent):
+    """Новое поведение: AIClient с пулом и семафором"""
+    client = AIClient(api_key="fake", base_url=base_url, max_concurrent_requests=max_concurrent)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(client.complete(MESSAGES, model="fake-model") for _ in range(chats)))
+        return time.perf_counter() - start
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк параллельных чатов")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--max-concurrent", type=int, default=16)
+    parser.add_argument("--skip-blocking", action="store_true")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(latency=args.latency)
+    try:
+        print(f"Чатов: {args.chats}, задержка апстрима: {args.latency:.2f} с")
+        # Прогрев соединения, чтобы не мерить установку TCP
+        asyncio.run(run_async(base_url, 1, 1))
+
+        if not args.skip_blocking:
+            elapsed = asyncio.run(run_blocking(base_url, args.chats))
+            print(f"Синхронный клиент: {elapsed:.2f} с")
+
+        elapsed = asyncio.run(run_async(base_url, args.chats, args.max_concurrent))
+        waves = -(-args.chats // args.max_concurrent)
+        print(f"AIClient (max_concurrent={args.max_concurrent}): {elapsed:.2f} с "
+              f"(ожидаемо ~{waves * args.latency:.2f} с)")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Бенчмарк отправки длинных ответов при всплеске нагрузки.
+
+Фейковый Bot API отвечает 429, как настоящий, если бот превышает
+~30 сообщений в секунду в сумме или ~1 в секунду (с запасом 3) в одном чате.
+Сравниваются последовательная отправка частей без планирования (как было
+раньше: 429 означает потерянную часть) и SendScheduler.
+Запуск: python bench/bench_send_scheduler.py --chats 60 --parts 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from fake_telegram import FakeTelegramRequest
+from send_scheduler import PRIORITY_FOLLOWUP, SendScheduler, rate_limit_kwargs
+
+GLOBAL_PER_SECOND = 30
+CHAT_PER_SECOND = 1.0
+CHAT_BURST = 3
+
+
+class FloodingTelegramRequest(FakeTelegramRequest):
+    """Фейковый Bot API с лимитами на отправку"""
+
+    def __init__(self, latency=0.02):
+        super().__init__(latency=latency)
+        self.recent = []
+        self.chats = {}
+        self.flood_errors = 0
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            now = time.monotonic()
+            chat_id = request_data.parameters["chat_id"]
+            self.recent = [t for t in self.recent if now - t < 1.0]
+            tokens, updated = self.chats.get(chat_id, (CHAT_BURST, now))
+            tokens = min(CHAT_BURST, tokens + (now - updated) * CHAT_PER_SECOND)
+            if len(self.recent) >= GLOBAL_PER_SECOND or tokens < 1:
+                self.flood_errors += 1
+                body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1}}
+                return 429, json.dumps(body).encode()
+            self.recent.append(now)
+            self.chats[chat_id] = (tokens - 1, now)
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+async def deliver(bot, chat_id, parts, first_part_times, started):
+    """Отправляет ответ частями, как send_long_message"""
+    delivered = 0
+    for i in range(parts):
+        try:
+            if i == 0:
+                await bot.send_message(chat_id, f"Часть {i + 1}")
+                first_part_times.append(time.perf_counter() - started)
+            else:
+                await bot.send_message(chat_id, f"Часть {i + 1}", **rate_limit_kwargs(bot, PRIORITY_FOLLOWUP))
+            delivered += 1
+        except RetryAfter:
+            pass  # Без планировщика часть ответа теряется
+    return delivered
+
+
+async def run(chats, parts, scheduler):
+    request = FloodingTelegramRequest()
+    bot = ExtBot("123456:FAKE", request=request, rate_limiter=scheduler)
+    first_part_times = []
+    async with bot:
+        started = time.perf_counter()
+        delivered = await asyncio.gather(*(
+            deliver(bot, chat_id, parts, first_part_times, started) for chat_id in range(1, chats + 1)
+        ))
+        elapsed = time.perf_counter() - started
+        stats = scheduler.stats() if scheduler else {}
+    return {
+        "delivered": sum(delivered),
+        "flood_errors": request.flood_errors,
+        "elapsed": elapsed,
+        "first_p50": statistics.median(first_part_times) if first_part_times else 0.0,
+        "first_max": max(first_part_times) if first_part_times else 0.0,
+        "stats": stats,
+    }
+
+
+def report(name, result, total):
+    print(f"{name}: доставлено {result['delivered']}/{total}, ответов 429: {result['flood_errors']}, "
+          f"время {result['elapsed']:.2f} с, первая часть p50 {result['first_p50']:.2f} с, "
+          f"max {result['first_max']:.2f} с")
+    if result["stats"]:
+        print(f"  метрики планировщика: {result['stats']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк планировщика отправки")
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--parts", type=int, default=3)
+    args = parser.parse_args()
+    total = args.chats * args.parts
+
+    report("Без планировщика", await run(args.chats, args.parts, None), total)
+    scheduler = SendScheduler(global_rate=GLOBAL_PER_SECOND - 2, chat_rate=CHAT_PER_SECOND, chat_burst=CHAT_BURST)
+    report("SendScheduler", await run(args.chats, args.parts, scheduler), total)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
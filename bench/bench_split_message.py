@@ -0,0 +1,117 @@
+"""Микробенчмарк разбиения длинных ответов на сообщения Telegram.
+
+Генерирует ответы в стиле нейросети (абзацы, списки, Markdown, эмодзи,
+блоки кода) и сравнивает прежний split_long_message с message_splitter:
+время разбиения, число частей и нарушения — части длиннее лимита в
+единицах UTF-16 (Telegram их отклоняет) и части с разорванным блоком кода.
+Запуск: python bench/bench_split_message.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_splitter import split_message, split_text, utf16_len
+
+WORDS = [
+    "нейросеть", "ответ", "данные", "модель", "запрос", "функция", "пример", "результат",
+    "**важно**", "`config.json`", "*например*", "[документация](https://core.telegram.org/bots/api)",
+    "🚀", "✅", "📄", "Telegram", "Python",
+]
+
+
+def legacy_split(text, max_length):
+    """split_long_message до перехода на message_splitter"""
+    if len(text) <= max_length:
+        return [text]
+
+    parts = []
+    while text:
+        if len(text) <= max_length:
+            parts.append(text)
+            break
+
+        split_index = text.rfind('\n', 0, max_length)
+        if split_index == -1:
+            split_index = text.rfind('. ', 0, max_length)
+        if split_index == -1:
+            split_index = text.rfind(' ', 0, max_length)
+        if split_index == -1:
+            split_index = max_length
+
+        parts.append(text[:split_index].strip())
+        text = text[split_index:].strip()
+
+    return parts
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 20))]
+    return " ".join(words).capitalize() + "."
+
+
+def llm_answer(size, seed=0):
+    """Текст примерно из size символов, похожий на ответ нейросети"""
+    rng = random.Random(seed)
+    blocks = []
+    total = 0
+    while total < size:
+        kind = rng.random()
+        if kind < 0.1:
+            block = f"## {sentence(rng)}"
+        elif kind < 0.3:
+            block = "\n".join(f"- {sentence(rng)}" for _ in range(rng.randint(2, 6)))
+        elif kind < 0.45:
+            lines = [f"    result = compute({i})  # шаг {i} 🚀" for i in range(rng.randint(5, 300))]
+            block = "```python\ndef main():\n" + "\n".join(lines) + "\n```"
+        else:
+            block = " ".join(sentence(rng) for _ in range(rng.randint(2, 8)))
+        blocks.append(block)
+        total += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def violations(parts, max_length):
+    """(частей длиннее лимита в UTF-16, частей с непарными оградами кода)"""
+    too_long = sum(1 for part in parts if utf16_len(part) > max_length)
+    broken = sum(1 for part in parts if part.count("```") % 2)
+    return too_long, broken
+
+
+def measure(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбиения сообщений")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--max-length", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        text = llm_answer(size)
+        print(f"Ответ {len(text)} символов, {utf16_len(text)} единиц UTF-16:")
+        cases = [
+            ("прежний", lambda: legacy_split(text, args.max_length)),
+            ("новый", lambda: list(split_text(text, args.max_length))),
+            ("новый + HTML", lambda: [part for _, part in split_message(text, args.max_length, "html")]),
+            ("новый + MarkdownV2", lambda: [part for _, part in split_message(text, args.max_length, "markdownv2")]),
+        ]
+        for name, func in cases:
+            elapsed, parts = measure(func, args.repeat)
+            too_long, broken = violations(parts, args.max_length)
+            print(f"  {name:<20} {elapsed * 1000:9.2f} мс  частей {len(parts):4}  "
+                  f"длиннее лимита {too_long:3}  разорванных блоков кода {broken:3}")
+
+
+if __name__ == "__main__":
+    main()
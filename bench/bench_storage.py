@@ -0,0 +1,137 @@
+"""Бенчмарк задержки базы данных на одно сообщение.
+
+Заполняет message_history заданным числом строк и сравнивает старую схему
+работы (новое соединение на каждый вызов, без индекса) со Storage.
+Запуск: python bench/bench_storage.py --rows 1000000 --messages 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_writer import utc_timestamp
+from storage import MIGRATIONS, Storage
+
+MEMORY_SIZE = 10
+
+
+def populate(path, rows, users):
+    """Создает базу со старой схемой и rows строками истории"""
+    conn = sqlite3.connect(path)
+    for statement in MIGRATIONS[1]:
+        conn.execute(statement)
+    batch = []
+    for i in range(rows):
+        batch.append((random.randrange(users), f"Сообщение номер {i}", "text"))
+        if len(batch) >= 50000:
+            conn.executemany(
+                "INSERT INTO message_history (user_id, message_text, message_type) VALUES (?, ?, ?)", batch
+            )
+            batch.clear()
+    if batch:
+        conn.executemany(
+            "INSERT INTO message_history (user_id, message_text, message_type) VALUES (?, ?, ?)", batch
+        )
+    conn.commit()
+    conn.close()
+
+
+def legacy_message(path, user_id):
+    """Запросы одного сообщения в старом стиле: соединение на каждый вызов"""
+    conn = sqlite3.connect(path)
+    conn.execute("SELECT message_count, last_reset_date FROM user_limits WHERE user_id = ?", (user_id,))
+    conn.close()
+
+    for message_type in ("text", "bot_response"):
+        conn = sqlite3.connect(path)
+        conn.execute('''
+        DELETE FROM message_history
+        WHERE user_id = ? AND id NOT IN (
+            SELECT id FROM message_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
+        )''', (user_id, user_id, MEMORY_SIZE))
+        conn.execute(
+            "INSERT INTO message_history (user_id, message_text, message_type) VALUES (?, ?, ?)",
+            (user_id, "новое сообщение", message_type)
+        )
+        conn.commit()
+        conn.close()
+
+        if message_type == "text":
+            conn = sqlite3.connect(path)
+            conn.execute(
+                "SELECT message_text, message_type, timestamp FROM message_history "
+                "WHERE user_id = ? ORDER BY timestamp DESC LIMIT 5", (user_id,)
+            ).fetchall()
+            conn.close()
+
+
+async def storage_message(storage, user_id):
+    """Те же запросы через Storage: обе записи обмена уходят одной пачкой"""
+    await storage.get_limits(user_id)
+    await storage.get_history(user_id, 5)
+    timestamp = utc_timestamp()
+    await storage.insert_messages([
+        (user_id, "новое сообщение", "text", timestamp),
+        (user_id, "новое сообщение", "bot_response", timestamp),
+    ])
+    await storage.prune_history([user_id], MEMORY_SIZE)
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name}: среднее {statistics.mean(samples) * 1000:.2f} мс, "
+          f"p50 {statistics.median(samples) * 1000:.2f} мс, p95 {p95 * 1000:.2f} мс")
+
+
+async def run_storage(path, messages, users):
+    storage = Storage(path)
+    start = time.perf_counter()
+    storage.open()
+    print(f"Открытие и миграция: {time.perf_counter() - start:.2f} с")
+    samples = []
+    try:
+        for _ in range(messages):
+            user_id = random.randrange(users)
+            start = time.perf_counter()
+            await storage_message(storage, user_id)
+            samples.append(time.perf_counter() - start)
+    finally:
+        await storage.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки SQLite")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--legacy-messages", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        start = time.perf_counter()
+        populate(path, args.rows, args.users)
+        print(f"Заполнено {args.rows} строк за {time.perf_counter() - start:.1f} с")
+
+        samples = []
+        for _ in range(args.legacy_messages):
+            user_id = random.randrange(args.users)
+            start = time.perf_counter()
+            legacy_message(path, user_id)
+            samples.append(time.perf_counter() - start)
+        report("Старый путь (без индекса)", samples)
+
+        report("Storage (WAL + индекс)", asyncio.run(run_storage(path, args.messages, args.users)))
+
+
+if __name__ == "__main__":
+    main()
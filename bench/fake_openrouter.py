@@ -0,0 +1,163 @@
+"""Локальный фейковый сервер OpenRouter для бенчмарков.
+
+Отвечает на POST .../chat/completions в формате OpenAI с заданной задержкой.
+При "stream": true отдает ответ SSE-фрагментами, растягивая задержку на весь поток.
+С failure_rate > 0 такая доля запросов получает 503 после той же задержки,
+как при сбое провайдера.
+Запуск отдельно: python bench/fake_openrouter.py --port 8765 --latency 1.0
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "Это ответ фейкового сервера OpenRouter. " * 5
+
+
+class FakeOpenRouterHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов chat completions"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Не засоряем вывод бенчмарка логами каждого запроса
+        pass
+
+    def handle(self):
+        # Клиент мог бросить запрос по своему сроку, пока сервер "думал"
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.server.requests_total += 1
+
+        if random.random() < self.server.failure_rate:
+            time.sleep(self.server.latency)
+            self.server.failures_total += 1
+            self._error_reply(503, "Provider temporarily unavailable")
+            return
+
+        if body.get("stream"):
+            self._stream_reply(body)
+            return
+
+        time.sleep(self.server.latency)
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", []))
+        reply = self.server.reply
+        payload = json.dumps({
+            "id": f"chatcmpl-fake-{self.server.requests_total}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(reply) // 4,
+                "total_tokens": prompt_tokens + len(reply) // 4
+            }
+        }).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _error_reply(self, status, message):
+        payload = json.dumps({"error": {"code": status, "message": message}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream_reply(self, body):
+        """Отправляет ответ в виде SSE-потока с chunked-кодированием"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        words = self.server.reply.split(" ")
+        delay = self.server.latency / max(len(words), 1)
+        for i, word in enumerate(words):
+            time.sleep(delay)
+            chunk = {
+                "id": f"chatcmpl-fake-{self.server.requests_total}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "fake-model"),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": word if i == 0 else " " + word},
+                    "finish_reason": None
+                }]
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        if body.get("stream_options", {}).get("include_usage"):
+            # Как у OpenAI: расход токенов отдельным фрагментом без choices
+            prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", []))
+            completion_tokens = len(self.server.reply) // 4
+            chunk = {
+                "id": f"chatcmpl-fake-{self.server.requests_total}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "fake-model"),
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_fake_server(port=0, latency=1.0, reply=DEFAULT_REPLY, failure_rate=0.0):
+    """Запускает сервер в фоновом потоке, возвращает (server, base_url).
+
+    latency и failure_rate можно менять на ходу через атрибуты server.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenRouterHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.reply = reply
+    server.failure_rate = failure_rate
+    server.requests_total = 0
+    server.failures_total = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый OpenRouter")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(args.port, args.latency, failure_rate=args.failure_rate)
+    print(f"Фейковый OpenRouter слушает {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
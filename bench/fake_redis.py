@@ -0,0 +1,353 @@
+"""Минимальный Redis-совместимый сервер в памяти для локальных проверок.
+
+Понимает протокол RESP2 и подмножество команд, которые использует бот
+(строки, списки, хеши, sorted set, MULTI/EXEC/WATCH), так что RedisStorage
+можно проверить настоящим клиентом redis без установленного Redis.
+"""
+import asyncio
+import fnmatch
+
+
+class _Error(Exception):
+    pass
+
+
+def _score(value, exclusive_default=False):
+    value = value.decode() if isinstance(value, bytes) else value
+    if value in ("-inf", "+inf", "inf"):
+        return float(value.replace("inf", "inf")), False
+    if value.startswith("("):
+        return float(value[1:]), True
+    return float(value), exclusive_default
+
+
+class FakeRedis:
+    """Данные и выполнение команд"""
+
+    def __init__(self):
+        self.data = {}
+        self.versions = {}
+        self.commands = 0
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _get(self, key, kind):
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise _Error("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def execute(self, args):
+        self.commands += 1
+        name = args[0].decode().upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise _Error(f"ERR unknown command '{name}'")
+        return handler(*args[1:])
+
+    # Служебные команды
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_client(self, *args):
+        return "OK"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_flushdb(self, *args):
+        for key in list(self.data):
+            self._touch(key)
+        self.data.clear()
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                removed += 1
+                self._touch(key)
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    def cmd_keys(self, pattern):
+        return [key for key in self.data if fnmatch.fnmatchcase(key.decode(), pattern.decode())]
+
+    # Строки
+    def cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self._touch(key)
+        return "OK"
+
+    def cmd_incrby(self, key, amount):
+        value = int(self._get(key, bytes) or 0) + int(amount)
+        self.data[key] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b"1")
+
+    # Списки
+    def cmd_rpush(self, key, *values):
+        items = self._get(key, list)
+        if items is None:
+            items = self.data[key] = []
+        items.extend(values)
+        self._touch(key)
+        return len(items)
+
+    def cmd_llen(self, key):
+        return len(self._get(key, list) or [])
+
+    @staticmethod
+    def _range(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(0, length + start)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1)
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._get(key, list) or []
+        start, stop = self._range(len(items), start, stop)
+        return items[start:stop + 1]
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key, list)
+        if items is None:
+            return "OK"
+        start, stop = self._range(len(items), start, stop)
+        items[:] = items[start:stop + 1]
+        if not items:
+            del self.data[key]
+        self._touch(key)
+        return "OK"
+
+    # Хеши
+    def cmd_hset(self, key, *pairs):
+        table = self._get(key, dict)
+        if table is None:
+            table = self.data[key] = {}
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in table
+            table[field] = value
+        self._touch(key)
+        return added
+
+    def cmd_hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        table = self._get(key, dict) or {}
+        return [table.get(field) for field in fields]
+
+    def cmd_hgetall(self, key):
+        table = self._get(key, dict) or {}
+        return [item for pair in table.items() for item in pair]
+
+    def cmd_hdel(self, key, *fields):
+        table = self._get(key, dict) or {}
+        removed = sum(1 for field in fields if table.pop(field, None) is not None)
+        if key in self.data and not table:
+            del self.data[key]
+        self._touch(key)
+        return removed
+
+    def cmd_hincrby(self, key, field, amount):
+        table = self._get(key, dict)
+        if table is None:
+            table = self.data[key] = {}
+        value = int(table.get(field, 0)) + int(amount)
+        table[field] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def cmd_hincrbyfloat(self, key, field, amount):
+        table = self._get(key, dict)
+        if table is None:
+            table = self.data[key] = {}
+        value = float(table.get(field, 0)) + float(amount)
+        table[field] = repr(value).encode()
+        self._touch(key)
+        return repr(value).encode()
+
+    def cmd_hsetnx(self, key, field, value):
+        table = self._get(key, dict)
+        if table is None:
+            table = self.data[key] = {}
+        if field in table:
+            return 0
+        table[field] = value
+        self._touch(key)
+        return 1
+
+    def cmd_expire(self, key, seconds, *options):
+        # Срок жизни не отслеживается: проверки живут меньше любого TTL
+        return int(key in self.data)
+
+    # Sorted set (хранится как dict member -> score)
+    def cmd_zadd(self, key, *pairs):
+        zset = self._get(key, _ZSet)
+        if zset is None:
+            zset = self.data[key] = _ZSet()
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in zset
+            zset[member] = float(score)
+        self._touch(key)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self._get(key, _ZSet) or _ZSet()
+        removed = sum(1 for member in members if zset.pop(member, None) is not None)
+        if key in self.data and not zset:
+            del self.data[key]
+        self._touch(key)
+        return removed
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        zset = self._get(key, _ZSet) or _ZSet()
+        low, low_open = _score(low)
+        high, high_open = _score(high)
+        result = []
+        for member, score in sorted(zset.items(), key=lambda item: (item[1], item[0])):
+            if score < low or (low_open and score == low):
+                continue
+            if score > high or (high_open and score == high):
+                continue
+            result.append(member)
+        return result
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, _ZSet) or ())
+
+
+class _ZSet(dict):
+    pass
+
+
+class _Connection:
+    """Состояние одного клиента: транзакция и WATCH"""
+
+    def __init__(self, server):
+        self.server = server
+        self.queue = None
+        self.watched = {}
+
+    def handle(self, args):
+        name = args[0].decode().upper()
+        db = self.server.db
+        if name == "MULTI":
+            self.queue = []
+            return "OK"
+        if name == "WATCH":
+            for key in args[1:]:
+                self.watched[key] = db.versions.get(key, 0)
+            return "OK"
+        if name == "UNWATCH":
+            self.watched = {}
+            return "OK"
+        if name == "DISCARD":
+            self.queue, self.watched = None, {}
+            return "OK"
+        if name == "EXEC":
+            queue, self.queue = self.queue, None
+            watched, self.watched = self.watched, {}
+            if queue is None:
+                raise _Error("ERR EXEC without MULTI")
+            if any(db.versions.get(key, 0) != version for key, version in watched.items()):
+                return None  # Транзакция отменена, клиент получит WatchError
+            results = []
+            for queued in queue:
+                try:
+                    results.append(db.execute(queued))
+                except _Error as e:
+                    results.append(e)
+            return results
+        if self.queue is not None:
+            self.queue.append(args)
+            return "QUEUED"
+        return db.execute(args)
+
+
+def _encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, _Error):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    raise TypeError(f"Неподдерживаемый тип ответа: {type(value)}")
+
+
+async def _read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()  # inline-команда
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class FakeRedisServer:
+    """TCP-сервер поверх FakeRedis"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.db = FakeRedis()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        connection = _Connection(self)
+        try:
+            while True:
+                args = await _read_command(reader)
+                if args is None:
+                    break
+                try:
+                    reply = connection.handle(args)
+                except _Error as e:
+                    reply = e
+                except (ValueError, TypeError, IndexError) as e:
+                    reply = _Error(f"ERR {e}")
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
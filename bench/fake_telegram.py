@@ -0,0 +1,144 @@
+"""Фейковый Telegram Bot API для локальных проверок и нагрузочных тестов.
+
+FakeTelegramRequest подменяет сетевой слой python-telegram-bot: бот работает
+как настоящий, но вместо api.telegram.org запросы обслуживаются в памяти.
+"""
+import asyncio
+import io
+import json
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+def fake_image_bytes(size=(1600, 1200)):
+    """Тестовое изображение в JPEG (или заглушка, если Pillow не установлен)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + b"\x00" * 2048
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (90, 140, 200)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def fake_document_bytes(paragraphs=200):
+    """Тестовый текстовый документ в UTF-8"""
+    return "\n\n".join(
+        f"Раздел {i + 1}. Выручка за период составила {1000 + i * 17} тыс. руб., "
+        f"основные расходы пришлись на закупки и логистику. " * 3
+        for i in range(paragraphs)
+    ).encode("utf-8")
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Ответы Bot API из памяти с настраиваемой задержкой"""
+
+    def __init__(self, latency=0.0, file_bytes=None, document_bytes=None):
+        self.latency = latency
+        self.file_bytes = file_bytes if file_bytes is not None else fake_image_bytes()
+        # Файлы с file_id, начинающимся на "doc", отдаются как текстовые документы
+        self.document_bytes = document_bytes if document_bytes is not None else fake_document_bytes()
+        self.calls = Counter()
+        self.sent_texts = []
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # Скачивание файла идет GET-запросом по пути файла
+        if "/file/bot" in url:
+            self.calls["download"] += 1
+            return 200, self.document_bytes if "/documents/" in url else self.file_bytes
+
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        result = self._result(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            self.sent_texts.append(params.get("text", ""))
+            return {
+                "message_id": params.get("message_id", self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if api_method == "getFile":
+            file_id = params.get("file_id", "file")
+            if file_id.startswith("doc"):
+                file_size, file_path = len(self.document_bytes), "documents/file.txt"
+            else:
+                file_size, file_path = len(self.file_bytes), "photos/file.jpg"
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"unique-{file_id}",
+                "file_size": file_size,
+                "file_path": file_path,
+            }
+        return True
+
+
+class UpdateFactory:
+    """Синтетические обновления Telegram в формате JSON"""
+
+    def __init__(self):
+        self._update_id = 0
+
+    def _next(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, user_id, **fields):
+        update_id = self._next()
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+        message.update(fields)
+        return {"update_id": update_id, "message": message}
+
+    def text(self, user_id, text):
+        return self._message(user_id, text=text)
+
+    def command(self, user_id, command):
+        return self._message(
+            user_id, text=f"/{command}",
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command) + 1}]
+        )
+
+    def photo(self, user_id, caption="Что на этом изображении?", file_id="photo-1"):
+        return self._message(user_id, caption=caption, photo=[{
+            "file_id": file_id, "file_unique_id": f"unique-{file_id}",
+            "width": 1600, "height": 1200, "file_size": 100000
+        }])
+
+    def document(self, user_id, file_name="notes.txt", mime_type="text/plain",
+                 caption="Расскажи об этом файле", file_id="doc-1"):
+        return self._message(user_id, caption=caption, document={
+            "file_id": file_id, "file_unique_id": f"unique-{file_id}",
+            "file_name": file_name, "mime_type": mime_type, "file_size": 1000
+        })
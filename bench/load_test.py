@@ -0,0 +1,250 @@
+"""Нагрузочный тест бота целиком: настоящие обработчики, фейковые Telegram и OpenRouter.
+
+Создает временный каталог с config.json и базой, импортирует Main, собирает
+приложение через build_application с FakeTelegramRequest и прогоняет через
+процессор обновлений (контроль допуска) и application.process_update
+синтетические обновления от виртуальных пользователей. Каждый пользователь отправляет сообщения по очереди, дожидаясь
+ответа, с паузой --think-time. В отчете: p50/p95/p99 задержки по типам
+сообщений, сообщения в секунду, время хранилища, задержки event loop и
+сводка по этапам из метрик.
+
+Запуск: python bench/load_test.py --users 100 --messages 10 --latency 0.5
+Для проверки регрессий: --max-p95 2.0 завершит тест с кодом 1 при превышении,
+--output results.json сохранит результаты.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_openrouter import start_fake_server
+from fake_telegram import FakeTelegramRequest, UpdateFactory
+
+COMMANDS = ("stats", "history", "help")
+
+
+def parse_mix(text):
+    """'text=0.8,image=0.1,...' -> (типы, веса)"""
+    kinds, weights = [], []
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        kinds.append(kind.strip())
+        weights.append(float(weight))
+    return kinds, weights
+
+
+def parse_overrides(items):
+    """--set key=value с разбором значения как JSON"""
+    overrides = {}
+    for item in items:
+        key, value = item.split("=", 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def write_config(directory, base_url, args):
+    config = {
+        "telegram_bot_token": "123456:LOADTEST",
+        "openrouter_api_key": "loadtest",
+        "openrouter_base_url": base_url,
+        "max_messages_per_day": 10 ** 6,
+        "stream_responses": args.stream,
+    }
+    config.update(parse_overrides(args.set))
+    with open(os.path.join(directory, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+
+
+class LoopLagMonitor:
+    """Насколько позже запланированного просыпается event loop"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def virtual_user(application, factory, user_id, args, kinds, weights, latencies, rng):
+    from telegram import Update
+
+    for n in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "image":
+            file_id = f"photo-{user_id}-{n}" if args.unique_images else "photo-shared"
+            data = factory.photo(user_id, file_id=file_id)
+        elif kind == "document":
+            data = factory.document(user_id, file_id=f"doc-{user_id}-{n}")
+        elif kind == "command":
+            data = factory.command(user_id, rng.choice(COMMANDS))
+        else:
+            data = factory.text(user_id, f"Вопрос номер {n} от пользователя {user_id}: как дела?")
+
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        # Как в рабочем режиме: через процессор обновлений и контроль допуска
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        if args.think_time:
+            await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+async def run(args):
+    kinds, weights = parse_mix(args.mix)
+    server, base_url = start_fake_server(latency=args.latency)
+    directory = tempfile.mkdtemp(prefix="bot-loadtest-")
+    write_config(directory, base_url, args)
+    os.chdir(directory)
+
+    # Main читает config.json из текущего каталога при импорте
+    import Main
+    from metrics import registry
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    request = FakeTelegramRequest(latency=args.telegram_latency)
+    application = Main.build_application(with_updater=False, request=request)
+    Main.init_database()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    factory = UpdateFactory()
+    latencies = {}
+    monitor = LoopLagMonitor()
+    monitor.start()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        virtual_user(application, factory, 1000 + index, args, kinds, weights, latencies,
+                     random.Random(rng.random()))
+        for index in range(args.users)
+    ))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    admission = {
+        "/".join(labels): child.value for labels, child in registry.get("bot_admission_total").items()
+    }
+    db = registry.get("bot_db_query_seconds")
+    db_count = sum(child.count for _, child in db.items())
+    db_time = sum(child.sum for _, child in db.items())
+    stage_summary = Main.format_histogram(Main.STAGE_SECONDS)
+
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    server.shutdown()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        "users": args.users,
+        "messages": len(all_latencies),
+        "elapsed": elapsed,
+        "messages_per_second": len(all_latencies) / elapsed,
+        "latency": {
+            kind: {
+                "count": len(values),
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+            }
+            for kind, values in [("all", all_latencies), *sorted(latencies.items())]
+        },
+        "db_queries": db_count,
+        "db_time": db_time,
+        "loop_lag": {
+            "p50": percentile(monitor.samples, 0.50),
+            "p99": percentile(monitor.samples, 0.99),
+            "max": max(monitor.samples, default=0.0),
+        },
+        "admission": admission,
+        "llm_requests": server.requests_total,
+        "telegram_calls": dict(request.calls),
+    }
+    return result, stage_summary
+
+
+def report(result, stage_summary):
+    print(f"Пользователей: {result['users']}, сообщений: {result['messages']}, "
+          f"время {result['elapsed']:.2f} с, {result['messages_per_second']:.1f} сообщ./с")
+    print("Задержка обработки (с):")
+    for kind, stats in result["latency"].items():
+        print(f"  {kind:<9} n={stats['count']:<5} p50 {stats['p50']:.3f}  p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+    average_db = result["db_time"] / result["db_queries"] * 1000 if result["db_queries"] else 0.0
+    print(f"Хранилище: {result['db_queries']} операций, всего {result['db_time']:.3f} с, "
+          f"в среднем {average_db:.2f} мс")
+    lag = result["loop_lag"]
+    print(f"Задержка event loop: p50 {lag['p50'] * 1000:.1f} мс, p99 {lag['p99'] * 1000:.1f} мс, "
+          f"max {lag['max'] * 1000:.1f} мс")
+    print(f"Контроль допуска: {result['admission'] or 'нет решений'}")
+    print(f"Запросов к нейросети: {result['llm_requests']}, вызовов Bot API: {result['telegram_calls']}")
+    print("Этапы:")
+    print(stage_summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument("--users", type=int, default=50, help="виртуальных пользователей")
+    parser.add_argument("--messages", type=int, default=10, help="сообщений от каждого")
+    parser.add_argument("--mix", default="text=0.8,image=0.1,document=0.05,command=0.05",
+                        help="доли типов сообщений")
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка фейкового OpenRouter, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка фейкового Bot API, с")
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза между сообщениями, с")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы")
+    parser.add_argument("--unique-images", action="store_true", help="без повторов изображений (мимо кэша)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="переопределить параметр config.json")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--max-p95", type=float, help="порог p95 (с) для проверки регрессий")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    result, stage_summary = asyncio.run(run(args))
+    report(result, stage_summary)
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+    if args.max_p95 is not None and result["latency"]["all"]["p95"] > args.max_p95:
+        print(f"❌ p95 {result['latency']['all']['p95']:.3f} с превышает порог {args.max_p95} с")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Проверка повторов, сроков попыток и выключателя AIClient на фейковом OpenRouter.
+
+Этапы: нестабильный провайдер (часть ответов 503) без повторов и с ними,
+полный отказ (выключатель размыкается, запросы отклоняются без обращения
+к серверу), зависший ответ (срок попытки) и восстановление после
+reset_timeout.
+Запуск: python bench/resilience_check.py --requests 100 --failure-rate 0.3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_client import AIClient
+from fake_openrouter import start_fake_server
+from metrics import registry
+from resilience import CircuitOpenError, RetryPolicy
+
+MODEL = "fake/model"
+MESSAGES = [{"role": "user", "content": "Привет"}]
+
+
+async def burst(client, count, timeout=None):
+    """count одновременных запросов: (успешно, отклонено выключателем, ошибок, время)"""
+    async def one():
+        try:
+            await client.complete(MESSAGES, model=MODEL, timeout=timeout)
+            return "ok"
+        except CircuitOpenError:
+            return "rejected"
+        except Exception:
+            return "error"
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(count)))
+    return results.count("ok"), results.count("rejected"), results.count("error"), time.perf_counter() - started
+
+
+def report(name, result, server, requests_before):
+    ok, rejected, errors, elapsed = result
+    print(f"{name}: успешно {ok}, отклонено {rejected}, ошибок {errors}, "
+          f"запросов к серверу {server.requests_total - requests_before}, время {elapsed:.2f} с")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Проверка устойчивости клиента OpenRouter")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--failure-rate", type=float, default=0.3)
+    parser.add_argument("--reset-timeout", type=float, default=2.0)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(latency=0.05, failure_rate=args.failure_rate)
+
+    def client(max_retries):
+        return AIClient(
+            api_key="check", base_url=base_url, request_timeout=5,
+            retry_policy=RetryPolicy(max_retries=max_retries, base_delay=0.05, max_delay=1.0),
+            failure_threshold=10 ** 6 if max_retries == 0 else 5, reset_timeout=args.reset_timeout
+        )
+
+    plain = client(0)
+    before = server.requests_total
+    report("Без повторов", await burst(plain, args.requests), server, before)
+    await plain.close()
+
+    resilient = client(3)
+    before = server.requests_total
+    report("С повторами", await burst(resilient, args.requests), server, before)
+
+    server.failure_rate = 1.0
+    before = server.requests_total
+    report("Полный отказ", await burst(resilient, args.requests), server, before)
+    print(f"  выключатель: {resilient.breaker(MODEL).state}")
+
+    server.failure_rate = 0.0
+    await asyncio.sleep(args.reset_timeout)
+    server.latency = 3.0
+    before = server.requests_total
+    report("Зависший ответ (срок 0.5 с)", await burst(resilient, 1, timeout=0.5), server, before)
+    print(f"  выключатель: {resilient.breaker(MODEL).state}")
+
+    server.latency = 0.05
+    await asyncio.sleep(args.reset_timeout)
+    before = server.requests_total
+    report("Пробный запрос", await burst(resilient, 1), server, before)
+    before = server.requests_total
+    report("Восстановление", await burst(resilient, args.requests), server, before)
+    print(f"  выключатель: {resilient.breaker(MODEL).state}")
+    await resilient.close()
+
+    print("Метрики:")
+    for name in ("bot_circuit_transitions_total", "bot_circuit_rejected_total", "bot_llm_retries_total"):
+        for line in registry.get(name).render()[2:]:
+            print(f"  {line}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""Проверка взаимозаменяемости хранилищ и распределения по процессам.
+
+Прогоняет один и тот же сценарий на Storage (SQLite) и RedisStorage
+(поверх фейкового Redis из fake_redis.py) и сравнивает результаты, затем
+запускает WorkerPool и проверяет, что обновления одного пользователя
+всегда попадают в один процесс.
+Запуск: python bench/state_backend_check.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_redis import FakeRedisServer
+from fake_telegram import UpdateFactory
+from redis_storage import RedisStorage
+from sharding import WorkerPool
+from storage import Storage
+
+MEMORY_SIZE = 5
+
+
+async def scenario(storage):
+    """Одинаковые операции для любого хранилища, возвращает наблюдаемые результаты"""
+    results = {}
+    rows = [
+        (user_id, f"сообщение {i}", "text" if i % 2 else "bot_response", f"2025-01-01 00:00:{i:02d}")
+        for user_id in (1, 2) for i in range(8)
+    ]
+    start = time.perf_counter()
+    await storage.insert_messages(rows)
+    results["history"] = await storage.get_history(1, 3)
+    results["pruned"] = await storage.prune_history([1, 2], MEMORY_SIZE)
+    results["after_prune"] = [row[1:] for row in await storage.get_history_rows(1)]
+
+    history_rows = await storage.get_history_rows(2)
+    await storage.save_summary(2, "краткое содержание", history_rows[2][0])
+    results["summary"] = await storage.get_summary(2)
+    results["after_summary"] = [row[1:] for row in await storage.get_history_rows(2)]
+
+    await storage.save_limits([(1, 3, "2025-01-01"), (2, 7, "2025-01-02")])
+    await storage.save_limits([(1, 4, "2025-01-01")])
+    results["limits"] = await storage.get_limits(1)
+    results["limits_for_day"] = sorted(await storage.load_limits("2025-01-01"))
+
+    now = 1_000_000.0
+    cached = [
+        ("k1", "model", "ctx", "prompt 1", "response 1", 10, 0, now - 100, now - 1),
+        ("k2", "model", "ctx", "prompt 2", "response 2", 20, 3, now - 10, now - 5),
+        ("k3", "model", "ctx", "prompt 3", "response 3", 30, 1, now - 5000, now - 2),
+    ]
+    await storage.save_cached_responses(cached, [], now - 3600)
+    await storage.save_cached_responses([], ["k2"], now - 3600)
+    results["cache"] = [row[0] for row in await storage.load_cached_responses(now - 3600, 10)]
+    results["elapsed_ms"] = (time.perf_counter() - start) * 1000
+    return results
+
+
+def record_worker(index, updates):
+    """Процесс-обработчик для проверки: пишет в вывод, кому достались обновления"""
+    seen = set()
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        seen.add(data["message"]["from"]["id"])
+    print(f"  процесс {index}: пользователи {sorted(seen)}", flush=True)
+
+
+async def check_sharding(workers=3):
+    factory = UpdateFactory()
+    pool = WorkerPool(record_worker, workers)
+    pool.start()
+    for round_number in range(3):
+        for user_id in range(1, 10):
+            await pool.dispatch(factory.text(user_id, f"раунд {round_number}"))
+    await pool.stop(timeout=10)
+    print(f"Распределено по процессам: {pool.dispatched}")
+    assert sum(pool.dispatched) == 27
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_storage = Storage(os.path.join(directory, "bot_data.db"))
+        sqlite_storage.open()
+        try:
+            sqlite_results = await scenario(sqlite_storage)
+        finally:
+            await sqlite_storage.close()
+
+    server = await FakeRedisServer().start()
+    redis_storage = RedisStorage(server.url, prefix="check")
+    redis_storage.open()
+    try:
+        redis_results = await scenario(redis_storage)
+    finally:
+        await redis_storage.close()
+        await server.stop()
+
+    print(f"SQLite: {sqlite_results['elapsed_ms']:.1f} мс, Redis (фейк): {redis_results['elapsed_ms']:.1f} мс, "
+          f"команд Redis: {server.db.commands}")
+    for key in sqlite_results:
+        if key == "elapsed_ms":
+            continue
+        same = sqlite_results[key] == redis_results[key]
+        print(f"{'✅' if same else '❌'} {key}: {redis_results[key]}")
+        assert same, f"{key}: {sqlite_results[key]} != {redis_results[key]}"
+
+    await check_sharding()
+    print("✅ Хранилища взаимозаменяемы, обновления распределяются по процессам")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""Проверка потокового ответа на тексте из 4-байтовых символов.
+
+Эмодзи и другие символы вне BMP занимают две единицы UTF-16, и Telegram
+отклоняет сообщения длиннее лимита в этих единицах. Проверка подает в
+StreamingReply ответ из эмодзи и текста небольшими фрагментами через
+фейковые сообщение и бота и убеждается, что ни одна отправка или правка не
+превышает лимит, а весь текст дошел до пользователя.
+Запуск: python bench/streaming_check.py --length 20000 --max-length 4096
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_splitter import split_text, utf16_len
+from streaming import EditThrottle, StreamingReply, STREAM_PLACEHOLDER
+
+SYMBOLS = ["🚀", "✅", "📄", "😀", "𝔘𝔫𝔦𝔠𝔬𝔡𝔢", "текст", " ", " ", "\n"]
+
+
+class FakeMessage:
+    _ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, bot, text):
+        self.bot = bot
+        self.chat_id = 1
+        self.message_id = next(self._ids)
+        self.text = text
+
+    def get_bot(self):
+        return self.bot
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text)
+
+
+class FakeBot:
+    """Запоминает последний текст каждого сообщения и превышения лимита"""
+
+    rate_limiter = None
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.messages = {}
+        self.too_long = []
+
+    def _check(self, text):
+        if utf16_len(text) > self.max_length:
+            self.too_long.append(utf16_len(text))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._check(text)
+        message = FakeMessage(self, text)
+        self.messages[message.message_id] = text
+        return message
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self._check(text)
+        self.messages[message_id] = text
+
+
+def split(text, max_length):
+    return list(split_text(text, max_length)) or [text]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Проверка потокового ответа с эмодзи")
+    parser.add_argument("--length", type=int, default=20000, help="символов в ответе")
+    parser.add_argument("--max-length", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    text = ""
+    while len(text) < args.length:
+        text += rng.choice(SYMBOLS)
+
+    bot = FakeBot(args.max_length)
+    reply = StreamingReply(FakeMessage(bot, ""), EditThrottle(0), args.max_length, split)
+    await reply.start()
+    for start in range(0, len(text), 7):
+        await reply.feed(text[start:start + 7])
+    await reply.finish()
+
+    delivered = "".join(part for part in bot.messages.values() if part != STREAM_PLACEHOLDER)
+    lost = "".join(text.split()) != "".join(delivered.split())
+    print(f"Ответ {len(text)} символов, {utf16_len(text)} единиц UTF-16: сообщений {len(bot.messages)}, "
+          f"длиннее лимита {len(bot.too_long)} (максимум {max(bot.too_long, default=0)}), "
+          f"текст {'потерян' if lost else 'доставлен целиком'}")
+    if bot.too_long or lost:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""Проверка webhook-режима: отправляет фейковые обновления на локальный сервер.
+
+Поднимает WebhookServer на свободном порту с фейковым Bot API, отправляет
+обновления с правильным и неправильным секретным токеном и проверяет, что
+обработчик получил только корректные, а при остановке очередь дорабатывается.
+Запуск: python bench/webhook_smoke.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from telegram.ext import Application, MessageHandler, filters
+
+from fake_telegram import FakeTelegramRequest, UpdateFactory
+from webhook_server import SECRET_HEADER, WebhookServer
+
+SECRET = "smoke-secret"
+
+
+async def main():
+    received = []
+
+    async def on_text(update, context):
+        await asyncio.sleep(0.2)  # Имитация работы, чтобы проверить дренаж
+        received.append(update.message.text)
+
+    application = (
+        Application.builder()
+        .token("123456:FAKE")
+        .request(FakeTelegramRequest())
+        .get_updates_request(FakeTelegramRequest())
+        .updater(None)
+        .concurrent_updates(8)
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, on_text))
+
+    server = WebhookServer(application, host="127.0.0.1", port=0, path="/telegram", secret_token=SECRET)
+    factory = UpdateFactory()
+
+    await application.initialize()
+    await application.start()
+    await server.start()
+    url = f"http://127.0.0.1:{server.port}/telegram"
+
+    async with httpx.AsyncClient() as client:
+        ok = await client.post(url, json=factory.text(1, "привет"), headers={SECRET_HEADER: SECRET})
+        forbidden = await client.post(url, json=factory.text(2, "чужой"), headers={SECRET_HEADER: "wrong"})
+        bad = await client.post(url, content=b"not json", headers={SECRET_HEADER: SECRET})
+        burst = await asyncio.gather(*(
+            client.post(url, json=factory.text(3, f"сообщение {i}"), headers={SECRET_HEADER: SECRET})
+            for i in range(5)
+        ))
+        health = await client.get(f"http://127.0.0.1:{server.port}/healthz")
+
+    await server.drain()
+    await application.stop()
+    await server.stop()
+    await application.shutdown()
+
+    print(f"Корректное обновление: {ok.status_code}")
+    print(f"Неверный секрет: {forbidden.status_code}")
+    print(f"Некорректный JSON: {bad.status_code}")
+    print(f"Пачка обновлений: {[r.status_code for r in burst]}")
+    print(f"Healthcheck: {health.status_code}")
+    print(f"Обработано обработчиком: {len(received)} из 6")
+
+    assert ok.status_code == 200
+    assert forbidden.status_code == 403
+    assert bad.status_code == 400
+    assert all(r.status_code == 200 for r in burst)
+    assert len(received) == 6 and "чужой" not in received
+    print("✅ Webhook работает")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
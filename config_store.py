@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import os
+from collections.abc import Mapping
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    """Конфигурация не прошла проверку; текст перечисляет все ошибки"""
+
+
+def freeze(value):
+    """Неизменяемая копия: словари становятся MappingProxyType, списки — кортежами"""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """Обратное преобразование для сохранения в JSON"""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def _type_error(value, default):
+    """Описание несоответствия типа значению по умолчанию или None"""
+    if isinstance(default, bool):
+        return None if isinstance(value, bool) else "ожидалось true или false"
+    if isinstance(default, (int, float)):
+        # Целые и дробные взаимозаменяемы: таймаут 60 можно записать как 60.5
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return "ожидалось число"
+        return None
+    if isinstance(default, str):
+        return None if isinstance(value, str) else "ожидалась строка"
+    if isinstance(default, (list, tuple)):
+        return None if isinstance(value, (list, tuple)) else "ожидался список"
+    return None
+
+
+def validate(values, defaults, choices=None, positive=(), maximums=None, checks=None, integers=(),
+             relations=None):
+    """Проверяет значения по схеме из значений по умолчанию.
+
+    Тип каждого параметра должен совпадать с типом значения по умолчанию,
+    числа не могут быть отрицательными, параметры из integers — дробными
+    (размеры, счетчики и окна идут в срезы и deque), из positive должны быть
+    больше нуля, из choices — входить в список допустимых, из maximums — не
+    превышать предел. checks задает для параметра функцию, которая
+    возвращает описание ошибки или None. relations — такие же функции
+    check(value, values) для связей между параметрами; они запускаются,
+    только когда каждый параметр корректен сам по себе. Возвращает словарь
+    {параметр: описание ошибки}.
+    """
+    choices = choices or {}
+    maximums = maximums or {}
+    checks = checks or {}
+    relations = relations or {}
+    errors = {}
+    for key, default in defaults.items():
+        value = values.get(key, default)
+        error = _type_error(value, default)
+        if error is None and key in integers and isinstance(value, float):
+            error = "ожидалось целое число"
+        if error is None and isinstance(value, (int, float)) and not isinstance(value, bool):
+            if value < 0:
+                error = "не может быть отрицательным"
+            elif key in positive and value == 0:
+                error = "должно быть больше нуля"
+            elif key in maximums and value > maximums[key]:
+                error = f"не больше {maximums[key]}"
+        if error is None and key in choices and value not in choices[key]:
+            error = f"допустимые значения: {', '.join(map(str, choices[key]))}"
+        if error is None and key in checks:
+            error = checks[key](value)
+        if error is not None:
+            errors[key] = f"{error} (получено {value!r})"
+    if errors:
+        return errors
+    values = {**defaults, **values}
+    for key, check in relations.items():
+        error = check(values[key], values)
+        if error is not None:
+            errors[key] = f"{error} (получено {values[key]!r})"
+    return errors
+
+
+class ConfigStore(Mapping):
+    """Конфигурация бота с горячей перезагрузкой.
+
+    Читается как обычный словарь (config["model"]), но хранит неизменяемый
+    снимок, который при перезагрузке целиком заменяется новым одним
+    присваиванием: обработчик никогда не увидит наполовину примененный файл.
+    Новый файл сначала проверяется по схеме; если в нем есть ошибки,
+    остается прежний снимок. Параметры из restart_keys применяются только
+    после перезапуска, их изменения при перезагрузке игнорируются с
+    предупреждением. Подписчики получают множество измененных параметров.
+    """
+
+    def __init__(self, path, defaults, choices=None, positive=(), maximums=None, checks=None,
+                 restart_keys=(), integers=(), relations=None):
+        self.path = path
+        self.defaults = defaults
+        self.choices = choices or {}
+        self.positive = set(positive)
+        self.maximums = maximums or {}
+        self.checks = checks or {}
+        self.restart_keys = set(restart_keys)
+        self.integers = set(integers)
+        self.relations = relations or {}
+        self.reloads = 0
+        self.failed_reloads = 0
+        self._listeners = []
+        self._stamp = None
+        self._task = None
+        self._snapshot = freeze(self._load_initial())
+
+    def __getitem__(self, key):
+        return self._snapshot[key]
+
+    def __iter__(self):
+        return iter(self._snapshot)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __repr__(self):
+        return repr(thaw(self._snapshot))
+
+    @property
+    def snapshot(self):
+        """Текущий неизменяемый снимок: его можно держать на время всего запроса"""
+        return self._snapshot
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            values = json.load(f)
+        if not isinstance(values, dict):
+            raise ConfigError("в файле должен быть JSON-объект")
+        unknown = sorted(set(values) - set(self.defaults))
+        if unknown:
+            logger.warning(f"Неизвестные параметры конфига: {', '.join(unknown)}")
+        return {**self.defaults, **values}
+
+    def _validate(self, values):
+        return validate(
+            values, self.defaults, self.choices, self.positive, self.maximums, self.checks, self.integers,
+            self.relations
+        )
+
+    def _load_initial(self):
+        """Первая загрузка: ошибочные значения заменяются значениями по умолчанию"""
+        try:
+            if not os.path.exists(self.path):
+                # Создаем файл с дефолтными настройками
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump(self.defaults, f, indent=4, ensure_ascii=False)
+            self._stamp = self._file_stamp()
+            values = self._read()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки конфига: {e}")
+            return dict(self.defaults)
+        for key, error in self._validate(values).items():
+            logger.error(f"Параметр {key}: {error}, используется значение по умолчанию")
+            values[key] = self.defaults[key]
+        return values
+
+    def subscribe(self, callback):
+        """callback(changed, snapshot) вызывается после каждой успешной перезагрузки"""
+        self._listeners.append(callback)
+
+    def reload(self):
+        """Перечитывает файл и атомарно подменяет снимок.
+
+        Возвращает (примененные параметры, параметры, ждущие перезапуска).
+        При ошибке чтения или проверки бросает ConfigError, снимок не меняется.
+        """
+        self._stamp = self._file_stamp()
+        try:
+            values = self._read()
+        except (OSError, json.JSONDecodeError) as e:
+            self.failed_reloads += 1
+            raise ConfigError(f"не удалось прочитать {self.path}: {e}") from e
+        except ConfigError:
+            self.failed_reloads += 1
+            raise
+        errors = self._validate(values)
+        if errors:
+            self.failed_reloads += 1
+            raise ConfigError("\n".join(f"{key}: {error}" for key, error in errors.items()))
+
+        current = self._snapshot
+        new = freeze(values)
+        changed = {key for key in new if new[key] != current.get(key)}
+        pending = changed & self.restart_keys
+        if pending:
+            # До перезапуска снимок отражает действующие значения
+            values.update({key: thaw(current[key]) for key in pending})
+            new = freeze(values)
+            logger.warning(f"Параметры применятся после перезапуска: {', '.join(sorted(pending))}")
+        applied = changed - pending
+        if not applied:
+            return applied, pending
+
+        self._snapshot = new
+        self.reloads += 1
+        logger.info(f"Конфигурация обновлена: {', '.join(sorted(applied))}")
+        for callback in self._listeners:
+            try:
+                callback(applied, new)
+            except Exception as e:
+                logger.error(f"Ошибка применения конфигурации: {e}")
+        return applied, pending
+
+    def start_watching(self, interval):
+        """Проверяет файл раз в interval секунд и перезагружает при изменении"""
+        if interval and self._task is None:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    async def stop_watching(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stamp = self._file_stamp()
+            if stamp is None or stamp == self._stamp:
+                continue
+            try:
+                self.reload()
+            except ConfigError as e:
+                logger.error(f"Новый конфиг не применен:\n{e}")
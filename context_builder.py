@@ -0,0 +1,95 @@
+import math
+
+# Служебные токены, которые API добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+# Примерная стоимость одного изображения в токенах
+IMAGE_TOKENS = 765
+ELLIPSIS = "\n…\n"
+
+# Как сообщения из истории превращаются в сообщения API
+HISTORY_ROLES = {
+    "text": ("user", "{}"),
+    "image": ("user", "[{}]"),
+    "document": ("user", "[{}]"),
+    "bot_response": ("assistant", "{}"),
+}
+
+
+def estimate_tokens(text):
+    """Быстрая оценка числа токенов без настоящего токенизатора.
+
+    Латиница в среднем дает ~4 символа на токен, кириллица и прочие
+    не-ASCII символы ~2.5. Число не-ASCII символов оценивается по разнице
+    длины в UTF-8 и в символах, что считается в C и не требует цикла.
+    """
+    extra_bytes = len(text.encode("utf-8")) - len(text)
+    non_ascii = min(extra_bytes, len(text))
+    return math.ceil((len(text) - non_ascii) / 4 + non_ascii / 2.5)
+
+
+def content_tokens(content):
+    """Оценка токенов содержимого сообщения (строка или список частей)"""
+    if isinstance(content, str):
+        return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content:
+        if part.get("type") == "text":
+            tokens += estimate_tokens(part["text"])
+        elif part.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Обрезает текст до max_tokens, сохраняя начало и конец"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Подбираем длину по средней плотности текста, без повторных оценок
+    ratio = max_tokens / estimate_tokens(text)
+    keep = max(1, int(len(text) * ratio) - len(ELLIPSIS))
+    head = keep * 2 // 3
+    return text[:head] + ELLIPSIS + text[len(text) - (keep - head):]
+
+
+class ContextBuilder:
+    """Сборка сообщений для запроса к нейросети в пределах бюджета токенов.
+
+    История передается отдельными сообщениями с ролями user/assistant.
+    Если она не помещается в бюджет, отбрасываются самые старые реплики,
+    а слишком длинные сообщения укорачиваются до max_message_tokens.
+    """
+
+    def __init__(self, token_budget=3000, max_message_tokens=1000):
+        self.token_budget = token_budget
+        self.max_message_tokens = max_message_tokens
+
+    def build(self, system_prompt, history, user_content, summary=None):
+        """Возвращает (messages, оценка токенов запроса, число реплик истории).
+
+        history идет от новых к старым, как ее отдает get_user_message_history,
+        и уже содержит текущее сообщение пользователя: оно пропускается, потому
+        что передается отдельно в user_content.
+        """
+        if history and history[0]["type"] != "bot_response":
+            history = history[1:]
+
+        system_content = system_prompt
+        if summary:
+            system_content += f"\n\nКраткое содержание предыдущего разговора:\n{summary}"
+
+        system_message = {"role": "system", "content": system_content}
+        user_message = {"role": "user", "content": user_content}
+        used = content_tokens(system_content) + content_tokens(user_content)
+
+        turns = []
+        for msg in history:
+            role, template = HISTORY_ROLES.get(msg["type"], ("user", "{}"))
+            text = truncate_to_tokens(template.format(msg["text"]), self.max_message_tokens)
+            tokens = content_tokens(text)
+            if used + tokens > self.token_budget:
+                break
+            used += tokens
+            turns.append({"role": role, "content": text})
+
+        turns.reverse()  # В хронологическом порядке
+        return [system_message, *turns, user_message], used, len(turns)
@@ -0,0 +1,75 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+
+
+class ChatDispatcher:
+    """Порядок обработки сообщений внутри одного пользователя.
+
+    Сообщения одного пользователя обрабатываются строго по очереди, а разные
+    пользователи по-прежнему обслуживаются параллельно. Если задано окно
+    debounce_window, серия сообщений, пришедшая подряд (например, длинный
+    текст, который Telegram разбил на части), объединяется в один запрос.
+    """
+
+    def __init__(self, debounce_window=0.0, max_debounce_wait=3.0):
+        self.debounce_window = debounce_window
+        self.max_debounce_wait = max_debounce_wait
+        self.coalesced = 0
+        self._locks = {}
+        self._bursts = {}
+
+    @asynccontextmanager
+    async def serialize(self, user_id):
+        """Захватывает очередь пользователя на время обработки"""
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def serialized(self, handler):
+        """Оборачивает обработчик так, чтобы он шел в очереди пользователя"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = update.effective_user
+            if user is None:
+                return await handler(update, context)
+            async with self.serialize(user.id):
+                return await handler(update, context)
+        return wrapper
+
+    async def collect(self, user_id, text):
+        """Собирает серию сообщений пользователя.
+
+        Первое сообщение серии ждет, пока новые фрагменты перестанут
+        поступать, и получает объединенный текст. Для остальных фрагментов
+        возвращается None: их уже учел первый обработчик.
+        """
+        if self.debounce_window <= 0:
+            return text
+
+        burst = self._bursts.get(user_id)
+        if burst is not None:
+            burst.append(text)
+            self.coalesced += 1
+            return None
+
+        burst = self._bursts[user_id] = [text]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_debounce_wait
+        try:
+            while True:
+                seen = len(burst)
+                await asyncio.sleep(min(self.debounce_window, max(0.0, deadline - loop.time())))
+                if len(burst) == seen or loop.time() >= deadline:
+                    break
+        finally:
+            del self._bursts[user_id]
+        return "\n".join(burst)
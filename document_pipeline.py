@@ -0,0 +1,318 @@
+import asyncio
+import codecs
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple
+
+from context_builder import estimate_tokens, truncate_to_tokens
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # Без pypdf PDF-файлы не поддерживаются
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+# Тип содержимого по расширению и MIME-типу
+EXTENSION_KINDS = {
+    ".txt": "text", ".md": "text", ".markdown": "text", ".log": "text",
+    ".csv": "csv", ".tsv": "csv",
+    ".json": "text",
+    ".pdf": "pdf",
+}
+MIME_KINDS = {
+    "text/plain": "text", "text/markdown": "text", "text/x-markdown": "text",
+    "text/csv": "csv", "text/tab-separated-values": "csv",
+    "application/json": "text",
+    "application/pdf": "pdf",
+}
+
+READ_SIZE = 64 * 1024
+# Символов на токен в худшем случае (кириллица), для разрезания длинных строк
+CHARS_PER_TOKEN = 2.5
+
+MAP_SYSTEM_PROMPT = (
+    "Ты читаешь фрагмент большого документа. Кратко выпиши из фрагмента факты, "
+    "цифры и выводы, которые нужны, чтобы ответить на вопрос пользователя. Не "
+    "выдумывай ничего, чего нет в тексте. Если полезного нет, ответь одним символом «—»."
+)
+REDUCE_SYSTEM_PROMPT = (
+    "Ты объединяешь заметки по частям одного документа. Сведи их в одну краткую "
+    "выжимку без повторов, сохранив факты, цифры и выводы, нужные для ответа на "
+    "вопрос пользователя."
+)
+
+
+class DocumentError(Exception):
+    """Файл нельзя обработать; текст исключения показывается пользователю"""
+
+
+class ExtractedDocument(NamedTuple):
+    """Текст документа, разбитый на части в пределах бюджета токенов"""
+    name: str
+    chunks: List[str]
+    truncated: bool
+    chars: int
+
+
+def document_kind(file_name, mime_type):
+    """Тип содержимого ("text", "csv", "pdf") или None, если файл не поддерживается"""
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension in EXTENSION_KINDS:
+        return EXTENSION_KINDS[extension]
+    return MIME_KINDS.get((mime_type or "").split(";")[0].strip().lower())
+
+
+def _guess_encoding(head):
+    """UTF-8 (с BOM или без), UTF-16 по BOM, иначе cp1251"""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # Начало файла может оборваться посреди символа, поэтому декодер потоковый
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+
+def iter_text(path):
+    """Текст файла блоками по READ_SIZE байт"""
+    with open(path, "rb") as f:
+        data = f.read(READ_SIZE)
+        decoder = codecs.getincrementaldecoder(_guess_encoding(data))(errors="replace")
+        while data:
+            yield decoder.decode(data)
+            data = f.read(READ_SIZE)
+        yield decoder.decode(b"", final=True)
+
+
+def iter_pdf(path):
+    """Текст PDF по страницам"""
+    if PdfReader is None:
+        raise DocumentError("📄 Для чтения PDF на сервере бота не установлен пакет pypdf.")
+    reader = PdfReader(path)
+    if reader.is_encrypted:
+        raise DocumentError("🔒 PDF защищен паролем, прочитать его не получится.")
+    for page in reader.pages:
+        yield (page.extract_text() or "") + "\n\n"
+
+
+def chunk_text(pieces, max_tokens, max_chunks, repeat_header=False):
+    """Собирает поток фрагментов текста в части не длиннее max_tokens.
+
+    Части режутся по границам строк, слишком длинные строки — по символам.
+    С repeat_header первая строка (заголовок CSV) повторяется в каждой части.
+    Возвращает (части, обрезан ли текст, число прочитанных символов).
+    """
+    chunks = []
+    current = []
+    used = 0
+    header = None
+    header_tokens = 0
+    chars = 0
+    max_chars = max(1, int(max_tokens * CHARS_PER_TOKEN))
+
+    def flush():
+        nonlocal current, used
+        if any(line.strip() for line in current):
+            chunks.append("\n".join(current))
+        current = [header] if header is not None else []
+        used = header_tokens
+
+    def add(line):
+        nonlocal used
+        tokens = estimate_tokens(line) + 1
+        if used + tokens > max_tokens and len(current) > (header is not None):
+            flush()
+        current.append(line)
+        used += tokens
+
+    buffer = ""
+    for piece in pieces:
+        chars += len(piece)
+        buffer += piece
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            if repeat_header and header is None:
+                header, header_tokens = line, estimate_tokens(line) + 1
+                current, used = [header], header_tokens
+                continue
+            for start in range(0, max(len(line), 1), max_chars):
+                add(line[start:start + max_chars])
+            if len(chunks) >= max_chunks:
+                return chunks[:max_chunks], True, chars
+        # Строка без переводов тоже не должна расти без предела
+        while len(buffer) > max_chars:
+            add(buffer[:max_chars])
+            buffer = buffer[max_chars:]
+    if buffer:
+        add(buffer)
+    flush()
+    return chunks[:max_chunks], len(chunks) > max_chunks, chars
+
+
+def extract_chunks(path, kind, max_tokens, max_chunks):
+    """Извлекает текст файла и режет его на части (выполняется в процессе пула)"""
+    pieces = iter_pdf(path) if kind == "pdf" else iter_text(path)
+    return chunk_text(pieces, max_tokens, max_chunks, repeat_header=kind == "csv")
+
+
+class DocumentPipeline:
+    """Извлечение текста из документов и сжатие больших файлов.
+
+    Файл скачивается во временный файл и читается потоково в пуле процессов:
+    разбор PDF — чистый Python и в потоке держал бы GIL, тормозя event loop.
+    Текст режется на части по chunk_tokens, но не больше max_chunks частей.
+    Если частей несколько, каждая сжимается нейросетью в заметки по вопросу
+    пользователя (map), а заметки сводятся в одну выжимку (reduce).
+    Извлеченный текст и заметки кэшируются по file_unique_id.
+    """
+
+    def __init__(self, max_bytes=10 * 1024 * 1024, chunk_tokens=2000, max_chunks=20,
+                 map_concurrency=4, cache_max_bytes=16 * 1024 * 1024, max_workers=2,
+                 max_cached_notes=1000):
+        self.max_bytes = max_bytes
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.map_concurrency = map_concurrency
+        self.cache_max_bytes = cache_max_bytes
+        self.max_workers = max_workers
+        self.max_cached_notes = max_cached_notes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.map_calls = 0
+        self._cache = OrderedDict()
+        self._notes = OrderedDict()
+        self._executor = None
+
+    def _pool(self):
+        # Процессы запускаются при первом документе, а не при старте бота
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def prepare(self, bot, document):
+        """Скачивает документ и извлекает из него текст"""
+        kind = document_kind(document.file_name, document.mime_type)
+        if kind is None:
+            raise DocumentError("📎 Этот тип файлов не поддерживается. Подойдут txt, md, csv, json и pdf.")
+
+        extracted = self._cache.get(document.file_unique_id)
+        if extracted is not None:
+            self.hits += 1
+            self._cache.move_to_end(document.file_unique_id)
+            return extracted
+
+        self._check_size(document.file_size)
+        self.misses += 1
+        file = await bot.get_file(document.file_id)
+        self._check_size(file.file_size)
+
+        extension = os.path.splitext(document.file_name or "")[1].lower()
+        fd, path = tempfile.mkstemp(prefix="bot-document-", suffix=extension)
+        os.close(fd)
+        try:
+            await file.download_to_drive(path)
+            loop = asyncio.get_running_loop()
+            chunks, truncated, chars = await loop.run_in_executor(
+                self._pool(), extract_chunks, path, kind, self.chunk_tokens, self.max_chunks
+            )
+        finally:
+            os.remove(path)
+
+        if not chunks:
+            raise DocumentError("📄 В файле не найден текст. Если это скан, пришлите его как изображение.")
+        extracted = ExtractedDocument(document.file_name or "файл", chunks, truncated, chars)
+        self._remember(document.file_unique_id, extracted)
+        logger.info(
+            f"Документ {extracted.name}: {chars} символов, {len(chunks)} частей"
+            f"{' (обрезан)' if truncated else ''}"
+        )
+        return extracted
+
+    def _check_size(self, size):
+        if size and size > self.max_bytes:
+            raise DocumentError(
+                f"📦 Файл слишком большой: {size / 1024 / 1024:.1f} МБ, "
+                f"максимум {self.max_bytes / 1024 / 1024:.0f} МБ."
+            )
+
+    async def condense(self, file_unique_id, extracted, question, complete_func):
+        """Текст документа, помещающийся в один запрос: сам текст или выжимка по вопросу.
+
+        complete_func(system_prompt, content) возвращает ответ нейросети.
+        """
+        if len(extracted.chunks) == 1:
+            return extracted.chunks[0]
+
+        key = (file_unique_id, question)
+        if key in self._notes:
+            self._notes.move_to_end(key)
+            return self._notes[key]
+
+        semaphore = asyncio.Semaphore(self.map_concurrency)
+
+        async def ask(system_prompt, content):
+            async with semaphore:
+                self.map_calls += 1
+                return await complete_func(system_prompt, f"Вопрос пользователя: {question}\n\n{content}")
+
+        total = len(extracted.chunks)
+        notes = await asyncio.gather(*(
+            ask(MAP_SYSTEM_PROMPT, f"Фрагмент {i + 1} из {total}:\n{chunk}")
+            for i, chunk in enumerate(extracted.chunks)
+        ))
+        notes = [note for note in notes if note.strip() not in ("", "—", "-")]
+
+        # Сводим заметки группами, пока они не поместятся в одну часть
+        while True:
+            groups, _, _ = chunk_text(["\n\n".join(notes)], self.chunk_tokens, max_chunks=len(notes) * 4 + 1)
+            if len(groups) <= 1:
+                break
+            reduced = await asyncio.gather(*(ask(REDUCE_SYSTEM_PROMPT, group) for group in groups))
+            if len(reduced) >= len(notes):
+                # Заметки не сжимаются, дальше только обрезка
+                groups = [truncate_to_tokens("\n\n".join(reduced), self.chunk_tokens)]
+                break
+            notes = reduced
+        condensed = groups[0] if groups else ""
+
+        self._notes[key] = condensed
+        while len(self._notes) > self.max_cached_notes:
+            self._notes.popitem(last=False)
+        return condensed
+
+    @staticmethod
+    def _size(extracted):
+        return sum(len(chunk) for chunk in extracted.chunks)
+
+    def _remember(self, file_unique_id, extracted):
+        self._cache[file_unique_id] = extracted
+        self.cache_bytes += self._size(extracted)
+        while self.cache_bytes > self.cache_max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self.cache_bytes -= self._size(evicted)
+
+    def stats(self):
+        """Счетчики конвейера"""
+        return {
+            "cached": len(self._cache),
+            "cache_bytes": self.cache_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "map_calls": self.map_calls,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,157 @@
+import time
+from collections import OrderedDict, deque
+
+# Примерные накладные расходы на одно сообщение в памяти (словарь, строки времени и типа)
+MESSAGE_OVERHEAD = 200
+
+
+def message_size(message):
+    """Оценка размера сообщения в байтах"""
+    return len(message["text"].encode("utf-8")) + MESSAGE_OVERHEAD
+
+
+class _Window:
+    """Окно последних сообщений одного пользователя"""
+    __slots__ = ("messages", "size", "last_access")
+
+    def __init__(self, window_size):
+        self.messages = deque(maxlen=window_size)
+        self.size = 0
+        self.last_access = time.monotonic()
+
+
+class HistoryCache:
+    """LRU-кэш последних сообщений пользователей перед таблицей message_history.
+
+    Окно каждого пользователя хранит до window_size сообщений, общий объем
+    ограничен max_bytes, а окна без обращений дольше idle_ttl секунд
+    вытесняются. К базе обращаются только при промахе.
+    """
+
+    def __init__(self, window_size, max_bytes=16 * 1024 * 1024, idle_ttl=1800):
+        self.window_size = window_size
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._windows = OrderedDict()
+        self._loading = {}
+
+    def get(self, user_id, limit):
+        """Последние limit сообщений от новых к старым или None при промахе"""
+        window = self._windows.get(user_id)
+        if window is not None and time.monotonic() - window.last_access > self.idle_ttl:
+            self._evict(user_id)
+            window = None
+        if window is None or limit > self.window_size:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        window.last_access = time.monotonic()
+        self._windows.move_to_end(user_id)
+        result = []
+        for message in reversed(window.messages):
+            if len(result) >= limit:
+                break
+            result.append(message)
+        return result
+
+    def begin_load(self, user_id):
+        """Отмечает, что окно пользователя загружается из базы.
+
+        Сообщения, добавленные во время загрузки, не потеряются: они будут
+        применены поверх загруженной истории в put().
+        """
+        self._loading.setdefault(user_id, [])
+
+    def abort_load(self, user_id):
+        """Отменяет загрузку окна после ошибки чтения из базы"""
+        self._loading.pop(user_id, None)
+
+    def put(self, user_id, history):
+        """Сохраняет окно, загруженное из базы (история от новых к старым)"""
+        appended = self._loading.pop(user_id, None)
+        if appended is None:
+            # Окно сбросили во время загрузки, прочитанная история могла устареть
+            return
+        window = _Window(self.window_size)
+        for message in reversed(history[:self.window_size]):
+            self._push(window, message)
+        for message in appended:
+            self._push(window, message)
+
+        self._evict(user_id, count=False)
+        self._windows[user_id] = window
+        self.total_bytes += window.size
+        self._shrink()
+
+    def append(self, user_id, message):
+        """Добавляет новое сообщение в окно, если оно есть в кэше"""
+        if user_id in self._loading:
+            self._loading[user_id].append(message)
+            return
+        window = self._windows.get(user_id)
+        if window is None:
+            return
+        window.last_access = time.monotonic()
+        self._windows.move_to_end(user_id)
+        before = window.size
+        self._push(window, message)
+        self.total_bytes += window.size - before
+        self._shrink()
+
+    def invalidate(self, user_id):
+        """Удаляет окно пользователя, следующий запрос пойдет в базу"""
+        self._loading.pop(user_id, None)
+        self._evict(user_id, count=False)
+
+    def resize(self, window_size):
+        """Меняет размер окна; окна в кэше сбрасываются и перечитаются из базы"""
+        self.window_size = window_size
+        for user_id in list(self._windows):
+            self.invalidate(user_id)
+
+    def length(self, user_id):
+        """Число сообщений в окне пользователя или None, если окна нет в кэше"""
+        window = self._windows.get(user_id)
+        return len(window.messages) if window is not None else None
+
+    def evict_idle(self):
+        """Вытесняет окна без обращений дольше idle_ttl, возвращает их число"""
+        deadline = time.monotonic() - self.idle_ttl
+        expired = [user_id for user_id, window in self._windows.items() if window.last_access < deadline]
+        for user_id in expired:
+            self._evict(user_id)
+        return len(expired)
+
+    def stats(self):
+        """Счетчики кэша"""
+        return {
+            "users": len(self._windows),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _push(self, window, message):
+        if len(window.messages) == window.messages.maxlen:
+            window.size -= message_size(window.messages[0])
+        window.messages.append(message)
+        window.size += message_size(message)
+
+    def _evict(self, user_id, count=True):
+        window = self._windows.pop(user_id, None)
+        if window is not None:
+            self.total_bytes -= window.size
+            if count:
+                self.evictions += 1
+
+    def _shrink(self):
+        """Вытесняет самые давние окна, пока объем превышает лимит"""
+        while self.total_bytes > self.max_bytes and len(self._windows) > 1:
+            user_id = next(iter(self._windows))
+            self._evict(user_id)
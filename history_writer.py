@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def utc_timestamp():
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class HistoryWriter:
+    """Отложенная запись истории сообщений.
+
+    Сообщения копятся в памяти и пишутся одной транзакцией раз в
+    flush_interval секунд или при накоплении batch_size строк. Лишние
+    сообщения удаляются периодическим проходом по затронутым пользователям,
+    а не при каждой вставке.
+    """
+
+    def __init__(self, storage, memory_size, flush_interval=0.5, batch_size=100, prune_interval=60):
+        self.storage = storage
+        self.memory_size = memory_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.prune_interval = prune_interval
+        self._pending = []
+        self._dirty_users = set()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def add(self, user_id, message_text, message_type):
+        """Ставит сообщение в очередь на запись и возвращает его в виде записи истории"""
+        timestamp = utc_timestamp()
+        self._pending.append((user_id, message_text, message_type, timestamp))
+        self._dirty_users.add(user_id)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return {"text": message_text, "type": message_type, "timestamp": timestamp}
+
+    def pending_for(self, user_id):
+        """Еще не записанные сообщения пользователя, от новых к старым"""
+        return [
+            {"text": row[1], "type": row[2], "timestamp": row[3]}
+            for row in reversed(self._pending) if row[0] == user_id
+        ]
+
+    @property
+    def queue_size(self):
+        return len(self._pending)
+
+    def start(self):
+        """Запускает фоновые циклы записи и обрезки"""
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._prune_loop()),
+        ]
+
+    async def stop(self):
+        """Останавливает циклы и записывает все, что осталось в очереди"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        await self.prune()
+
+    async def flush(self):
+        """Записывает накопленные сообщения одной транзакцией"""
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self.storage.insert_messages(rows)
+        except Exception as e:
+            logger.error(f"Ошибка записи истории ({len(rows)} сообщений): {e}")
+            # Возвращаем строки в начало очереди, чтобы не потерять их
+            self._pending = rows + self._pending
+
+    async def prune(self):
+        """Обрезает историю пользователей, получивших новые сообщения"""
+        if not self._dirty_users:
+            return
+        user_ids, self._dirty_users = self._dirty_users, set()
+        try:
+            deleted = await self.storage.prune_history(user_ids, self.memory_size)
+            if deleted:
+                logger.info(f"Удалено старых сообщений из истории: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка обрезки истории: {e}")
+            self._dirty_users |= user_ids
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _prune_loop(self):
+        while True:
+            await asyncio.sleep(self.prune_interval)
+            # Сначала дописываем очередь, чтобы обрезка видела все сообщения
+            await self.flush()
+            await self.prune()
@@ -0,0 +1,130 @@
+import asyncio
+import base64
+import io
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Без Pillow изображения отправляются как есть
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def detect_image_format(data):
+    """Определяет MIME-тип изображения по сигнатуре файла"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:2] == b"BM":
+        return "image/bmp"
+    return None
+
+
+class ImagePipeline:
+    """Подготовка изображений перед отправкой в нейросеть.
+
+    Изображение уменьшается до max_edge по большей стороне и пережимается в
+    компактный JPEG/WebP в отдельном потоке, чтобы не блокировать event loop.
+    Готовый data URL кэшируется по file_unique_id: повторно присланная
+    картинка не скачивается и не кодируется заново.
+    """
+
+    def __init__(self, max_edge=1568, output_format="JPEG", quality=85,
+                 cache_max_bytes=32 * 1024 * 1024, max_workers=2):
+        if output_format not in OUTPUT_MIME_TYPES:
+            raise ValueError(f"Неподдерживаемый формат изображений: {output_format}")
+        self.max_edge = max_edge
+        self.output_format = output_format
+        self.quality = quality
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._cache = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image")
+
+    async def prepare(self, bot, file_id, file_unique_id):
+        """Скачивает и подготавливает изображение, возвращает data URL"""
+        data_url = self._cache.get(file_unique_id)
+        if data_url is not None:
+            self.hits += 1
+            self._cache.move_to_end(file_unique_id)
+            return data_url
+
+        self.misses += 1
+        file = await bot.get_file(file_id)
+        file_data = await file.download_as_bytearray()
+
+        loop = asyncio.get_running_loop()
+        data_url = await loop.run_in_executor(self._executor, self.encode, bytes(file_data))
+        self._remember(file_unique_id, data_url)
+        return data_url
+
+    def encode(self, data):
+        """Уменьшает и пережимает изображение, возвращает data URL"""
+        mime_type = detect_image_format(data) or "image/jpeg"
+        self.bytes_in += len(data)
+        if Image is not None:
+            try:
+                data, mime_type = self._recompress(data, mime_type)
+            except Exception as e:
+                logger.warning(f"Не удалось пережать изображение, отправляем оригинал: {e}")
+        self.bytes_out += len(data)
+        return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+    def _recompress(self, data, mime_type):
+        with Image.open(io.BytesIO(data)) as image:
+            resized = max(image.size) > self.max_edge
+            image.thumbnail((self.max_edge, self.max_edge))
+            if self.output_format == "JPEG" and image.mode != "RGB":
+                image = self._flatten(image)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.output_format, quality=self.quality, optimize=True)
+
+        encoded = buffer.getvalue()
+        # Маленькие уже сжатые картинки иногда после пережатия только растут
+        if not resized and len(encoded) >= len(data):
+            return data, mime_type
+        return encoded, OUTPUT_MIME_TYPES[self.output_format]
+
+    @staticmethod
+    def _flatten(image):
+        """Переводит изображение в RGB, прозрачность заменяется белым фоном"""
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+
+    def _remember(self, file_unique_id, data_url):
+        self._cache[file_unique_id] = data_url
+        self.cache_bytes += len(data_url)
+        while self.cache_bytes > self.cache_max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
+
+    def stats(self):
+        """Счетчики конвейера"""
+        return {
+            "cached": len(self._cache),
+            "cache_bytes": self.cache_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = registry.histogram(
+    "bot_event_loop_lag_seconds", "Задержка цикла событий относительно расписания",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_STALLS = registry.counter(
+    "bot_event_loop_stalls_total", "Блокировки цикла событий дольше порога", ["handler"]
+)
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+def _site(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+
+
+class Offender:
+    """Накопленные блокировки одного обработчика"""
+    __slots__ = ("stalls", "samples", "blocked", "longest", "sites", "stack")
+
+    def __init__(self):
+        self.stalls = 0
+        self.samples = 0
+        self.blocked = 0.0
+        self.longest = 0.0
+        self.sites = Counter()
+        self.stack = ()
+
+
+class LoopWatchdog:
+    """Сторож цикла событий: задержка цикла и стеки блокирующих вызовов.
+
+    Внутри цикла каждые interval секунд срабатывает пульс и пишет задержку
+    относительно расписания в bot_event_loop_lag_seconds. Отдельный поток
+    спит до момента, когда пульс должен был прийти, плюс threshold; если
+    пульса нет, цикл занят синхронным кодом, и поток снимает стек главного
+    потока каждые sample_interval секунд, пока цикл не освободится. Пробы
+    относятся к обработчику — внешней функции из handler_files (Main.py) в
+    стеке, а если такой нет, к первой функции вне asyncio. Пока цикл
+    здоров, накладные расходы — один пульс за interval и одно пробуждение
+    потока за interval + threshold.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25, sample_interval=0.02, stack_depth=8,
+                 handler_files=()):
+        self.interval = interval
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.stack_depth = stack_depth
+        self.handler_files = {os.path.abspath(path) for path in handler_files}
+        self.max_lag = 0.0
+        self._offenders = {}
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        """Запускает пульс в текущем цикле и поток наблюдения"""
+        if self._task is not None:
+            return
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._stop.set()
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self._thread = None
+
+    def reset(self):
+        """Сбрасывает накопленные блокировки"""
+        with self._lock:
+            self._offenders = {}
+            self.max_lag = 0.0
+
+    def top(self, limit=5):
+        """Обработчики с наибольшим временем блокировки: [(имя, Offender)]"""
+        with self._lock:
+            offenders = list(self._offenders.items())
+        return sorted(offenders, key=lambda item: -item[1].blocked)[:limit]
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._beat = time.monotonic()
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def _watch(self):
+        while not self._stop.is_set():
+            beat = self._beat
+            wait = beat + self.interval + self.threshold - time.monotonic()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            # Пульс опаздывает больше порога: цикл занят синхронным кодом
+            samples = []
+            while self._beat == beat and not self._stop.is_set():
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    samples.append(self._sample(frame))
+                del frame
+                self._stop.wait(self.sample_interval)
+            if samples:
+                self._record(samples, max(0.0, self._beat - beat - self.interval))
+
+    def _sample(self, frame):
+        """(обработчик, стек от внутреннего вызова наружу)"""
+        stack = []
+        while frame is not None:
+            # Выше Handle._run — сам цикл и main(), они не относятся к обработчику
+            if frame.f_code.co_name == "_run" and frame.f_code.co_filename.startswith(_ASYNCIO_DIR):
+                break
+            stack.append(frame)
+            frame = frame.f_back
+        handler = None
+        for outer in reversed(stack):
+            if os.path.abspath(outer.f_code.co_filename) in self.handler_files:
+                handler = outer.f_code.co_name
+                break
+        if handler is None:
+            handler = "<loop>"
+            for outer in reversed(stack):
+                if not outer.f_code.co_filename.startswith(_ASYNCIO_DIR):
+                    handler = outer.f_code.co_name
+                    break
+        return handler, tuple(_site(inner) for inner in stack[:self.stack_depth])
+
+    def _record(self, samples, duration):
+        handlers = Counter(handler for handler, _ in samples)
+        handler = handlers.most_common(1)[0][0]
+        stacks = Counter(stack for name, stack in samples if name == handler)
+        stack = stacks.most_common(1)[0][0]
+        with self._lock:
+            offender = self._offenders.get(handler)
+            if offender is None:
+                offender = self._offenders[handler] = Offender()
+            offender.stalls += 1
+            offender.samples += len(samples)
+            offender.blocked += duration
+            if duration >= offender.longest:
+                offender.longest = duration
+                offender.stack = stack
+            offender.sites.update(stack[0] for name, stack in samples if name == handler and stack)
+        LOOP_STALLS.labels(handler).inc()
+        # Пустой стек — цикл блокирует встроенная функция, вызванная им напрямую
+        trace = "\n  ".join(stack) or "недоступен: встроенная функция"
+        logger.warning(
+            f"Цикл событий заблокирован на {duration:.2f} с в {handler} ({len(samples)} проб), стек:\n  {trace}"
+        )
@@ -0,0 +1,353 @@
+import html
+import re
+from bisect import bisect_right
+from typing import NamedTuple
+
+# Telegram считает длину сообщения в единицах UTF-16, а не в символах Python:
+# эмодзи и другие символы вне BMP занимают две единицы
+TELEGRAM_MAX_LENGTH = 4096
+
+# Форматы ответа и соответствующий parse_mode Telegram
+FORMATS = ("plain", "html", "markdownv2")
+PARSE_MODES = {"plain": None, "html": "HTML", "markdownv2": "MarkdownV2"}
+
+# Меньше этого части не делятся даже ради длинной разметки
+MIN_RENDER_LENGTH = 64
+
+LINE_BREAK_RE = re.compile(r"\n[ \t]*(\n\s*)?")
+SENTENCE_END = ".!?…;:"
+FENCE_RE = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})([^\n`]*)$", re.M)
+ENTITY_RE = re.compile(
+    r"(?P<code>`[^`\n]+`)"
+    r"|(?P<link>\[[^\]\n]+\]\([^()\s]+\))"
+    r"|(?P<header>^#{1,6}[ \t]+[^\n]+$)"
+    r"|(?P<bold>\*\*(?=\S)[^\n]+?(?<=\S)\*\*|__(?=\S)[^\n]+?(?<=\S)__)"
+    r"|(?P<strike>~~(?=\S)[^\n]+?(?<=\S)~~)"
+    r"|(?P<italic>(?<![\w*])\*(?![\s*])[^*\n]+?(?<!\s)\*(?![\w*])|(?<![\w_])_(?![\s_])[^_\n]+?(?<!\s)_(?![\w_]))",
+    re.M
+)
+LINK_RE = re.compile(r"\[([^\]\n]+)\]\(([^()\s]+)\)")
+MARKDOWNV2_SPECIAL_RE = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+
+
+def utf16_len(text):
+    """Длина текста в единицах UTF-16, как ее считает Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class Fence(NamedTuple):
+    """Блок кода в оградах ``` или ~~~ (позиции в исходном тексте)"""
+    start: int       # начало открывающей строки
+    body: int        # начало кода
+    close: int       # начало закрывающей строки
+    end: int         # конец закрывающей строки
+    opener: str      # открывающая строка, например ```python
+    marker: str      # ``` или ~~~
+
+
+def _fence_lines(text):
+    """Строки-ограды по порядку: FENCE_RE проверяется только на строках с ``` или ~~~"""
+    lines = set()
+    for char in "`~":
+        # Поиск одного символа заметно быстрее поиска подстроки в тексте с эмодзи
+        position = text.find(char)
+        while position != -1:
+            if not text.startswith(char * 3, position):
+                position = text.find(char, position + 1)
+                continue
+            line = text.rfind("\n", 0, position) + 1
+            if position - line <= 3:
+                lines.add(line)
+            position = text.find("\n", position)
+            if position == -1:
+                break
+            position = text.find(char, position)
+    for line in sorted(lines):
+        match = FENCE_RE.match(text, line)
+        if match is not None:
+            yield match
+
+
+def fence_spans(text):
+    """Блоки кода по порядку; незакрытый блок идет до конца текста"""
+    spans = []
+    opened = None
+    for match in _fence_lines(text):
+        if opened is None:
+            opened = match
+            continue
+        marker = match.group(1)
+        if marker[0] == opened.group(1)[0] and len(marker) >= len(opened.group(1)) and not match.group(2).strip():
+            spans.append(Fence(opened.start(), min(opened.end() + 1, match.start()), match.start(), match.end(),
+                               opened.group(0).strip(), opened.group(1)))
+            opened = None
+    if opened is not None:
+        spans.append(Fence(opened.start(), min(opened.end() + 1, len(text)), len(text), len(text),
+                           opened.group(0).strip(), opened.group(1)))
+    return spans
+
+
+def _fence_at(fences, starts, index):
+    """Блок кода, которому принадлежит позиция index, или None"""
+    position = bisect_right(starts, index) - 1
+    if position >= 0 and index < fences[position].end:
+        return fences[position]
+    return None
+
+
+def _rfind_outside(text, sub, lo, hi, fences, starts):
+    """Последнее вхождение sub в [lo, hi) вне блоков кода или -1"""
+    while True:
+        position = text.rfind(sub, lo, hi)
+        if position == -1:
+            return -1
+        fence = _fence_at(fences, starts, position)
+        if fence is None:
+            return position
+        hi = fence.start
+
+
+def _rfind_code_line(text, lo, hi, fences, starts):
+    """Последний перевод строки внутри кода в [lo, hi), не на строках оград: (позиция, блок)"""
+    index = bisect_right(starts, hi) - 1
+    while index >= 0 and fences[index].end > lo:
+        fence = fences[index]
+        position = text.rfind("\n", max(lo, fence.body), min(hi, fence.close - 1))
+        if position != -1:
+            return position, fence
+        index -= 1
+    return -1, None
+
+
+def _line_break(text, lo, end, code_end, fences, starts):
+    """Лучший разрыв по строкам с концом части в [lo, end]: (конец, начало следующей, блок) или None.
+
+    Абзац предпочтительнее строки, строка — строки кода; из равных берется
+    самый правый. Markdown-сущности не переходят через строку, поэтому
+    перевод строки их никогда не разрывает. Внутри блока кода конец части
+    не дальше code_end: после него нужно место для закрывающей ограды.
+    """
+    for sub in ("\n\n", "\n"):
+        cut = _rfind_outside(text, sub, lo, end + len(sub), fences, starts)
+        if cut != -1:
+            return cut, LINE_BREAK_RE.match(text, cut).end(), None
+    cut, fence = _rfind_code_line(text, lo, code_end + 1, fences, starts)
+    if cut != -1:
+        # Отступы кода значимы: следующая часть начинается сразу после перевода строки
+        return cut, cut + 1, fence
+    return None
+
+def _inline_break(text, start, end, half, fences, starts):
+    """Разрыв внутри строки на [start, end): по предложению не левее half, иначе по последнему пробелу.
+
+    Ищется с конца окна и только когда в его второй половине нет перевода
+    строки; пробелы внутри сущностей и блоков кода пропускаются.
+    """
+    entities = [match.span() for match in ENTITY_RE.finditer(text, start, end)]
+    entity_starts = [span[0] for span in entities]
+    space = None
+    position = end
+    while True:
+        position = text.rfind(" ", start + 1, position)
+        if position == -1 or (space is not None and position < half):
+            return space
+        entity = bisect_right(entity_starts, position) - 1
+        if entity >= 0 and position < entities[entity][1]:
+            position = entities[entity][0]
+            continue
+        if _fence_at(fences, starts, position) is not None:
+            continue
+        if text[position - 1] in SENTENCE_END and position >= half:
+            return position
+        if space is None:
+            space = position
+
+
+def _cuts(text, start, budget, reserve):
+    """Самые дальние позиции, до которых от start не больше budget и budget - reserve единиц UTF-16"""
+    budget = max(budget, 0)
+    window = text[start:start + budget]
+    encoded = window.encode("utf-16-le")
+    if len(encoded) == 2 * len(window):
+        end = start + len(window)
+        code_end = min(end, start + budget - reserve)
+    else:
+        # Обрезаем по единицам; половина суррогатной пары на границе отбрасывается
+        encoded = encoded[:2 * budget]
+        end = start + len(encoded.decode("utf-16-le", "ignore"))
+        units = len(encoded) // 2
+        if 0xD8 <= encoded[-1] <= 0xDB:
+            units -= 1
+        code_end = end
+        while units > budget - reserve and code_end > start:
+            code_end -= 1
+            units -= 2 if ord(text[code_end]) > 0xFFFF else 1
+    return max(end, start + 1), max(code_end, start + 1)
+
+
+def _closer(fence):
+    return "\n" + fence.marker if fence is not None else ""
+
+
+def iter_split_offsets(text, max_length):
+    """Разбивает text на части не длиннее max_length единиц UTF-16.
+
+    Генератор выдает (начало, конец, префикс, суффикс): часть сообщения —
+    префикс + text[начало:конец] + суффикс. Конец каждой части ищется с
+    конца окна обратными поисками, как в прежнем разбиении, поэтому работа
+    пропорциональна числу частей, а не строк. Режет по абзацам и строкам во
+    второй половине окна, иначе по предложениям и пробелам, иначе по
+    строкам в первой половине; Markdown-сущности (`код`, **жирный**,
+    ссылки) не разрываются. Блок кода режется, только если сам не
+    помещается в часть: тогда он закрывается суффиксом и открывается заново
+    префиксом следующей части. Текст без единой границы режется по длине.
+    """
+    fences = fence_spans(text)
+    starts = [fence.start for fence in fences]
+    reserve = max((len(fence.marker) + 1 for fence in fences), default=0)
+    start, prefix, prefix_units = 0, "", 0
+    while True:
+        budget = max_length - prefix_units
+        end, code_end = _cuts(text, start, budget, reserve)
+        # Половины окна — только порог предпочтения, их хватает посчитать в символах
+        half = min(start + max_length // 2, end)
+        inline_half = min(start + (budget - reserve) // 2, code_end)
+        if end >= len(text):
+            # Остаток помещается в часть целиком
+            break
+        point = _line_break(text, half, end, code_end, fences, starts)
+        if point is None:
+            inline = _inline_break(text, start, code_end, inline_half, fences, starts)
+            if inline is None or inline < half:
+                point = _line_break(text, start + 1, half - 1, min(code_end, half - 1), fences, starts)
+            if point is None and inline is not None:
+                point = inline, inline + 1, None
+            elif point is None:
+                point = code_end, code_end, _fence_at(fences, starts, code_end)
+        cut, resume, fence = point
+        yield start, cut, prefix, _closer(fence)
+        prefix = fence.opener + "\n" if fence is not None else ""
+        prefix_units = utf16_len(prefix)
+        start = resume
+    if start < len(text):
+        yield start, len(text), prefix, ""
+
+def split_text(text, max_length):
+    """Части сообщения в виде строк, см. iter_split_offsets"""
+    # Символов не больше единиц UTF-16: длинный текст не кодируем целиком
+    if len(text) <= max_length and utf16_len(text) <= max_length:
+        yield text
+        return
+    for start, end, prefix, suffix in iter_split_offsets(text, max_length):
+        body = text[start:end].rstrip()
+        if not prefix:
+            body = body.lstrip()
+        if body.strip():
+            yield prefix + body + suffix
+
+
+def _render(text, escape, entity, code_block):
+    """Обход разметки: блоки кода, сущности и экранирование остального текста"""
+    out = []
+    position = 0
+    for fence in fence_spans(text):
+        out.append(_render_inline(text[position:fence.start], escape, entity))
+        language = fence.opener.lstrip(" \t`~").split()
+        out.append(code_block(text[fence.body:fence.close].rstrip("\n"), language[0] if language else ""))
+        position = fence.end
+    out.append(_render_inline(text[position:], escape, entity))
+    return "".join(out)
+
+
+def _render_inline(text, escape, entity):
+    out = []
+    position = 0
+    for match in ENTITY_RE.finditer(text):
+        out.append(escape(text[position:match.start()]))
+        out.append(entity(match.lastgroup, match.group(0)))
+        position = match.end()
+    out.append(escape(text[position:]))
+    return "".join(out)
+
+
+def _entity_parts(kind, source):
+    """Содержимое сущности без Markdown-разметки"""
+    if kind == "header":
+        return source.lstrip("#").strip()
+    if kind in ("bold", "strike"):
+        return source[2:-2]
+    return source[1:-1]
+
+
+def _html_escape(text):
+    return html.escape(text, quote=False)
+
+
+def _html_entity(kind, source):
+    if kind == "code":
+        return f"<code>{_html_escape(source[1:-1])}</code>"
+    if kind == "link":
+        label, url = LINK_RE.fullmatch(source).groups()
+        return f'<a href="{html.escape(url)}">{_render_inline(label, _html_escape, _html_entity)}</a>'
+    tag = {"header": "b", "bold": "b", "strike": "s", "italic": "i"}[kind]
+    return f"<{tag}>{_render_inline(_entity_parts(kind, source), _html_escape, _html_entity)}</{tag}>"
+
+
+def _html_code_block(code, language):
+    if language:
+        return f'<pre><code class="language-{html.escape(language)}">{_html_escape(code)}</code></pre>'
+    return f"<pre>{_html_escape(code)}</pre>"
+
+
+def escape_markdown_v2(text):
+    """Экранирует все спецсимволы MarkdownV2"""
+    return MARKDOWNV2_SPECIAL_RE.sub(r"\\\1", text)
+
+
+def _markdown_v2_code(text):
+    return text.replace("\\", "\\\\").replace("`", "\\`")
+
+
+def _markdown_v2_entity(kind, source):
+    if kind == "code":
+        return f"`{_markdown_v2_code(source[1:-1])}`"
+    if kind == "link":
+        label, url = LINK_RE.fullmatch(source).groups()
+        url = url.replace("\\", "\\\\").replace(")", "\\)")
+        return f"[{_render_inline(label, escape_markdown_v2, _markdown_v2_entity)}]({url})"
+    mark = {"header": "*", "bold": "*", "strike": "~", "italic": "_"}[kind]
+    return f"{mark}{_render_inline(_entity_parts(kind, source), escape_markdown_v2, _markdown_v2_entity)}{mark}"
+
+
+def _markdown_v2_code_block(code, language):
+    return f"```{language}\n{_markdown_v2_code(code)}\n```"
+
+
+def render(text, fmt):
+    """Переводит Markdown ответа нейросети в разметку Telegram для формата fmt"""
+    if fmt == "html":
+        return _render(text, _html_escape, _html_entity, _html_code_block)
+    if fmt == "markdownv2":
+        return _render(text, escape_markdown_v2, _markdown_v2_entity, _markdown_v2_code_block)
+    return text
+
+
+def split_message(text, max_length, fmt="plain"):
+    """Части для отправки с parse_mode из PARSE_MODES[fmt]: пары (исходник, разметка).
+
+    Разметка длиннее исходника (теги, экранирование), поэтому часть, которая
+    после рендера не помещается в max_length, делится мельче. Исходник
+    нужен, чтобы при ошибке разбора отправить часть без форматирования.
+    """
+    yield from _split_rendered(text, max_length, max_length, fmt)
+
+
+def _split_rendered(text, limit, max_length, fmt):
+    for part in split_text(text, limit):
+        rendered = render(part, fmt)
+        size = utf16_len(rendered)
+        if size <= max_length or limit <= MIN_RENDER_LENGTH:
+            yield part, rendered
+            continue
+        smaller = max(MIN_RENDER_LENGTH, min(limit, utf16_len(part)) * max_length // size - 1)
+        yield from _split_rendered(part, smaller, max_length, fmt)
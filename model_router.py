@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from collections.abc import Mapping
+
+from metrics import registry
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+HEDGES = registry.counter("bot_llm_hedges_total", "Дублирующие запросы к запасной модели", ["outcome"])
+FALLBACKS = registry.counter("bot_llm_fallbacks_total", "Переходы на следующую модель после ошибки", ["model"])
+
+
+class NoVisionModelError(Exception):
+    """Запрос с изображением, а ни одна модель из конфига не поддерживает vision"""
+
+
+def normalize_models(models, default_model, default_timeout):
+    """Приводит список моделей из конфига к словарям name/timeout/vision.
+
+    Элемент списка — строка с именем модели или словарь. Если список пуст,
+    используется одна модель из параметра model, она же обрабатывает изображения.
+    """
+    if not models:
+        return [{"name": default_model, "timeout": default_timeout, "vision": True}]
+    normalized = []
+    for model in models:
+        if isinstance(model, str):
+            model = {"name": model}
+        normalized.append({
+            "name": model["name"],
+            "timeout": model.get("timeout", default_timeout),
+            "vision": model.get("vision", False),
+        })
+    return normalized
+
+
+def models_error(models):
+    """Описание ошибки в списке моделей из конфига или None"""
+    for model in models:
+        if isinstance(model, str):
+            continue
+        if not isinstance(model, Mapping) or not isinstance(model.get("name"), str):
+            return "каждая модель — строка или объект с полем name"
+        if not isinstance(model.get("timeout", 0), (int, float)) or model.get("timeout", 1) <= 0:
+            return f"timeout модели {model['name']} должен быть положительным числом"
+    return None
+
+
+class _ModelStats:
+    """Задержки и ошибки модели за последние window_seconds"""
+
+    def __init__(self, window_size, window_seconds):
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=window_size)
+
+    def record(self, latency, ok):
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _prune(self):
+        horizon = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < horizon:
+            self.samples.popleft()
+
+    def error_rate(self):
+        self._prune()
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+    def median_latency(self):
+        self._prune()
+        latencies = [latency for _, latency, ok in self.samples if ok]
+        return statistics.median(latencies) if latencies else None
+
+    def __len__(self):
+        self._prune()
+        return len(self.samples)
+
+
+class ModelRouter:
+    """Выбор модели нейросети с запасными вариантами и хеджированием.
+
+    Модели перебираются в порядке из конфига, но модели с долей ошибок выше
+    max_error_rate (при хотя бы min_samples запросах) уходят в конец очереди.
+    Если основная модель не ответила за hedge_after секунд, параллельно
+    запускается запрос к самой быстрой из запасных, и берется первый
+    успешный ответ. При ошибке запрос повторяется на следующей модели.
+    Запросы с изображениями идут только к моделям с vision; если таких нет,
+    бросается NoVisionModelError. Модели с разомкнутым выключателем клиента
+    считаются неисправными.
+    """
+
+    def __init__(self, client, models, hedge_after=0.0, max_error_rate=0.5, min_samples=5,
+                 window_size=50, window_seconds=300):
+        self.client = client
+        self.models = models
+        self.hedge_after = hedge_after
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self._stats = {model["name"]: _ModelStats(window_size, window_seconds) for model in models}
+
+    def configure(self, models, hedge_after):
+        """Новый список моделей; статистика оставшихся моделей сохраняется"""
+        # Пустая статистика ложна по len, поэтому без "or": начатые запросы пишут в тот же объект
+        self._stats = {model["name"]: self._stats_of(model) for model in models}
+        self.models = models
+        self.hedge_after = hedge_after
+
+    def _stats_of(self, model):
+        """Статистика модели для начатого запроса.
+
+        Перезагрузка конфига может убрать модель, пока запрос к ней идет;
+        тогда результат пишется в отдельный объект и просто теряется.
+        """
+        stats = self._stats.get(model["name"])
+        return stats if stats is not None else _ModelStats(self.window_size, self.window_seconds)
+
+    def _healthy(self, model):
+        if not self.client.available(model["name"]):
+            return False
+        stats = self._stats[model["name"]]
+        return len(stats) < self.min_samples or stats.error_rate() < self.max_error_rate
+
+    def available(self, vision=False):
+        """Есть ли модель, которая сейчас примет запрос"""
+        return any(self.client.available(model["name"]) for model in self.candidates(vision))
+
+    def supports_images(self):
+        """Есть ли в конфиге модель с vision"""
+        return any(model["vision"] for model in self.models)
+
+    def candidates(self, vision=False):
+        """Модели в порядке попыток; для изображений — только модели с vision"""
+        models = [model for model in self.models if model["vision"]] if vision else list(self.models)
+        return sorted(models, key=lambda model: not self._healthy(model))
+
+    def _hedge_target(self, candidates):
+        """Самая быстрая из исправных запасных моделей"""
+        fallbacks = [model for model in candidates[1:] if self._healthy(model)]
+        if not fallbacks:
+            return None
+        return min(fallbacks, key=lambda model: self._stats[model["name"]].median_latency() or float("inf"))
+
+    async def _attempt(self, model, messages, kwargs):
+        stats = self._stats_of(model)
+        started = time.perf_counter()
+        try:
+            completion = await self.client.complete(
+                messages, model=model["name"], timeout=model["timeout"], **kwargs
+            )
+        except (asyncio.CancelledError, CircuitOpenError):
+            # Отказ выключателя — не ответ модели, в статистику не попадает
+            raise
+        except Exception:
+            stats.record(time.perf_counter() - started, False)
+            raise
+        stats.record(time.perf_counter() - started, True)
+        return completion
+
+    async def complete(self, messages, vision=False, **kwargs):
+        """Ответ первой успешно ответившей модели: (completion, имя модели)"""
+        candidates = self.candidates(vision)
+        if not candidates:
+            # Текстовая модель отклонит изображение или ответит наугад
+            raise NoVisionModelError("нет моделей с поддержкой изображений")
+        primary = candidates[0]
+        hedge = self._hedge_target(candidates) if self.hedge_after else None
+        try:
+            if hedge is None:
+                return await self._attempt(primary, messages, kwargs), primary["name"]
+            return await self._hedged(primary, hedge, messages, kwargs)
+        except Exception as e:
+            last_error = e
+
+        # Запасную модель, которая уже участвовала в хеджировании, повторно не пробуем
+        for model in candidates[1:]:
+            if model is hedge:
+                continue
+            FALLBACKS.labels(model["name"]).inc()
+            logger.warning(f"Переход на модель {model['name']} после ошибки: {last_error}")
+            try:
+                return await self._attempt(model, messages, kwargs), model["name"]
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    async def _hedged(self, primary, hedge, messages, kwargs):
+        """Основной запрос и дублирующий к запасной модели после hedge_after секунд"""
+        primary_task = asyncio.create_task(self._attempt(primary, messages, kwargs))
+        tasks = {primary_task: primary}
+        try:
+            await asyncio.wait([primary_task], timeout=self.hedge_after)
+            # Запасная модель подключается, если основная медлит или уже упала
+            if not primary_task.done() or primary_task.exception() is not None:
+                HEDGES.labels("launched").inc()
+                tasks[asyncio.create_task(self._attempt(hedge, messages, kwargs))] = hedge
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if tasks[task] is hedge:
+                            HEDGES.labels("won").inc()
+                        return task.result(), tasks[task]["name"]
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, messages, **kwargs):
+        """Потоковый ответ; на следующую модель переходим, только пока ничего не отдано"""
+        candidates = self.candidates()
+        for position, model in enumerate(candidates):
+            stats = self._stats_of(model)
+            started = time.perf_counter()
+            produced = False
+            try:
+                deltas = self.client.stream(messages, model=model["name"], timeout=model["timeout"], **kwargs)
+                async for delta in deltas:
+                    produced = True
+                    yield delta
+            except Exception as e:
+                if not isinstance(e, CircuitOpenError):
+                    stats.record(time.perf_counter() - started, False)
+                if produced or position == len(candidates) - 1:
+                    raise
+                FALLBACKS.labels(candidates[position + 1]["name"]).inc()
+                logger.warning(f"Модель {model['name']} не ответила ({e}), пробуем следующую")
+                continue
+            stats.record(time.perf_counter() - started, True)
+            return
+
+    def stats(self):
+        """Доля ошибок и медианная задержка по моделям"""
+        return {
+            model["name"]: {
+                "requests": len(self._stats[model["name"]]),
+                "error_rate": round(self._stats[model["name"]].error_rate(), 3),
+                "median_latency": self._stats[model["name"]].median_latency(),
+            }
+            for model in self.models
+        }
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("daily", "token_bucket", "sliding_window")
+
+
+class LimitResult(NamedTuple):
+    """Результат проверки лимита"""
+    allowed: bool
+    count: int
+    reason: Optional[str] = None  # "daily", "rate" или "tokens" (квота), если запрос отклонен
+    retry_after: float = 0.0
+
+
+class _UserState:
+    __slots__ = ("day", "count", "tokens", "refilled_at", "recent")
+
+    def __init__(self, day, count=0):
+        self.day = day
+        self.count = count
+        self.tokens = None
+        self.refilled_at = 0.0
+        self.recent = None
+
+
+def today_str():
+    return datetime.now().date().strftime('%Y-%m-%d')
+
+
+class RateLimiter:
+    """Лимиты сообщений пользователей в памяти.
+
+    Проверка и увеличение счетчика выполняются одним синхронным вызовом без
+    await, поэтому параллельные обработчики одного пользователя не могут
+    вместе проскочить лимит. Дневной счетчик сбрасывается лениво при первом
+    сообщении в новый день, а в базу счетчики сохраняются пачкой раз в
+    persist_interval секунд.
+
+    Кроме дневной квоты можно включить ограничение частоты:
+    token_bucket (burst сообщений подряд, пополнение refill_per_minute в минуту)
+    или sliding_window (не больше window_max сообщений за window_seconds).
+    """
+
+    def __init__(self, storage, max_per_day, policy="daily", burst=5, refill_per_minute=10,
+                 window_seconds=60, window_max=10, persist_interval=30):
+        if policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика лимитов: {policy}")
+        self.storage = storage
+        self.max_per_day = max_per_day
+        self.policy = policy
+        self.burst = burst
+        self.refill_per_minute = refill_per_minute
+        self.window_seconds = window_seconds
+        self.window_max = window_max
+        self.persist_interval = persist_interval
+        self._users = {}
+        self._dirty = set()
+        self._task = None
+
+    def check(self, user_id):
+        """Проверяет лимиты и, если запрос разрешен, учитывает его"""
+        today = today_str()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(today)
+        elif state.day != today:
+            state.day = today
+            state.count = 0
+
+        if state.count >= self.max_per_day:
+            return LimitResult(False, state.count, "daily")
+
+        now = time.monotonic()
+        if self.policy == "token_bucket":
+            retry_after = self._take_token(state, now)
+        elif self.policy == "sliding_window":
+            retry_after = self._take_slot(state, now)
+        else:
+            retry_after = 0.0
+        if retry_after:
+            return LimitResult(False, state.count, "rate", retry_after)
+
+        state.count += 1
+        self._dirty.add(user_id)
+        return LimitResult(True, state.count)
+
+    def usage(self, user_id):
+        """(счетчик, дата) за сегодня или None, если сообщений сегодня не было"""
+        state = self._users.get(user_id)
+        if state is None or state.day != today_str() or state.count == 0:
+            return None
+        return state.count, state.day
+
+    def _take_token(self, state, now):
+        refill_rate = self.refill_per_minute / 60
+        if state.tokens is None:
+            state.tokens = float(self.burst)
+        else:
+            state.tokens = min(self.burst, state.tokens + (now - state.refilled_at) * refill_rate)
+        state.refilled_at = now
+        if state.tokens < 1:
+            return (1 - state.tokens) / refill_rate if refill_rate else self.window_seconds
+        state.tokens -= 1
+        return 0.0
+
+    def _take_slot(self, state, now):
+        if state.recent is None:
+            state.recent = deque()
+        while state.recent and now - state.recent[0] >= self.window_seconds:
+            state.recent.popleft()
+        if len(state.recent) >= self.window_max:
+            return self.window_seconds - (now - state.recent[0])
+        state.recent.append(now)
+        return 0.0
+
+    async def load(self):
+        """Загружает сегодняшние счетчики из базы"""
+        today = today_str()
+        rows = await self.storage.load_limits(today)
+        for user_id, message_count in rows:
+            self._users[user_id] = _UserState(today, message_count)
+        logger.info(f"Загружено счетчиков лимитов за сегодня: {len(rows)}")
+
+    async def persist(self):
+        """Сохраняет измененные счетчики одним UPSERT"""
+        if not self._dirty:
+            return
+        user_ids, self._dirty = self._dirty, set()
+        rows = [(user_id, self._users[user_id].count, self._users[user_id].day) for user_id in user_ids]
+        try:
+            await self.storage.save_limits(rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения лимитов: {e}")
+            self._dirty |= user_ids
+            return
+        self._forget_stale()
+
+    def _forget_stale(self):
+        """Убирает из памяти пользователей, не писавших сегодня"""
+        today = today_str()
+        now = time.monotonic()
+        stale = [
+            user_id for user_id, state in self._users.items()
+            if state.day != today and user_id not in self._dirty
+            and (state.recent is None or not state.recent or now - state.recent[-1] >= self.window_seconds)
+        ]
+        for user_id in stale:
+            del self._users[user_id]
+
+    def start(self):
+        """Запускает периодическое сохранение счетчиков"""
+        self._task = asyncio.create_task(self._persist_loop())
+
+    async def stop(self):
+        """Останавливает сохранение и записывает последние изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.persist()
+
+    async def _persist_loop(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.persist()
@@ -0,0 +1,266 @@
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+from metrics import timed
+from storage import DB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # Redis нужен только при state_backend = "redis"
+    redis = None
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+
+# Сырые события расхода в Redis хранятся ограниченным списком
+USAGE_EVENTS_KEEP = 100000
+# Часовые сводки нужны только для отчета за последние сутки
+USAGE_HOUR_TTL = 31 * 24 * 3600
+USAGE_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "latency_sum")
+
+
+class RedisStorage:
+    """Хранилище бота в Redis с тем же асинхронным интерфейсом, что и Storage.
+
+    Позволяет нескольким процессам бота работать с общим состоянием.
+    Ключи:
+      {prefix}:history:seq          счетчик id сообщений
+      {prefix}:history:{user_id}    список JSON-записей истории, от старых к новым
+      {prefix}:limits               хеш user_id -> [счетчик, дата]
+      {prefix}:responses            хеш ключ -> JSON-строка кэша ответов
+      {prefix}:responses:created    sorted set ключей кэша по времени создания
+      {prefix}:summary:{user_id}    краткое содержание разговора
+      {prefix}:usage:events         последние события расхода нейросети (JSON)
+      {prefix}:usage:day:{day}      хеш "user_id|модель|поле" -> сумма за день
+      {prefix}:usage:hour:{hour}    хеш "модель|поле" -> сумма за час
+      {prefix}:usage:user:{user_id} хеш итогов пользователя за все время
+    """
+
+    def __init__(self, url=DEFAULT_REDIS_URL, prefix="bot", client=None):
+        self.url = url
+        self.prefix = prefix
+        self._client = client
+
+    def _key(self, *parts):
+        return ":".join((self.prefix, *map(str, parts)))
+
+    def open(self):
+        """Создает клиент; соединения открываются при первом запросе"""
+        if self._client is not None:
+            return
+        if redis is None:
+            raise RuntimeError("Для state_backend = \"redis\" установите пакет redis")
+        self._client = redis.from_url(self.url, decode_responses=True)
+
+    async def close(self):
+        """Закрывает соединения с Redis"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @timed(DB_SECONDS, "get_history")
+    async def get_history(self, user_id, limit):
+        """Последние limit сообщений пользователя, от новых к старым"""
+        if limit <= 0:
+            return []
+        items = await self._client.lrange(self._key("history", user_id), -limit, -1)
+        history = []
+        for item in reversed(items):
+            record = json.loads(item)
+            history.append({"text": record["text"], "type": record["type"], "timestamp": record["timestamp"]})
+        return history
+
+    @timed(DB_SECONDS, "insert_messages")
+    async def insert_messages(self, rows):
+        """Записывает пачку (user_id, текст, тип, время) одним конвейером"""
+        if not rows:
+            return
+        # id выдаются одним INCRBY на всю пачку
+        last_id = await self._client.incrby(self._key("history", "seq"), len(rows))
+        first_id = last_id - len(rows) + 1
+        async with self._client.pipeline(transaction=False) as pipe:
+            for offset, (user_id, text, message_type, timestamp) in enumerate(rows):
+                record = {"id": first_id + offset, "text": text, "type": message_type, "timestamp": timestamp}
+                pipe.rpush(self._key("history", user_id), json.dumps(record, ensure_ascii=False))
+            await pipe.execute()
+
+    @timed(DB_SECONDS, "prune_history")
+    async def prune_history(self, user_ids, memory_size):
+        """Удаляет у пользователей сообщения сверх memory_size, возвращает число удаленных"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+        async with self._client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.llen(self._key("history", user_id))
+                pipe.ltrim(self._key("history", user_id), -memory_size, -1)
+            results = await pipe.execute()
+        return sum(max(0, length - memory_size) for length in results[::2])
+
+    @timed(DB_SECONDS, "get_limits")
+    async def get_limits(self, user_id):
+        """Счетчик и дата последнего сброса пользователя или None"""
+        value = await self._client.hget(self._key("limits"), user_id)
+        return tuple(json.loads(value)) if value else None
+
+    @timed(DB_SECONDS, "load_limits")
+    async def load_limits(self, day):
+        """Счетчики (user_id, message_count) всех пользователей за день"""
+        values = await self._client.hgetall(self._key("limits"))
+        rows = []
+        for user_id, value in values.items():
+            message_count, last_reset_date = json.loads(value)
+            if last_reset_date == day:
+                rows.append((int(user_id), message_count))
+        return rows
+
+    @timed(DB_SECONDS, "save_limits")
+    async def save_limits(self, rows):
+        """Сохраняет пачку (user_id, счетчик, дата) одним HSET"""
+        if rows:
+            mapping = {user_id: json.dumps([count, day]) for user_id, count, day in rows}
+            await self._client.hset(self._key("limits"), mapping=mapping)
+
+    @timed(DB_SECONDS, "load_cached_responses")
+    async def load_cached_responses(self, min_created_at, limit):
+        """Неистекшие записи кэша ответов, недавно использованные первыми"""
+        keys = await self._client.zrangebyscore(self._key("responses", "created"), f"({min_created_at}", "+inf")
+        if not keys:
+            return []
+        values = await self._client.hmget(self._key("responses"), keys)
+        rows = [tuple(json.loads(value)) for value in values if value]
+        rows.sort(key=lambda row: row[8], reverse=True)
+        return rows[:limit]
+
+    @timed(DB_SECONDS, "save_cached_responses")
+    async def save_cached_responses(self, rows, deleted_keys, expire_before):
+        """Сохраняет и удаляет записи кэша ответов одной транзакцией"""
+        created_key = self._key("responses", "created")
+        expired = await self._client.zrangebyscore(created_key, "-inf", expire_before)
+        async with self._client.pipeline(transaction=True) as pipe:
+            if rows:
+                pipe.hset(self._key("responses"), mapping={
+                    row[0]: json.dumps(row, ensure_ascii=False) for row in rows
+                })
+                pipe.zadd(created_key, {row[0]: row[7] for row in rows})
+            removed = set(deleted_keys) | set(expired)
+            if removed:
+                pipe.hdel(self._key("responses"), *removed)
+                pipe.zrem(created_key, *removed)
+            await pipe.execute()
+
+    @timed(DB_SECONDS, "get_history_rows")
+    async def get_history_rows(self, user_id):
+        """Вся история пользователя с id, от старых к новым"""
+        items = await self._client.lrange(self._key("history", user_id), 0, -1)
+        rows = []
+        for item in items:
+            record = json.loads(item)
+            rows.append((record["id"], record["text"], record["type"], record["timestamp"]))
+        return rows
+
+    @timed(DB_SECONDS, "get_summary")
+    async def get_summary(self, user_id):
+        """Сохраненное краткое содержание разговора или None"""
+        return await self._client.get(self._key("summary", user_id))
+
+    @timed(DB_SECONDS, "save_summary")
+    async def save_summary(self, user_id, summary, last_summarized_id):
+        """Сохраняет краткое содержание и удаляет вошедшие в него сообщения"""
+        history_key = self._key("history", user_id)
+        async with self._client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # Список могут обрезать параллельно, поэтому считаем
+                    # удаляемые записи под WATCH и повторяем при изменении
+                    await pipe.watch(history_key)
+                    items = await pipe.lrange(history_key, 0, -1)
+                    folded = sum(1 for item in items if json.loads(item)["id"] <= last_summarized_id)
+                    pipe.multi()
+                    pipe.set(self._key("summary", user_id), summary)
+                    if folded:
+                        pipe.ltrim(history_key, folded, -1)
+                    await pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    @timed(DB_SECONDS, "save_usage")
+    async def save_usage(self, events, daily, hourly, totals):
+        """Записывает события расхода и приращения сводок одной транзакцией"""
+        events_key = self._key("usage", "events")
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.rpush(events_key, *(json.dumps(event) for event in events))
+            pipe.ltrim(events_key, -USAGE_EVENTS_KEEP, -1)
+            for day, user_id, model, *values in daily:
+                for field, value in zip(USAGE_FIELDS, values):
+                    key = self._key("usage", "day", day)
+                    if isinstance(value, float):
+                        pipe.hincrbyfloat(key, f"{user_id}|{model}|{field}", value)
+                    else:
+                        pipe.hincrby(key, f"{user_id}|{model}|{field}", value)
+            for hour, model, *values in hourly:
+                key = self._key("usage", "hour", hour.replace(" ", "T"))
+                for field, value in zip(USAGE_FIELDS, values):
+                    if isinstance(value, float):
+                        pipe.hincrbyfloat(key, f"{model}|{field}", value)
+                    else:
+                        pipe.hincrby(key, f"{model}|{field}", value)
+                pipe.expire(key, USAGE_HOUR_TTL)
+            for user_id, *values, last_day in totals:
+                key = self._key("usage", "user", user_id)
+                for field, value in zip(USAGE_FIELDS, values):
+                    pipe.hincrby(key, field, value)
+                pipe.hsetnx(key, "first_day", last_day)
+                pipe.hset(key, "last_day", last_day)
+            await pipe.execute()
+
+    @timed(DB_SECONDS, "load_usage_day")
+    async def load_usage_day(self, day):
+        """Расход (user_id, запросы, токены запроса, токены ответа) всех пользователей за день"""
+        values = await self._client.hgetall(self._key("usage", "day", day))
+        users = {}
+        for field, value in values.items():
+            user_id = field.split("|", 1)[0]
+            name = field.rsplit("|", 1)[1]
+            if name in USAGE_FIELDS[:3]:
+                row = users.setdefault(int(user_id), [0, 0, 0])
+                row[USAGE_FIELDS.index(name)] += int(value)
+        return [(user_id, *row) for user_id, row in users.items()]
+
+    @timed(DB_SECONDS, "load_usage_hours")
+    async def load_usage_hours(self, since):
+        """Часовые сводки по моделям начиная с часа since ("ГГГГ-ММ-ДД ЧЧ")"""
+        hour = datetime.strptime(since, "%Y-%m-%d %H").replace(tzinfo=timezone.utc)
+        hours = []
+        while hour <= datetime.now(timezone.utc):
+            hours.append(hour.strftime("%Y-%m-%d %H"))
+            hour += timedelta(hours=1)
+        async with self._client.pipeline(transaction=False) as pipe:
+            for name in hours:
+                pipe.hgetall(self._key("usage", "hour", name.replace(" ", "T")))
+            results = await pipe.execute()
+        rows = []
+        for name, values in zip(hours, results):
+            models = {}
+            for field, value in values.items():
+                model, field_name = field.rsplit("|", 1)
+                models.setdefault(model, {})[field_name] = value
+            for model, fields in sorted(models.items()):
+                rows.append((
+                    name, model, *(int(fields.get(field, 0)) for field in USAGE_FIELDS[:3]),
+                    float(fields.get("latency_sum", 0.0))
+                ))
+        return rows
+
+    @timed(DB_SECONDS, "get_usage_totals")
+    async def get_usage_totals(self, user_id):
+        """Расход пользователя за все время и первый день или None"""
+        values = await self._client.hmget(
+            self._key("usage", "user", user_id), "requests", "prompt_tokens", "completion_tokens", "first_day"
+        )
+        if values[0] is None:
+            return None
+        return int(values[0]), int(values[1] or 0), int(values[2] or 0), values[3]
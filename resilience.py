@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from openai import APIConnectionError, APIStatusError
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Числовое состояние для метрики: 0 — работает, 1 — проверка, 2 — разомкнут
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+TRANSITIONS = registry.counter(
+    "bot_circuit_transitions_total", "Переходы автоматических выключателей", ["name", "state"]
+)
+REJECTED = registry.counter(
+    "bot_circuit_rejected_total", "Запросы, отклоненные разомкнутым выключателем", ["name"]
+)
+RETRIES = registry.counter("bot_llm_retries_total", "Повторы запросов к нейросети", ["model", "reason"])
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = (408, 409, 429)
+
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут: запрос отклонен без обращения к API"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} временно недоступен, повтор через {retry_in:.0f} с")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def failure_reason(error):
+    """Причина временного сбоя или None, если повтор не поможет.
+
+    Ошибки запроса (400, 401, 404 и т.п.) повторять бессмысленно, и они не
+    говорят о недоступности API, поэтому выключатель их не учитывает.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return "deadline"
+    if isinstance(error, APIStatusError):
+        if error.status_code in RETRYABLE_STATUSES or error.status_code >= 500:
+            return str(error.status_code)
+        return None
+    if isinstance(error, APIConnectionError):
+        # APITimeoutError наследуется от APIConnectionError
+        return "timeout" if "timeout" in type(error).__name__.lower() else "connection"
+    return None
+
+
+def retry_after_header(error):
+    """Пауза из заголовка Retry-After ответа 429/503, если она указана"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Ограниченные повторы с экспоненциальной паузой и полным джиттером.
+
+    Пауза перед повтором n — случайная величина от 0 до
+    min(max_delay, base_delay * 2^n), чтобы после общего сбоя запросы не
+    возвращались к API одной волной. Если API просит подождать дольше
+    max_delay, запрос не повторяется.
+    """
+
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error):
+        """Пауза перед повтором или None, если повторять не нужно"""
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_header(error)
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для вызовов внешнего API.
+
+    Размыкается, когда среди последних window_size запросов не меньше
+    failure_threshold временных сбоев и они составляют не меньше
+    failure_ratio (пока запросов меньше половины окна, доля считается от
+    половины окна). Порог — только нижняя граница: при окне 50 и доле 0.5
+    нужно не меньше 13 сбоев, а для размыкания ровно после failure_threshold
+    сбоев подряд окно должно быть не больше 2 * failure_threshold, а доля —
+    не больше 1. Одиночные сбои нестабильного провайдера при этом
+    остаются делом повторов. Разомкнутый выключатель reset_timeout секунд
+    сразу отвечает CircuitOpenError, не занимая соединения и место в
+    очереди, затем пропускает half_open_max_calls пробных запросов:
+    успех замыкает выключатель, сбой снова размыкает.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, failure_ratio=0.5,
+                 window_size=50, half_open_max_calls=1):
+        self.name = name
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._outcomes = deque()
+        self._probes = 0
+        self.configure(failure_threshold, reset_timeout, failure_ratio, window_size)
+
+    def configure(self, failure_threshold, reset_timeout, failure_ratio, window_size):
+        """Новые пороги; последние исходы запросов сохраняются в новом окне"""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self._outcomes = deque(self._outcomes, maxlen=int(max(window_size, failure_threshold)))
+
+    @property
+    def failures(self):
+        return self._outcomes.count(False)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        logger.warning(f"Выключатель {self.name}: {self.state} -> {state}")
+        self.state = state
+        TRANSITIONS.labels(self.name, state).inc()
+
+    def retry_in(self):
+        """Сколько секунд осталось до пробного запроса"""
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def check(self):
+        """Быстрая проверка до постановки в очередь, ничего не меняет"""
+        if self.state == OPEN and self.retry_in() > 0:
+            REJECTED.labels(self.name).inc()
+            raise CircuitOpenError(self.name, self.retry_in())
+
+    def before_call(self):
+        """Разрешение на запрос; вызывается непосредственно перед обращением к API"""
+        if self.state == OPEN:
+            if self.retry_in() > 0:
+                REJECTED.labels(self.name).inc()
+                raise CircuitOpenError(self.name, self.retry_in())
+            self._set_state(HALF_OPEN)
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_max_calls:
+                REJECTED.labels(self.name).inc()
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probes += 1
+
+    def record_success(self):
+        # Запросы, начатые до размыкания, не замыкают выключатель: это делает только проба
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN:
+            self._outcomes.clear()
+        self._outcomes.append(True)
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        if self.state == OPEN:
+            return
+        self._outcomes.append(False)
+        failures = self.failures
+        sample = max(len(self._outcomes), self._outcomes.maxlen // 2)
+        if self.state == HALF_OPEN or (
+            failures >= self.failure_threshold and failures >= self.failure_ratio * sample
+        ):
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self):
+        """Запрос завершился без вывода о здоровье API (например, ошибка 400)"""
+        if self.state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
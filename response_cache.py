@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import math
+import re
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DIM = 1024
+NGRAM_SIZE = 3
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    """Нормализация запроса: регистр, пунктуация и лишние пробелы не важны"""
+    text = _PUNCTUATION.sub(" ", text.lower().replace("ё", "е"))
+    return _SPACES.sub(" ", text).strip()
+
+
+def ngram_vector(text, dim=VECTOR_DIM, n=NGRAM_SIZE):
+    """Разреженный вектор хешированных символьных n-грамм, нормированный по длине"""
+    padded = f" {text} "
+    vector = {}
+    for i in range(max(1, len(padded) - n + 1)):
+        index = zlib.crc32(padded[i:i + n].encode("utf-8")) % dim
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    return {index: value / norm for index, value in vector.items()}
+
+
+def cosine_similarity(a, b):
+    """Косинусная близость нормированных разреженных векторов"""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+
+def context_hash(*parts):
+    """Хеш контекста запроса (системный промпт, история и т.п.)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:32]
+
+
+class _Entry:
+    __slots__ = ("key", "model", "context", "prompt", "response", "tokens", "hits",
+                 "created_at", "last_used", "vector")
+
+    def __init__(self, key, model, context, prompt, response, tokens, hits, created_at, last_used):
+        self.key = key
+        self.model = model
+        self.context = context
+        self.prompt = prompt
+        self.response = response
+        self.tokens = tokens
+        self.hits = hits
+        self.created_at = created_at
+        self.last_used = last_used
+        self.vector = None
+
+    def row(self):
+        return (self.key, self.model, self.context, self.prompt, self.response,
+                self.tokens, self.hits, self.created_at, self.last_used)
+
+
+class ResponseCache:
+    """Кэш ответов нейросети на повторяющиеся запросы.
+
+    Ключ точного уровня строится из нормализованного запроса, модели и хеша
+    контекста. Если задан similarity_threshold, при промахе ищется похожий
+    запрос с тем же контекстом по косинусной близости векторов n-грамм.
+    Записи живут ttl секунд, при превышении max_entries вытесняются давно
+    не использованные, а изменения пачкой сохраняются в SQLite.
+    """
+
+    def __init__(self, storage, ttl=86400, max_entries=5000, similarity_threshold=0.0,
+                 max_prompt_length=300, flush_interval=30):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.max_prompt_length = max_prompt_length
+        self.flush_interval = flush_interval
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._entries = {}
+        self._buckets = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._task = None
+
+    def cacheable(self, prompt):
+        """Кэшируются только короткие запросы: длинные почти не повторяются"""
+        return len(prompt) <= self.max_prompt_length
+
+    def lookup(self, prompt, model, context):
+        """Ответ из кэша или None"""
+        if not self.cacheable(prompt):
+            return None
+        now = time.time()
+        normalized = normalize_prompt(prompt)
+        entry = self._entries.get(self._key(normalized, model, context))
+        if entry is not None and now - entry.created_at > self.ttl:
+            self._remove(entry)
+            entry = None
+        if entry is not None:
+            self.exact_hits += 1
+        elif self.similarity_threshold > 0:
+            entry = self._find_similar(normalized, model, context, now)
+            if entry is not None:
+                self.similar_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+
+        entry.hits += 1
+        entry.last_used = now
+        self.tokens_saved += entry.tokens
+        self._dirty.add(entry.key)
+        return entry.response
+
+    def store(self, prompt, model, context, response, tokens=0):
+        """Сохраняет ответ в кэш"""
+        if not self.cacheable(prompt):
+            return
+        now = time.time()
+        normalized = normalize_prompt(prompt)
+        key = self._key(normalized, model, context)
+        old = self._entries.get(key)
+        if old is not None:
+            self._remove(old)
+        self._add(_Entry(key, model, context, normalized, response, tokens or 0, 0, now, now))
+        self._deleted.discard(key)
+        self._dirty.add(key)
+        self._shrink()
+
+    def stats(self):
+        """Счетчики кэша"""
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
+
+    def _key(self, normalized, model, context):
+        return context_hash(normalized, model, context)
+
+    def _find_similar(self, normalized, model, context, now):
+        vector = ngram_vector(normalized)
+        best, best_score = None, self.similarity_threshold
+        for entry in self._buckets.get((model, context), {}).values():
+            if now - entry.created_at > self.ttl:
+                continue
+            if entry.vector is None:
+                entry.vector = ngram_vector(entry.prompt)
+            score = cosine_similarity(vector, entry.vector)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def _add(self, entry):
+        self._entries[entry.key] = entry
+        self._buckets.setdefault((entry.model, entry.context), {})[entry.key] = entry
+
+    def _remove(self, entry):
+        self._entries.pop(entry.key, None)
+        bucket = self._buckets.get((entry.model, entry.context))
+        if bucket is not None:
+            bucket.pop(entry.key, None)
+            if not bucket:
+                del self._buckets[(entry.model, entry.context)]
+        self._dirty.discard(entry.key)
+        self._deleted.add(entry.key)
+
+    def _shrink(self):
+        """Вытесняет давно не использованные записи сверх max_entries"""
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        # Вытесняем с запасом, чтобы не сортировать кэш на каждой вставке
+        excess += self.max_entries // 10
+        for entry in sorted(self._entries.values(), key=lambda e: e.last_used)[:excess]:
+            self._remove(entry)
+
+    async def load(self):
+        """Загружает из базы неистекшие записи"""
+        rows = await self.storage.load_cached_responses(time.time() - self.ttl, self.max_entries)
+        for row in rows:
+            self._add(_Entry(*row))
+        logger.info(f"Загружено ответов в кэш: {len(rows)}")
+
+    async def flush(self):
+        """Сохраняет изменения кэша в базу"""
+        if not self._dirty and not self._deleted:
+            return
+        rows = [self._entries[key].row() for key in self._dirty if key in self._entries]
+        deleted = list(self._deleted)
+        self._dirty, self._deleted = set(), set()
+        try:
+            await self.storage.save_cached_responses(rows, deleted, time.time() - self.ttl)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша ответов: {e}")
+            self._dirty |= {row[0] for row in rows}
+            self._deleted |= set(deleted)
+
+    def start(self):
+        """Запускает периодическое сохранение кэша"""
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает сохранение и записывает последние изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        logger.info(f"Кэш ответов: {self.stats()}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
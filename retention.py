@@ -0,0 +1,161 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ROWS = registry.counter(
+    "bot_retention_rows_total", "Строки, удаленные задачей хранения", ["table"]
+)
+
+
+class RetentionReport(NamedTuple):
+    """Итог одного прохода обслуживания базы"""
+    archived: int          # сообщений перенесено в архив и удалено
+    limits_deleted: int    # устаревших счетчиков лимитов удалено
+    usage_deleted: int     # сырых событий расхода удалено (сводки остаются)
+    files: int             # архивных файлов дописано
+    users: frozenset       # пользователи, у которых удалены сообщения
+    size_before: int
+    size_after: int
+    seconds: float
+
+    @property
+    def reclaimed(self):
+        return self.size_before - self.size_after
+
+
+def archive_path(directory, day):
+    return os.path.join(directory, f"history-{day}.jsonl.gz")
+
+
+def append_archive(directory, day, rows):
+    """Дописывает строки истории в сжатый архив дня.
+
+    Каждый вызов добавляет к файлу отдельный gzip-поток; gzip и zcat читают
+    такие файлы целиком. Данные сбрасываются на диск до удаления из базы,
+    поэтому при сбое сообщение может попасть в архив дважды, но не пропасть.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(archive_path(directory, day), "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as archive:
+            for row_id, user_id, text, message_type, timestamp in rows:
+                line = {"id": row_id, "user_id": user_id, "type": message_type, "text": text, "timestamp": timestamp}
+                archive.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+class RetentionJob:
+    """Обслуживание базы: архивирование старой истории и возврат места на диске.
+
+    Сообщения старше retention_days переносятся в сжатые архивы по дням
+    (archive_dir/history-ГГГГ-ММ-ДД.jsonl.gz) и удаляются пачками по
+    batch_size: каждая пачка — отдельная короткая транзакция, и между ними
+    успевают пройти запросы обработчиков. Так же пачками удаляются сырые
+    события журнала использования старше retention_days (сводки остаются) и
+    счетчики лимитов, не сбрасывавшиеся limits_retention_days дней. Затем
+    свободные страницы возвращаются файлу шагами по vacuum_pages, а ANALYZE
+    обновляет статистику для планировщика запросов. Старую базу нужно заранее
+    перевести в режим auto_vacuum=INCREMENTAL (storage.enable_incremental_vacuum
+    в основном процессе при запуске): без него шаги не возвращают место, а
+    полный VACUUM здесь надолго занял бы поток хранилища.
+    """
+
+    def __init__(self, storage, retention_days=30, archive_dir="archive", batch_size=1000,
+                 limits_retention_days=7, vacuum_pages=1000):
+        self.storage = storage
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.limits_retention_days = limits_retention_days
+        self.vacuum_pages = vacuum_pages
+        self.last_report = None
+        self._running = False
+
+    async def run(self):
+        """Один проход обслуживания, возвращает RetentionReport или None, если проход уже идет"""
+        if self._running:
+            return None
+        self._running = True
+        try:
+            report = await self._run()
+        finally:
+            self._running = False
+        self.last_report = report
+        logger.info(
+            f"Обслуживание базы: в архив {report.archived} сообщений ({report.files} файлов), "
+            f"удалено счетчиков {report.limits_deleted} и событий расхода {report.usage_deleted}, освобождено {report.reclaimed / 1024 / 1024:.1f} МБ "
+            f"({report.size_before} -> {report.size_after} байт) за {report.seconds:.1f} с"
+        )
+        return report
+
+    async def _run(self):
+        started = time.perf_counter()
+        size_before = self.storage.file_size()
+        now = datetime.now(timezone.utc)
+
+        archived, usage_deleted, files, users = 0, 0, set(), set()
+        if self.retention_days:
+            before = (now - timedelta(days=self.retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+            archived = await self._archive_messages(before, files, users)
+            usage_deleted = await self._delete_batches(self.storage.delete_expired_usage, before)
+            RETENTION_ROWS.labels("usage_events").inc(usage_deleted)
+
+        limits_deleted = 0
+        if self.limits_retention_days:
+            before_day = (now - timedelta(days=self.limits_retention_days)).strftime('%Y-%m-%d')
+            limits_deleted = await self._delete_batches(self.storage.delete_stale_limits, before_day)
+            RETENTION_ROWS.labels("user_limits").inc(limits_deleted)
+
+        free_pages = None
+        while True:
+            remaining = await self.storage.incremental_vacuum(self.vacuum_pages)
+            if not remaining or remaining == free_pages:
+                break
+            free_pages = remaining
+            # Между шагами очередь хранилища обслуживает другие запросы
+            await asyncio.sleep(0)
+        await self.storage.analyze()
+
+        return RetentionReport(
+            archived, limits_deleted, usage_deleted, len(files), frozenset(users),
+            size_before, self.storage.file_size(), time.perf_counter() - started
+        )
+
+    async def _delete_batches(self, delete, before):
+        """Вызывает delete(before, batch_size), пока удаляются полные пачки"""
+        total = 0
+        while True:
+            deleted = await delete(before, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+
+    async def _archive_messages(self, before, files, users):
+        loop = asyncio.get_running_loop()
+        archived = 0
+        while True:
+            rows = await self.storage.select_expired_messages(before, self.batch_size)
+            if not rows:
+                return archived
+            by_day = {}
+            for row in rows:
+                by_day.setdefault(row[4][:10], []).append(row)
+            for day, day_rows in by_day.items():
+                # Запись архива не занимает поток хранилища
+                await loop.run_in_executor(None, append_archive, self.archive_dir, day, day_rows)
+                files.add(day)
+            deleted = await self.storage.delete_messages([row[0] for row in rows])
+            users.update(row[1] for row in rows)
+            archived += deleted
+            RETENTION_ROWS.labels("message_history").inc(deleted)
+            if len(rows) < self.batch_size:
+                return archived
@@ -0,0 +1,272 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньше — раньше
+PRIORITY_FIRST = 0       # первая часть ответа и обычные сообщения
+PRIORITY_FOLLOWUP = 1    # продолжение длинного ответа
+PRIORITY_BACKGROUND = 2  # промежуточные правки потокового ответа
+
+# Методы, на которые распространяются лимиты Bot API на отправку
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+UNLIMITED_ENDPOINTS = ("sendChatAction",)
+
+
+def retry_after_seconds(error):
+    """Пауза из RetryAfter в секундах (int или timedelta в зависимости от версии PTB)"""
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+def rate_limit_kwargs(bot, priority, max_retries=None):
+    """Аргументы для методов бота с приоритетом отправки.
+
+    Без планировщика rate_limit_args вызывают ошибку, поэтому они передаются
+    только если он подключен к боту.
+    """
+    if getattr(bot, "rate_limiter", None) is None:
+        return {}
+    args = {"priority": priority}
+    if max_retries is not None:
+        args["max_retries"] = max_retries
+    return {"rate_limit_args": args}
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at", "blocked_until")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = now
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до свободного токена"""
+        if self.rate <= 0:
+            # Нулевая скорость — без ограничения, а не деление на ноль в цикле планировщика
+            self.tokens = float(self.capacity)
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        delay = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class _Request:
+    __slots__ = ("priority", "seq", "future")
+
+    def __init__(self, priority, seq, future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик исходящих запросов к Bot API.
+
+    Подключается к приложению через Application.builder().rate_limiter(...)
+    и пропускает через себя все отправки и правки сообщений. Запросы ждут
+    токен в общем ведре (global_rate в секунду) и в ведре своего чата:
+    в личных чатах chat_rate в секунду с запасом chat_burst, в группах
+    group_rate_per_minute в минуту. Из готовых к отправке чатов первым
+    обслуживается запрос с меньшим приоритетом, внутри чата порядок
+    сохраняется. При 429 чат блокируется на retry_after, а запрос
+    повторяется до max_retries раз.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1.0, chat_burst=3, group_rate_per_minute=20,
+                 max_retries=3, max_idle_chats=10000):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        # Общее ведро без запаса: отправки равномерно распределяются по секунде
+        self._global = _Bucket(global_rate, 1, time.monotonic())
+        self._buckets = {}
+        self._pending = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.queued = 0
+        self.max_queued = 0
+        self.sent = 0
+        self.granted = 0
+        self.retried = 0
+        self.failed = 0
+        self._wait_total = 0.0
+
+    def configure(self, global_rate, chat_rate, chat_burst, group_rate_per_minute, max_retries):
+        """Новые лимиты; накопленные токены в ведрах чатов сохраняются"""
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self._global.rate = global_rate
+        for chat_id, bucket in self._buckets.items():
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket.rate, bucket.capacity = chat_rate, chat_burst
+            else:
+                bucket.rate = self.group_rate
+            bucket.tokens = min(bucket.tokens, bucket.capacity)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for requests in self._pending.values():
+            for request in requests:
+                if not request.future.done():
+                    request.future.cancel()
+        self._pending.clear()
+        self.queued = 0
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        options = rate_limit_args or {}
+        priority = options.get("priority", PRIORITY_FIRST)
+        max_retries = options.get("max_retries", self.max_retries)
+        chat_id = data.get("chat_id") if data else None
+        limited = endpoint.startswith(LIMITED_PREFIXES) and endpoint not in UNLIMITED_ENDPOINTS
+
+        attempt = 0
+        while True:
+            if limited and self._task is not None:
+                await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                if attempt >= max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                logger.warning(f"429 для {endpoint} в чате {chat_id}, повтор через {delay} с")
+                if limited and chat_id is not None and self._task is not None:
+                    # Следующие запросы в этот чат тоже подождут
+                    self._bucket(chat_id, time.monotonic()).blocked_until = time.monotonic() + delay
+                else:
+                    await asyncio.sleep(delay)
+
+    def stats(self):
+        by_priority = {}
+        for requests in self._pending.values():
+            for request in requests:
+                by_priority[request.priority] = by_priority.get(request.priority, 0) + 1
+        return {
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "queued_by_priority": by_priority,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "avg_wait_ms": round(self._wait_total / self.granted * 1000, 1) if self.granted else 0.0,
+        }
+
+    async def _acquire(self, chat_id, priority):
+        """Ставит запрос в очередь и ждет разрешения на отправку"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(chat_id, deque()).append(_Request(priority, next(self._seq), future))
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self._wakeup.set()
+        started = time.monotonic()
+        await future
+        self._wait_total += time.monotonic() - started
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = _Bucket(self.chat_rate, self.chat_burst, now)
+            else:
+                # Группы, супергруппы и каналы (отрицательные id и @username)
+                bucket = _Bucket(self.group_rate, 1, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now):
+        """Выбирает чат для следующей отправки или время до ближайшей возможности"""
+        global_wait = self._global.wait_time(now)
+        best = None
+        wait = None
+        for chat_id, requests in list(self._pending.items()):
+            # Отмененные ожидания (например, обработчик завершился) пропускаем
+            while requests and requests[0].future.done():
+                requests.popleft()
+                self.queued -= 1
+            if not requests:
+                del self._pending[chat_id]
+                continue
+            chat_wait = self._bucket(chat_id, now).wait_time(now) if chat_id is not None else 0.0
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            head = requests[0]
+            if best is None or (head.priority, head.seq) < best[0]:
+                best = ((head.priority, head.seq), chat_id)
+        if best is None:
+            return None, wait
+        if global_wait > 0:
+            return None, global_wait
+        return best[1], 0.0
+
+    def _grant(self, chat_id, now):
+        self._global.take()
+        if chat_id is not None:
+            self._bucket(chat_id, now).take()
+        request = self._pending[chat_id].popleft()
+        if not self._pending[chat_id]:
+            del self._pending[chat_id]
+        self.queued -= 1
+        self.granted += 1
+        request.future.set_result(None)
+
+    def _forget_idle(self, now):
+        if len(self._buckets) <= self.max_idle_chats:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._pending and bucket.idle(now)]:
+            del self._buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            chat_id, wait = self._pick(now)
+            if wait == 0.0:
+                self._grant(chat_id, now)
+                continue
+            self._forget_idle(now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
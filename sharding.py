@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Поля обновления, в которых Telegram передает отправителя
+SENDER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request",
+    "business_message", "edited_business_message", "message_reaction",
+)
+
+
+def update_user_id(data):
+    """Id пользователя (или чата), от которого пришло обновление, или None"""
+    for field in SENDER_FIELDS:
+        payload = data.get(field)
+        if not isinstance(payload, dict):
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if sender:
+            return sender.get("id")
+        chat = payload.get("chat")
+        if chat:
+            return chat.get("id")
+    return None
+
+
+def shard_for(user_id, workers):
+    """Номер процесса, который обслуживает пользователя"""
+    if user_id is None:
+        return 0
+    return user_id % workers
+
+
+def stop_event_on_signals():
+    """Событие, которое выставляется по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # На Windows обработчики сигналов в event loop недоступны
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+    return stop_event
+
+
+class WorkerPool:
+    """Процессы-обработчики с распределением обновлений по id пользователя.
+
+    Все обновления одного пользователя попадают в один и тот же процесс,
+    поэтому его лимиты, кэш истории и очередь сообщений остаются локальными
+    для процесса, а общим является только хранилище. target(index, queue)
+    запускается в отдельном процессе и получает обновления в виде JSON-словарей;
+    None в очереди означает остановку.
+    """
+
+    def __init__(self, target, workers, queue_size=1000):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [
+            context.Process(target=target, args=(index, self.queues[index]), name=f"bot-worker-{index}")
+            for index in range(workers)
+        ]
+        self.dispatched = [0] * workers
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Запущено процессов-обработчиков: {len(self.processes)}")
+
+    async def dispatch(self, data):
+        """Передает обновление процессу его пользователя"""
+        index = shard_for(update_user_id(data), len(self.queues))
+        try:
+            self.queues[index].put_nowait(data)
+        except queue.Full:
+            # Процесс не успевает: ждем места, не блокируя event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.queues[index].put, data)
+        self.dispatched[index] += 1
+
+    def stats(self):
+        return {
+            "dispatched": list(self.dispatched),
+            "alive": sum(1 for process in self.processes if process.is_alive()),
+        }
+
+    async def stop(self, timeout=30):
+        """Просит процессы доработать принятые обновления и дожидается их"""
+        await asyncio.get_running_loop().run_in_executor(None, self._stop, timeout)
+
+    def _stop(self, timeout):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился за {timeout} с, прерываем")
+                process.terminate()
+                process.join()
+
+
+class UpdatePoller:
+    """Long polling getUpdates, результаты которого передаются в dispatch"""
+
+    def __init__(self, bot, dispatch, timeout=25):
+        self.bot = bot
+        self.dispatch = dispatch
+        self.timeout = timeout
+        self.offset = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await self.bot.delete_webhook()
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=self.offset, timeout=self.timeout, allowed_updates=Update.ALL_TYPES
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.dispatch(update.to_dict())
+                self.offset = update.update_id + 1
+
+    async def stop(self):
+        """Останавливает опрос и подтверждает полученные обновления"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.offset is not None:
+            # Иначе Telegram снова пришлет уже переданные обработчикам обновления
+            try:
+                await self.bot.get_updates(offset=self.offset, timeout=0, limit=1)
+            except Exception as e:
+                logger.error(f"Ошибка подтверждения обновлений: {e}")
+
+
+async def serve_sharded(pool, bot, server=None, webhook_url="", drain_timeout=30):
+    """Жизненный цикл основного процесса: прием обновлений и раздача процессам.
+
+    Обновления принимаются через webhook (если передан server) или long polling.
+    """
+    stop_event = stop_event_on_signals()
+    pool.start()
+    async with bot:
+        if server is not None:
+            await server.start()
+            if webhook_url:
+                await bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=server.secret_token or None,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                logger.info(f"Webhook зарегистрирован: {webhook_url}")
+            receiver = server
+        else:
+            receiver = UpdatePoller(bot, pool.dispatch)
+            receiver.start()
+
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("Остановка, дожидаемся обработки обновлений процессами...")
+            if server is not None:
+                await server.drain()
+            await receiver.stop()
+            await pool.stop(drain_timeout)
+            logger.info(f"Распределено обновлений по процессам: {pool.stats()['dispatched']}")
+
+
+async def serve_worker(application, updates):
+    """Жизненный цикл процесса-обработчика.
+
+    Обновления читаются из очереди основного процесса и обрабатываются
+    приложением так же, как при polling; после None очередь дорабатывается.
+    """
+    # Ctrl+C и SIGTERM от systemd получает вся группа процессов,
+    # а останавливает обработчики основной процесс через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.update_queue.join()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
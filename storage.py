@@ -0,0 +1,600 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DB_SECONDS = registry.histogram(
+    "bot_db_query_seconds", "Время операций хранилища вместе с ожиданием очереди", ["operation"]
+)
+
+DB_FILE = 'bot_data.db'
+
+# Настройки соединения: WAL позволяет читать во время записи, а synchronous=NORMAL
+# в режиме WAL не теряет целостность и убирает fsync на каждый коммит
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Миграции схемы по номеру PRAGMA user_version
+MIGRATIONS = {
+    1: (
+        '''
+        CREATE TABLE IF NOT EXISTS message_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_limits (
+            user_id INTEGER PRIMARY KEY,
+            message_count INTEGER DEFAULT 0,
+            last_reset_date DATE DEFAULT CURRENT_DATE
+        )
+        ''',
+    ),
+    2: (
+        '''
+        CREATE INDEX IF NOT EXISTS idx_message_history_user_ts
+        ON message_history (user_id, timestamp, id)
+        ''',
+    ),
+    3: (
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            context_hash TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            response TEXT NOT NULL,
+            tokens INTEGER DEFAULT 0,
+            hits INTEGER DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''',
+    ),
+    4: (
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    5: (
+        # Для выборки истекших сообщений задачей хранения
+        '''
+        CREATE INDEX IF NOT EXISTS idx_message_history_ts
+        ON message_history (timestamp)
+        ''',
+    ),
+    6: (
+        '''
+        CREATE TABLE IF NOT EXISTS usage_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            timestamp DATETIME NOT NULL
+        )
+        ''',
+        # Сводки обновляются приращениями при каждой записи пачки событий
+        '''
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            latency_sum REAL NOT NULL,
+            PRIMARY KEY (day, user_id, model)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS usage_hourly (
+            hour TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            latency_sum REAL NOT NULL,
+            PRIMARY KEY (hour, model)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS usage_totals (
+            user_id INTEGER PRIMARY KEY,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            first_day DATE NOT NULL,
+            last_day DATE NOT NULL
+        )
+        ''',
+    ),
+}
+
+# Запросы вынесены в константы: sqlite3 кэширует подготовленные выражения
+# по тексту запроса, поэтому повторные вызовы не компилируют SQL заново
+SQL_SELECT_HISTORY = '''
+SELECT message_text, message_type, timestamp
+FROM message_history
+WHERE user_id = ?
+ORDER BY timestamp DESC, id DESC
+LIMIT ?
+'''
+
+SQL_INSERT_MESSAGE = '''
+INSERT INTO message_history (user_id, message_text, message_type, timestamp)
+VALUES (?, ?, ?, ?)
+'''
+
+# Обрезка истории одним проходом по всем затронутым пользователям:
+# оставляем memory_size последних сообщений каждого
+SQL_PRUNE_USERS = '''
+DELETE FROM message_history
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY user_id ORDER BY timestamp DESC, id DESC
+        ) AS position
+        FROM message_history
+        WHERE user_id IN (SELECT value FROM json_each(?))
+    )
+    WHERE position > ?
+)
+'''
+
+SQL_SELECT_LIMIT = '''
+SELECT message_count, last_reset_date
+FROM user_limits
+WHERE user_id = ?
+'''
+
+SQL_SELECT_LIMITS_FOR_DAY = '''
+SELECT user_id, message_count
+FROM user_limits
+WHERE last_reset_date = ?
+'''
+
+SQL_UPSERT_LIMIT = '''
+INSERT INTO user_limits (user_id, message_count, last_reset_date)
+VALUES (?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+    message_count = excluded.message_count,
+    last_reset_date = excluded.last_reset_date
+'''
+
+
+SQL_SELECT_CACHED_RESPONSES = '''
+SELECT key, model, context_hash, prompt, response, tokens, hits, created_at, last_used
+FROM response_cache
+WHERE created_at > ?
+ORDER BY last_used DESC
+LIMIT ?
+'''
+
+SQL_UPSERT_CACHED_RESPONSE = '''
+INSERT INTO response_cache (key, model, context_hash, prompt, response, tokens, hits, created_at, last_used)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    response = excluded.response,
+    tokens = excluded.tokens,
+    hits = excluded.hits,
+    created_at = excluded.created_at,
+    last_used = excluded.last_used
+'''
+
+SQL_DELETE_CACHED_RESPONSE = '''
+DELETE FROM response_cache WHERE key = ?
+'''
+
+SQL_DELETE_EXPIRED_RESPONSES = '''
+DELETE FROM response_cache WHERE created_at <= ?
+'''
+
+
+SQL_SELECT_HISTORY_ROWS = '''
+SELECT id, message_text, message_type, timestamp
+FROM message_history
+WHERE user_id = ?
+ORDER BY timestamp, id
+'''
+
+SQL_SELECT_SUMMARY = '''
+SELECT summary FROM conversation_summaries WHERE user_id = ?
+'''
+
+SQL_UPSERT_SUMMARY = '''
+INSERT INTO conversation_summaries (user_id, summary, updated_at)
+VALUES (?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT (user_id) DO UPDATE SET
+    summary = excluded.summary,
+    updated_at = excluded.updated_at
+'''
+
+SQL_DELETE_SUMMARIZED = '''
+DELETE FROM message_history WHERE user_id = ? AND id <= ?
+'''
+
+
+SQL_SELECT_EXPIRED_MESSAGES = '''
+SELECT id, user_id, message_text, message_type, timestamp
+FROM message_history
+WHERE timestamp < ?
+ORDER BY timestamp, id
+LIMIT ?
+'''
+
+SQL_DELETE_MESSAGES = '''
+DELETE FROM message_history WHERE id IN (SELECT value FROM json_each(?))
+'''
+
+SQL_DELETE_STALE_LIMITS = '''
+DELETE FROM user_limits
+WHERE user_id IN (SELECT user_id FROM user_limits WHERE last_reset_date < ? LIMIT ?)
+'''
+
+SQL_DELETE_EXPIRED_USAGE = '''
+DELETE FROM usage_events
+WHERE id IN (SELECT id FROM usage_events WHERE timestamp < ? ORDER BY id LIMIT ?)
+'''
+
+
+SQL_INSERT_USAGE_EVENT = '''
+INSERT INTO usage_events (user_id, model, kind, prompt_tokens, completion_tokens, latency, timestamp)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+SQL_UPSERT_USAGE_DAILY = '''
+INSERT INTO usage_daily (day, user_id, model, requests, prompt_tokens, completion_tokens, latency_sum)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (day, user_id, model) DO UPDATE SET
+    requests = requests + excluded.requests,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    latency_sum = latency_sum + excluded.latency_sum
+'''
+
+SQL_UPSERT_USAGE_HOURLY = '''
+INSERT INTO usage_hourly (hour, model, requests, prompt_tokens, completion_tokens, latency_sum)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (hour, model) DO UPDATE SET
+    requests = requests + excluded.requests,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    latency_sum = latency_sum + excluded.latency_sum
+'''
+
+SQL_UPSERT_USAGE_TOTALS = '''
+INSERT INTO usage_totals (user_id, requests, prompt_tokens, completion_tokens, first_day, last_day)
+VALUES (?1, ?2, ?3, ?4, ?5, ?5)
+ON CONFLICT (user_id) DO UPDATE SET
+    requests = requests + excluded.requests,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    last_day = excluded.last_day
+'''
+
+SQL_SELECT_USAGE_DAY = '''
+SELECT user_id, SUM(requests), SUM(prompt_tokens), SUM(completion_tokens)
+FROM usage_daily
+WHERE day = ?
+GROUP BY user_id
+'''
+
+SQL_SELECT_USAGE_HOURS = '''
+SELECT hour, model, requests, prompt_tokens, completion_tokens, latency_sum
+FROM usage_hourly
+WHERE hour >= ?
+ORDER BY hour, model
+'''
+
+SQL_SELECT_USAGE_TOTALS = '''
+SELECT requests, prompt_tokens, completion_tokens, first_day
+FROM usage_totals
+WHERE user_id = ?
+'''
+
+
+class Storage:
+    """Хранилище бота поверх одного долгоживущего соединения SQLite.
+
+    Все запросы выполняются в отдельном потоке, поэтому event loop не ждет
+    диск, а обращения к соединению идут строго по очереди.
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def open(self):
+        """Открывает соединение, применяет настройки и миграции"""
+        self._executor.submit(self._open).result()
+
+    async def close(self):
+        """Закрывает соединение и поток хранилища"""
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке хранилища"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, func, self._conn, *args)
+        finally:
+            DB_SECONDS.labels(func.__name__.lstrip("_")).observe(time.perf_counter() - started)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            # В новой базе освобожденные страницы можно вернуть без полного VACUUM
+            self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        for pragma in PRAGMAS:
+            self._conn.execute(pragma)
+        self._migrate()
+
+    def _close(self):
+        try:
+            self._conn.execute("PRAGMA optimize")
+        finally:
+            self._conn.close()
+            self._conn = None
+
+    def _migrate(self):
+        """Применяет недостающие миграции схемы"""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        for target in sorted(MIGRATIONS):
+            if target <= version:
+                continue
+            with self._conn:
+                for statement in MIGRATIONS[target]:
+                    self._conn.execute(statement)
+                self._conn.execute(f"PRAGMA user_version = {target}")
+            logger.info(f"Применена миграция базы данных до версии {target}")
+
+    async def get_history(self, user_id, limit):
+        """Последние limit сообщений пользователя, от новых к старым"""
+        return await self.run(_get_history, user_id, limit)
+
+    async def insert_messages(self, rows):
+        """Записывает пачку (user_id, текст, тип, время) одной транзакцией"""
+        await self.run(_insert_messages, rows)
+
+    async def prune_history(self, user_ids, memory_size):
+        """Удаляет у пользователей сообщения сверх memory_size, возвращает число удаленных"""
+        return await self.run(_prune_history, user_ids, memory_size)
+
+    async def get_limits(self, user_id):
+        """Счетчик и дата последнего сброса пользователя или None"""
+        return await self.run(_get_limits, user_id)
+
+    async def load_limits(self, day):
+        """Счетчики (user_id, message_count) всех пользователей за день"""
+        return await self.run(_load_limits, day)
+
+    async def save_limits(self, rows):
+        """Сохраняет пачку (user_id, счетчик, дата) одним UPSERT"""
+        await self.run(_save_limits, rows)
+
+    async def load_cached_responses(self, min_created_at, limit):
+        """Неистекшие записи кэша ответов, недавно использованные первыми"""
+        return await self.run(_load_cached_responses, min_created_at, limit)
+
+    async def save_cached_responses(self, rows, deleted_keys, expire_before):
+        """Сохраняет и удаляет записи кэша ответов одной транзакцией"""
+        await self.run(_save_cached_responses, rows, deleted_keys, expire_before)
+
+    async def get_history_rows(self, user_id):
+        """Вся история пользователя с id, от старых к новым"""
+        return await self.run(_get_history_rows, user_id)
+
+    async def get_summary(self, user_id):
+        """Сохраненное краткое содержание разговора или None"""
+        return await self.run(_get_summary, user_id)
+
+    async def save_summary(self, user_id, summary, last_summarized_id):
+        """Сохраняет краткое содержание и удаляет вошедшие в него сообщения"""
+        await self.run(_save_summary, user_id, summary, last_summarized_id)
+
+    async def select_expired_messages(self, before, limit):
+        """Самые старые limit сообщений, записанных раньше before"""
+        return await self.run(_select_expired_messages, before, limit)
+
+    async def delete_messages(self, ids):
+        """Удаляет сообщения по id одной короткой транзакцией"""
+        return await self.run(_delete_messages, ids)
+
+    async def delete_stale_limits(self, before_day, limit):
+        """Удаляет до limit счетчиков, не сбрасывавшихся с before_day"""
+        return await self.run(_delete_stale_limits, before_day, limit)
+
+    async def delete_expired_usage(self, before, limit):
+        """Удаляет до limit сырых событий расхода старше before (сводки остаются)"""
+        return await self.run(_delete_expired_usage, before, limit)
+
+    async def incremental_vacuum(self, pages):
+        """Возвращает файлу до pages свободных страниц, возвращает число оставшихся"""
+        return await self.run(_incremental_vacuum, pages)
+
+    async def analyze(self):
+        """Обновляет статистику планировщика запросов и усекает WAL"""
+        await self.run(_analyze)
+
+    def file_size(self):
+        """Размер файлов базы на диске вместе с WAL"""
+        return sum(
+            os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path)
+        )
+
+    async def save_usage(self, events, daily, hourly, totals):
+        """Записывает события расхода и приращения сводок одной транзакцией"""
+        await self.run(_save_usage, events, daily, hourly, totals)
+
+    async def load_usage_day(self, day):
+        """Расход (user_id, запросы, токены запроса, токены ответа) всех пользователей за день"""
+        return await self.run(_load_usage_day, day)
+
+    async def load_usage_hours(self, since):
+        """Часовые сводки по моделям начиная с часа since ("ГГГГ-ММ-ДД ЧЧ")"""
+        return await self.run(_load_usage_hours, since)
+
+    async def get_usage_totals(self, user_id):
+        """Расход пользователя за все время и первый день или None"""
+        return await self.run(_get_usage_totals, user_id)
+
+
+def _get_history(conn, user_id, limit):
+    rows = conn.execute(SQL_SELECT_HISTORY, (user_id, limit)).fetchall()
+    return [{"text": row[0], "type": row[1], "timestamp": row[2]} for row in rows]
+
+
+def _insert_messages(conn, rows):
+    with conn:
+        conn.executemany(SQL_INSERT_MESSAGE, rows)
+
+
+def _prune_history(conn, user_ids, memory_size):
+    with conn:
+        cursor = conn.execute(SQL_PRUNE_USERS, (json.dumps(list(user_ids)), memory_size))
+    return cursor.rowcount
+
+
+def _get_limits(conn, user_id):
+    return conn.execute(SQL_SELECT_LIMIT, (user_id,)).fetchone()
+
+
+def _load_limits(conn, day):
+    return conn.execute(SQL_SELECT_LIMITS_FOR_DAY, (day,)).fetchall()
+
+
+def _save_limits(conn, rows):
+    with conn:
+        conn.executemany(SQL_UPSERT_LIMIT, rows)
+
+
+def _load_cached_responses(conn, min_created_at, limit):
+    return conn.execute(SQL_SELECT_CACHED_RESPONSES, (min_created_at, limit)).fetchall()
+
+
+def _save_cached_responses(conn, rows, deleted_keys, expire_before):
+    with conn:
+        conn.executemany(SQL_UPSERT_CACHED_RESPONSE, rows)
+        conn.executemany(SQL_DELETE_CACHED_RESPONSE, [(key,) for key in deleted_keys])
+        conn.execute(SQL_DELETE_EXPIRED_RESPONSES, (expire_before,))
+
+
+def _get_history_rows(conn, user_id):
+    return conn.execute(SQL_SELECT_HISTORY_ROWS, (user_id,)).fetchall()
+
+
+def _get_summary(conn, user_id):
+    row = conn.execute(SQL_SELECT_SUMMARY, (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _save_summary(conn, user_id, summary, last_summarized_id):
+    with conn:
+        conn.execute(SQL_UPSERT_SUMMARY, (user_id, summary))
+        conn.execute(SQL_DELETE_SUMMARIZED, (user_id, last_summarized_id))
+
+
+def _select_expired_messages(conn, before, limit):
+    return conn.execute(SQL_SELECT_EXPIRED_MESSAGES, (before, limit)).fetchall()
+
+
+def _delete_messages(conn, ids):
+    with conn:
+        cursor = conn.execute(SQL_DELETE_MESSAGES, (json.dumps(list(ids)),))
+    return cursor.rowcount
+
+
+def _delete_stale_limits(conn, before_day, limit):
+    with conn:
+        cursor = conn.execute(SQL_DELETE_STALE_LIMITS, (before_day, limit))
+    return cursor.rowcount
+
+
+def _delete_expired_usage(conn, before, limit):
+    with conn:
+        cursor = conn.execute(SQL_DELETE_EXPIRED_USAGE, (before, limit))
+    return cursor.rowcount
+
+
+def enable_incremental_vacuum(path=DB_FILE):
+    """Переводит старую базу в режим auto_vacuum=INCREMENTAL, True если понадобился VACUUM.
+
+    Полный VACUUM держит блокировку записи всей базы, поэтому вызывается в
+    основном процессе до запуска обработчиков и приема обновлений, через
+    отдельное соединение. Новую базу Storage сразу создает в этом режиме.
+    """
+    if not os.path.exists(path):
+        return False
+    conn = sqlite3.connect(path)
+    try:
+        return _enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+
+
+def _enable_incremental_vacuum(conn):
+    # 2 — INCREMENTAL; сменить режим у базы с таблицами можно только полным VACUUM
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def _incremental_vacuum(conn, pages):
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def _analyze(conn):
+    conn.execute("ANALYZE")
+    # Без контрольной точки освобожденное место остается в файле WAL
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+def _save_usage(conn, events, daily, hourly, totals):
+    with conn:
+        conn.executemany(SQL_INSERT_USAGE_EVENT, events)
+        conn.executemany(SQL_UPSERT_USAGE_DAILY, daily)
+        conn.executemany(SQL_UPSERT_USAGE_HOURLY, hourly)
+        conn.executemany(SQL_UPSERT_USAGE_TOTALS, totals)
+
+
+def _load_usage_day(conn, day):
+    return conn.execute(SQL_SELECT_USAGE_DAY, (day,)).fetchall()
+
+
+def _load_usage_hours(conn, since):
+    return conn.execute(SQL_SELECT_USAGE_HOURS, (since,)).fetchall()
+
+
+def _get_usage_totals(conn, user_id):
+    return conn.execute(SQL_SELECT_USAGE_TOTALS, (user_id,)).fetchone()
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from message_splitter import utf16_len
+from send_scheduler import (
+    PRIORITY_BACKGROUND, PRIORITY_FIRST, PRIORITY_FOLLOWUP, rate_limit_kwargs, retry_after_seconds
+)
+
+logger = logging.getLogger(__name__)
+
+STREAM_CURSOR = " ▌"
+STREAM_PLACEHOLDER = "⏳ Думаю..."
+
+
+class EditThrottle:
+    """Ограничивает частоту правок и отправок сообщений в одном чате.
+
+    Bot API начинает отвечать 429 при частых правках, поэтому промежуточные
+    правки пропускаются, пока интервал для чата не истек.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._next_allowed = {}
+
+    def ready(self, chat_id):
+        """Можно ли прямо сейчас править сообщение в чате"""
+        return time.monotonic() >= self._next_allowed.get(chat_id, 0)
+
+    def mark(self, chat_id):
+        """Фиксирует правку и откладывает следующую на interval секунд"""
+        self._next_allowed[chat_id] = time.monotonic() + self.interval
+
+    async def wait(self, chat_id):
+        """Дожидается, пока в чате снова можно править сообщение"""
+        delay = self._next_allowed.get(chat_id, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.mark(chat_id)
+
+
+class StreamingReply:
+    """Ответ, который постепенно дописывается правками сообщения.
+
+    Когда текст перерастает max_length (в единицах UTF-16, как считает
+    Telegram), готовые части фиксируются по границам split_func, а генерация
+    продолжается в новом сообщении.
+    """
+
+    def __init__(self, message, throttle, max_length, split_func):
+        self._message = message
+        self._throttle = throttle
+        # Промежуточные правки идут с курсором, ему нужно место в лимите
+        self._max_length = max_length - utf16_len(STREAM_CURSOR)
+        self._split = split_func
+        self._chat_id = message.chat_id
+        self._current = None
+        self._text = ""
+        self._units = 0  # длина _text в единицах UTF-16
+        self._shown = ""
+
+    async def start(self):
+        """Отправляет сообщение-заглушку, которое будет дописываться"""
+        await self._throttle.wait(self._chat_id)
+        self._current = await self._message.reply_text(STREAM_PLACEHOLDER)
+
+    async def feed(self, delta):
+        """Добавляет фрагмент текста, правит сообщение не чаще интервала"""
+        self._text += delta
+        self._units += utf16_len(delta)
+        if self._units > self._max_length:
+            await self._rollover()
+        elif self._throttle.ready(self._chat_id):
+            self._throttle.mark(self._chat_id)
+            await self._edit(self._text + STREAM_CURSOR, final=False)
+
+    async def finish(self, fallback_text=""):
+        """Финальная правка с полным текстом без курсора"""
+        if not self._text.strip():
+            self._text = fallback_text
+        await self._throttle.wait(self._chat_id)
+        await self._edit(self._text, final=True)
+
+    async def _rollover(self):
+        """Фиксирует заполненное сообщение и переносит остаток в новое"""
+        parts = self._split(self._text, self._max_length)
+        if len(parts) < 2:
+            return
+        await self._throttle.wait(self._chat_id)
+        await self._edit(parts[0], final=True)
+        bot = self._message.get_bot()
+        for part in parts[1:-1]:
+            await self._throttle.wait(self._chat_id)
+            await bot.send_message(self._chat_id, part, **rate_limit_kwargs(bot, PRIORITY_FOLLOWUP))
+        self._text = parts[-1]
+        self._units = utf16_len(self._text)
+        await self._throttle.wait(self._chat_id)
+        self._current = await bot.send_message(
+            self._chat_id, self._text + STREAM_CURSOR, **rate_limit_kwargs(bot, PRIORITY_FOLLOWUP)
+        )
+        self._shown = self._text + STREAM_CURSOR
+
+    async def _edit(self, text, final):
+        """Правка текущего сообщения, ошибки промежуточных правок не критичны"""
+        if not text or text == self._shown:
+            return
+        bot = self._current.get_bot()
+        if final:
+            limit_kwargs = rate_limit_kwargs(bot, PRIORITY_FIRST)
+        else:
+            # Промежуточные правки идут с низким приоритетом и без повторов после 429
+            limit_kwargs = rate_limit_kwargs(bot, PRIORITY_BACKGROUND, max_retries=0)
+        for _ in range(2):
+            try:
+                await bot.edit_message_text(
+                    text, chat_id=self._chat_id, message_id=self._current.message_id, **limit_kwargs
+                )
+                self._shown = text
+                return
+            except RetryAfter as e:
+                if not final:
+                    return
+                await asyncio.sleep(retry_after_seconds(e))
+            except BadRequest as e:
+                # "Message is not modified" и подобные ошибки не мешают ответу
+                if final:
+                    logger.warning(f"Не удалось обновить сообщение: {e}")
+                return
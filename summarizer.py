@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты сжимаешь переписку пользователя с ассистентом. Составь краткое содержание "
+    "на языке переписки: факты о пользователе, его цели, принятые решения и открытые "
+    "вопросы. Не выдумывай ничего, чего нет в тексте. Ответь только кратким содержанием."
+)
+
+SPEAKERS = {"bot_response": "Бот"}
+
+
+class Summarizer:
+    """Фоновое сжатие длинных разговоров в краткое содержание.
+
+    Когда в истории пользователя набирается trigger сообщений, старые реплики
+    (все, кроме keep_recent последних) вместе с прежним кратким содержанием
+    сворачиваются нейросетью в новое краткое содержание, а сами сообщения
+    удаляются из истории. Сжатие идет отдельной задачей после ответа и не
+    задерживает его.
+    """
+
+    def __init__(self, storage, history_writer, history_cache, summarize_func,
+                 trigger=8, keep_recent=4, max_cached=10000):
+        self.storage = storage
+        self.history_writer = history_writer
+        self.history_cache = history_cache
+        self.summarize_func = summarize_func
+        self.trigger = trigger
+        self.keep_recent = keep_recent
+        self.max_cached = max_cached
+        self.completed = 0
+        self.failed = 0
+        self._summaries = OrderedDict()
+        self._running = {}
+
+    async def get_summary(self, user_id):
+        """Краткое содержание разговора пользователя или None"""
+        if user_id in self._summaries:
+            self._summaries.move_to_end(user_id)
+            return self._summaries[user_id]
+        summary = await self.storage.get_summary(user_id)
+        self._remember(user_id, summary)
+        return summary
+
+    def maybe_schedule(self, user_id):
+        """Запускает сжатие, если история пользователя разрослась"""
+        if user_id in self._running:
+            return
+        length = self.history_cache.length(user_id)
+        if length is None or length < self.trigger:
+            return
+        self._running[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def stop(self):
+        """Дожидается завершения начатых сжатий"""
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    async def _run(self, user_id):
+        try:
+            await self._summarize(user_id)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка сжатия истории пользователя {user_id}: {e}")
+        finally:
+            del self._running[user_id]
+
+    async def _summarize(self, user_id):
+        # Сначала дописываем очередь, чтобы у всех сообщений были id в базе
+        await self.history_writer.flush()
+        rows = await self.storage.get_history_rows(user_id)
+        if len(rows) < self.trigger:
+            return
+
+        folded = rows[:len(rows) - self.keep_recent]
+        if not folded:
+            # Все сообщения остаются как есть: сжимать нечего
+            return
+        previous = await self.get_summary(user_id)
+        transcript = "\n".join(
+            f"{SPEAKERS.get(message_type, 'Пользователь')}: {text}"
+            for _, text, message_type, _ in folded
+        )
+        summary = await self.summarize_func(SUMMARY_SYSTEM_PROMPT, previous, transcript)
+        if not summary:
+            return
+
+        await self.storage.save_summary(user_id, summary, folded[-1][0])
+        self._remember(user_id, summary)
+        self.history_cache.invalidate(user_id)
+        self.completed += 1
+        logger.info(f"История пользователя {user_id} сжата: {len(folded)} сообщений")
+
+    def _remember(self, user_id, summary):
+        self._summaries[user_id] = summary
+        self._summaries.move_to_end(user_id)
+        while len(self._summaries) > self.max_cached:
+            self._summaries.popitem(last=False)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Пользователь для служебных запросов без автора (сжатие истории)
+SYSTEM_USER_ID = 0
+
+
+class Usage(NamedTuple):
+    """Сводный расход: запросы и токены"""
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+
+def quotas_error(quotas):
+    """Описание ошибки в user_token_quotas или None"""
+    if not isinstance(quotas, Mapping):
+        return "ожидался объект {id пользователя: квота}"
+    for user_id, quota in quotas.items():
+        if not str(user_id).lstrip("-").isdigit():
+            return f"ключ {user_id!r} должен быть id пользователя"
+        if isinstance(quota, bool) or not isinstance(quota, int) or quota < 0:
+            return f"квота пользователя {user_id} должна быть неотрицательным целым"
+    return None
+
+
+def _add(totals, key, requests, prompt_tokens, completion_tokens, latency):
+    row = totals.setdefault(key, [0, 0, 0, 0.0])
+    row[0] += requests
+    row[1] += prompt_tokens
+    row[2] += completion_tokens
+    row[3] += latency
+
+
+class UsageLedger:
+    """Журнал расхода нейросети: модель, токены и задержка каждого запроса.
+
+    Записи копятся в памяти и пишутся пачкой, как история сообщений: сырые
+    события и приращения сводок по дням (пользователь и модель), по часам
+    (модель) и итогов пользователя уходят в базу одной транзакцией. Расход
+    пользователей за текущие сутки (UTC) держится в памяти — по нему за O(1)
+    отвечает /stats и проверяется дневная квота токенов. Процессы-обработчики
+    делят пользователей по id, поэтому каждый видит полный расход своих.
+    """
+
+    def __init__(self, storage, flush_interval=1.0, batch_size=200, daily_token_quota=0,
+                 user_token_quotas=None):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.daily_token_quota = daily_token_quota
+        self.user_token_quotas = user_token_quotas or {}
+        self._pending = []
+        self._day = None
+        self._today = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def queue_size(self):
+        return len(self._pending)
+
+    def _roll(self, day):
+        # Новые сутки: дневные счетчики начинаются с нуля
+        if day != self._day:
+            self._day = day
+            self._today = {}
+
+    async def load(self):
+        """Загружает расход пользователей за текущие сутки"""
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        rows = await self.storage.load_usage_day(day)
+        self._roll(day)
+        for user_id, requests, prompt_tokens, completion_tokens in rows:
+            _add(self._today, user_id, requests, prompt_tokens, completion_tokens, 0.0)
+        logger.info(f"Журнал использования: загружен расход {len(rows)} пользователей за {day}")
+
+    def record(self, user_id, model, kind, prompt_tokens, completion_tokens, latency):
+        """Учитывает один запрос к нейросети"""
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self._roll(timestamp[:10])
+        prompt_tokens = prompt_tokens or 0
+        completion_tokens = completion_tokens or 0
+        _add(self._today, user_id, 1, prompt_tokens, completion_tokens, latency)
+        self._pending.append((user_id, model, kind, prompt_tokens, completion_tokens, latency, timestamp))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def today(self, user_id):
+        """Расход пользователя за текущие сутки"""
+        self._roll(datetime.now(timezone.utc).strftime('%Y-%m-%d'))
+        row = self._today.get(user_id)
+        return Usage(*row[:3]) if row else Usage()
+
+    def quota(self, user_id):
+        """Дневная квота токенов пользователя, 0 — без ограничения"""
+        return self.user_token_quotas.get(str(user_id), self.daily_token_quota)
+
+    def tokens_left(self, user_id):
+        """Сколько токенов пользователь еще может израсходовать сегодня, None — без ограничения"""
+        quota = self.quota(user_id)
+        if not quota:
+            return None
+        return max(0, quota - self.today(user_id).tokens)
+
+    async def totals(self, user_id):
+        """Расход пользователя за все время и дата первого запроса"""
+        await self.flush()
+        row = await self.storage.get_usage_totals(user_id)
+        if row is None:
+            return Usage(), None
+        requests, prompt_tokens, completion_tokens, first_day = row
+        return Usage(requests, prompt_tokens, completion_tokens), first_day
+
+    async def report(self, hours=24, top=10):
+        """Сводка для администратора по часовым и дневным сводкам, без сырых событий.
+
+        Возвращает (часы [(час, модель, Usage, суммарная задержка)], лучшие
+        пользователи суток [(user_id, Usage)]).
+        """
+        await self.flush()
+        now = datetime.now(timezone.utc)
+        since = (now - timedelta(hours=hours - 1)).strftime('%Y-%m-%d %H')
+        hour_rows = await self.storage.load_usage_hours(since)
+        user_rows = await self.storage.load_usage_day(now.strftime('%Y-%m-%d'))
+        hourly = [(hour, model, Usage(*values), latency) for hour, model, *values, latency in hour_rows]
+        users = sorted(
+            ((user_id, Usage(*values)) for user_id, *values in user_rows if user_id != SYSTEM_USER_ID),
+            key=lambda item: -item[1].tokens
+        )
+        return hourly, users[:top]
+
+    def start(self):
+        """Запускает фоновую запись"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает запись и сохраняет все, что осталось в очереди"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        """Записывает события и приращения сводок одной транзакцией"""
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        daily, hourly, totals = {}, {}, {}
+        for user_id, model, _, prompt_tokens, completion_tokens, latency, timestamp in rows:
+            _add(daily, (timestamp[:10], user_id, model), 1, prompt_tokens, completion_tokens, latency)
+            _add(hourly, (timestamp[:13], model), 1, prompt_tokens, completion_tokens, latency)
+            _add(totals, user_id, 1, prompt_tokens, completion_tokens, 0.0)
+        last_day = rows[-1][6][:10]
+        try:
+            await self.storage.save_usage(
+                rows,
+                [(*key, *values) for key, values in daily.items()],
+                [(*key, *values) for key, values in hourly.items()],
+                [(user_id, *values[:3], last_day) for user_id, values in totals.items()],
+            )
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала использования ({len(rows)} событий): {e}")
+            # Возвращаем события в начало очереди, чтобы не потерять их
+            self._pending = rows + self._pending
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -0,0 +1,140 @@
+import asyncio
+import hmac
+import json
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+from sharding import stop_event_on_signals
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """HTTP-сервер для приема обновлений Telegram через webhook.
+
+    Обновления проверяются по секретному токену и кладутся в update_queue
+    приложения, дальше их обрабатывает сам python-telegram-bot с тем же
+    ограничением параллельности, что и при polling. При остановке сервер
+    перестает принимать новые обновления (503, Telegram доставит их позже)
+    и дожидается обработки уже принятых.
+
+    Если передан dispatch, сырые обновления отдаются ему (например, процессам
+    WorkerPool), а не в очередь приложения.
+    """
+
+    def __init__(self, application, host="0.0.0.0", port=8443, path="/telegram",
+                 secret_token="", drain_timeout=30, dispatch=None):
+        self.application = application
+        self.dispatch = dispatch
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        self.received = 0
+        self.rejected = 0
+        self._draining = False
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self._handle_update)
+        self.app.router.add_get("/healthz", self._handle_health)
+
+    async def start(self):
+        """Запускает HTTP-сервер"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # При port=0 система выбирает свободный порт, запоминаем его
+        self.port = self._runner.addresses[0][1]
+        logger.info(f"Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+
+    async def drain(self):
+        """Перестает принимать обновления и ждет обработки принятых"""
+        self._draining = True
+        if self.application is None:
+            return
+        try:
+            await asyncio.wait_for(self.application.update_queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Не все обновления обработаны за {self.drain_timeout} с, "
+                f"в очереди осталось {self.application.update_queue.qsize()}"
+            )
+
+    async def stop(self):
+        """Останавливает HTTP-сервер"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_update(self, request):
+        if self._draining:
+            return web.Response(status=503, text="draining")
+
+        if self.secret_token:
+            received_token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received_token, self.secret_token):
+                self.rejected += 1
+                return web.Response(status=403, text="forbidden")
+
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError("ожидался JSON-объект")
+            update = None if self.dispatch else Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, TypeError, ValueError, KeyError) as e:
+            self.rejected += 1
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400, text="bad update")
+
+        self.received += 1
+        if self.dispatch:
+            await self.dispatch(data)
+        else:
+            await self.application.update_queue.put(update)
+        return web.Response(text="ok")
+
+    async def _handle_health(self, request):
+        if self._draining:
+            return web.Response(status=503, text="draining")
+        return web.Response(text="ok")
+
+
+async def serve_webhook(application, server, webhook_url=""):
+    """Полный жизненный цикл бота в режиме webhook.
+
+    Повторяет то, что делает run_polling: вызывает post_init и post_shutdown
+    приложения, а по SIGINT/SIGTERM корректно завершает работу.
+    """
+    stop_event = stop_event_on_signals()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+
+    if webhook_url:
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=server.secret_token or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook зарегистрирован: {webhook_url}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook-сервера, дожидаемся обработки обновлений...")
+        await server.drain()
+        await application.stop()
+        await server.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)